@@ -2,7 +2,11 @@
 
 import argparse
 import os
+import glob
+import json
 import polars as pl
+import pyarrow.parquet as pq
+from pipeline_utils import write_atomic
 
 
 arg_parser = argparse.ArgumentParser()
@@ -11,15 +15,35 @@ arg_parser.add_argument("--userinfo_path", type=str, required=True)
 arg_parser.add_argument("--save_path", type=str, required=True)
 arg_parser.add_argument("--present_tweet_ids_path", type=str, required=True)
 arg_parser.add_argument("--filter_hours", type=int, default=-1)
+arg_parser.add_argument("--windows", type=str, default=None)
+arg_parser.add_argument("--state_dir", type=str, default=None)
 
 
 MINUTE = 60
 HOUR = 60 * MINUTE
+STATE_KEY = b"folded"
 
 
 # [File Summary]
 # This script aggregates the second spread results from the second spreads directory.
 # Namely, This computes the cascading repost probability (CRP) for each user in each tweet.
+# [Configs]
+# filter_hours:
+#   If > 0, only the retweets of the followee within filter_hours
+#   from the source tweet are aggregated.
+# windows:
+#   Comma separated time windows in hours, e.g. "3,6,12,24,all".
+#   All the windows are aggregated in one pass over the second spread files.
+#   Each row is assigned to the smallest window it falls into,
+#   and the per-window aggregates are accumulated from it.
+#   If set, save_path is a directory and filter_hours is ignored.
+# state_dir:
+#   If set, the aggregate is kept in state_dir/aggregate.parquet, and the list of
+#   aggregated files is stored in the metadata of the same file.
+#   Both are replaced at once, so an interrupted run never counts a file twice.
+#   A rerun only aggregates the files added to second_sperads_dir since the last run
+#   and merges them into the kept aggregate.
+#   If an aggregated file or the configs are changed, the aggregate is rebuilt.
 # [Inputs]
 # second_sperads_dir:
 #   The path to the second spreads directory.
@@ -31,6 +55,132 @@ HOUR = 60 * MINUTE
 # present_tweet_ids_path:
 #   The path to the present tweet ids.
 #   This file is the output of the script extract_present_tweet_id_in_cascade.py.
+# [Outputs]
+# save_path:
+#   Path to save the aggregate.
+#   With windows, one file per window is saved in this directory
+#   (in_3hours.parquet, ..., in_1day.parquet, all.parquet).
+#   Windows that are whole days are named in days (24 -> in_1day).
+
+def parse_windows(windows, filter_hours):
+    # 時間窓 (hours) のリスト。None は全期間 (all)
+    if windows is None:
+        return [filter_hours] if filter_hours > 0 else [None]
+    hours = [None if w.strip() == "all" else int(w) for w in windows.split(",")]
+    return sorted(set(hours), key=lambda h: float("inf") if h is None else h)
+
+
+def window_name(hours):
+    # 24時間の倍数は日単位にする (24 -> in_1day)
+    if hours is None:
+        return "all"
+    if hours % 24 == 0:
+        return f"in_{hours // 24}day"
+    return f"in_{hours}hours"
+
+
+def window_index(windows):
+    # 各行が入る最小の窓のindex。どの窓にも入らない行 (時刻がnullの行を含む) はnull
+    passed_seconds = pl.col("followee_timestamp") - pl.col("source_timestamp")
+    index = pl.lit(None, dtype=pl.Int32)
+    for i, hours in reversed(list(enumerate(windows))):
+        in_window = pl.lit(True) if hours is None else passed_seconds <= hours * HOUR
+        index = pl.when(in_window).then(pl.lit(i, dtype=pl.Int32)).otherwise(index)
+    return index.alias("window")
+
+
+def scan_second_spreads(paths, windows, df_present):
+    columns = ["source_tweet_id", "followee", "parent_tweet_id", "is_retweeted", "is_in_cascade"]
+    if any(hours is not None for hours in windows):
+        columns += ["followee_timestamp", "source_timestamp"]
+
+    # ファイルごとにschemaが異なっても良いように、必要な列だけ選んでから結合する
+    lf = pl.concat([pl.scan_parquet(path).select(columns) for path in paths])
+    if windows == [None]:
+        lf = lf.with_columns(pl.lit(0, dtype=pl.Int32).alias("window"))
+    else:
+        lf = lf.with_columns(window_index(windows)).filter(pl.col("window").is_not_null())
+    return lf.join(df_present.lazy(), left_on="parent_tweet_id", right_on="tweet_id", how="semi")
+
+
+def aggregate(lf_ss):
+    return lf_ss.group_by(["source_tweet_id", "followee", "window"]).agg(
+        pl.len().alias("num_views"),
+        pl.sum("is_retweeted").alias("num_retweets"),
+        pl.col("is_in_cascade").first().alias("is_in_cascade"),
+    ).collect(streaming=True)
+
+
+def merge(dfs, by=("source_tweet_id", "followee", "window")):
+    return pl.concat(dfs).group_by(list(by)).agg(
+        pl.sum("num_views").alias("num_views"),
+        pl.sum("num_retweets").alias("num_retweets"),
+        pl.col("is_in_cascade").first().alias("is_in_cascade"),
+    )
+
+
+def cumulative(df_ss, window):
+    # 各行は最小の窓にだけ割り当てているので、window以下の窓を足すと累積値になる
+    return merge([df_ss.filter(pl.col("window") <= window)], by=("source_tweet_id", "followee"))
+
+
+def file_stats(paths):
+    return {os.path.basename(p): [os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths}
+
+
+def read_folded(aggregate_path):
+    # aggregate.parquet のmetadataに記録した集計済みのファイル。なければNone
+    if not os.path.exists(aggregate_path):
+        return None
+    metadata = pq.read_schema(aggregate_path).metadata or {}
+    if STATE_KEY not in metadata:
+        return None
+    return json.loads(metadata[STATE_KEY])
+
+
+def write_aggregate(aggregate_path, df_ss, folded):
+    # 集計結果と集計済みのファイルを1つのファイルにまとめて置き換える
+    table = df_ss.to_arrow()
+    table = table.replace_schema_metadata({STATE_KEY: json.dumps(folded, ensure_ascii=False)})
+    write_atomic(aggregate_path, lambda path: pq.write_table(table, path))
+
+
+def aggregate_incrementally(args, paths, windows, df_present):
+    # 集計済みのファイルは aggregate.parquet のmetadataに記録し、新しいファイルだけを集計して足し込む
+    aggregate_path = os.path.join(args.state_dir, "aggregate.parquet")
+    config = {
+        "second_sperads_dir": os.path.abspath(args.second_sperads_dir),
+        "present_tweet_ids": file_stats([args.present_tweet_ids_path]),
+        "windows": [window_name(hours) for hours in windows],
+    }
+    stats = file_stats(paths)
+
+    folded = read_folded(aggregate_path)
+    if folded is None:
+        folded = {"config": config, "files": {}}
+    else:
+        # 集計済みのファイルが変更・削除された場合は差分にできないので作り直す
+        changed = [name for name, stat in folded["files"].items() if stats.get(name) != stat]
+        if folded["config"] != config or changed:
+            print(f"Rebuilding the aggregate (config changed or {len(changed)} files changed)")
+            folded = {"config": config, "files": {}}
+
+    new_paths = [p for p in paths if os.path.basename(p) not in folded["files"]]
+    print(f"Folded files: {len(folded['files'])}, new files: {len(new_paths)}")
+
+    dfs = []
+    if folded["files"]:
+        dfs.append(pl.read_parquet(aggregate_path))
+    if new_paths:
+        dfs.append(aggregate(scan_second_spreads(new_paths, windows, df_present)))
+    df_ss = merge(dfs)
+
+    if new_paths or not folded["files"]:
+        os.makedirs(args.state_dir, exist_ok=True)
+        folded["files"].update({os.path.basename(p): stats[os.path.basename(p)] for p in new_paths})
+        write_aggregate(aggregate_path, df_ss, folded)
+    return df_ss
+
 
 def main(args):
     print("Loading User Information...")
@@ -54,41 +204,27 @@ def main(args):
     official_user_ids = df_userinfo.filter(
         df_userinfo["is_official"])["user_id"].to_list()
 
-    dfs = []
-    for second_spread_path in os.listdir(args.second_sperads_dir):
-        second_spread_path = os.path.join(args.second_sperads_dir, second_spread_path)
-        df_ss = pl.read_parquet(second_spread_path)
-
-        if args.filter_hours > 0:
-            df_ss = df_ss.with_columns(
-                (pl.col("followee_timestamp") - pl.col("source_timestamp")).alias("passed_seconds"),
-               ).filter(pl.col("passed_seconds") <= args.filter_hours * HOUR)
-
-        present_tweet_ids = pl.read_parquet(args.present_tweet_ids_path)["tweet_id"].to_list()
-        df_ss = df_ss.filter(pl.col("parent_tweet_id").is_in(present_tweet_ids))
-
-        print("Num Followees: ", df_ss["followee"].n_unique())
-
-        df_ss = df_ss.group_by(["source_tweet_id", "followee"]).agg(
-            pl.len().alias("num_views"),
-            pl.sum("is_retweeted").alias("num_retweets"),
-            pl.col("is_in_cascade").first().alias("is_in_cascade"),
+    print("Loading present tweet ids...")
+    df_present = pl.read_parquet(
+        args.present_tweet_ids_path, columns=["tweet_id"]).unique()
+
+    windows = parse_windows(args.windows, args.filter_hours)
+    second_spread_paths = sorted(glob.glob(os.path.join(args.second_sperads_dir, "*.parquet")))
+    if args.state_dir:
+        df_ss = aggregate_incrementally(args, second_spread_paths, windows, df_present)
+    else:
+        df_ss = aggregate(scan_second_spreads(second_spread_paths, windows, df_present))
+
+    if args.windows is not None:
+        os.makedirs(args.save_path, exist_ok=True)
+    for i, hours in enumerate(windows):
+        df_window = cumulative(df_ss, i).with_columns(
+            pl.col("followee").is_in(official_user_ids).alias("is_official")
         )
-        dfs.append(df_ss)
-
-    df_ss = pl.concat(dfs)
-
-    df_ss = df_ss.group_by(["source_tweet_id", "followee"]).agg(
-        pl.sum("num_views").alias("num_views"),
-        pl.sum("num_retweets").alias("num_retweets"),
-        pl.col("is_in_cascade").first().alias("is_in_cascade"),
-    )
-
-    df_ss = df_ss.with_columns(
-        pl.col("followee").is_in(official_user_ids).alias("is_official")
-    )
-
-    df_ss.write_parquet(args.save_path)
+        if args.windows is None:
+            df_window.write_parquet(args.save_path)
+        else:
+            df_window.write_parquet(os.path.join(args.save_path, f"{window_name(hours)}.parquet"))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import re
+import time
+import random
+import argparse
+import neologdn
+import polars as pl
+from utils import RE_EMOTICON, clean_text, clean_text_expr
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("--num_texts", type=int, default=100_000)
+arg_parser.add_argument("--num_check_texts", type=int, default=200_000)
+arg_parser.add_argument("--repeat", type=int, default=3)
+arg_parser.add_argument("--seed", type=int, default=0)
+arg_parser.add_argument("--texts_path", type=str, default=None)
+arg_parser.add_argument("--text_column", type=str, default="tweet_text")
+arg_parser.add_argument("--check_only", action="store_true")
+
+
+# [File Summary]
+# This script checks and benchmarks utils.clean_text and utils.clean_text_expr
+#   against the previous implementation (legacy_clean_text below).
+# First, every symbolize / remove_nlsp combination is checked on a corpus of
+#   adversarial texts (URLs glued to mentions, emoticons and other URLs, newlines,
+#   zero width spaces, ...) and on REGRESSION_TEXTS, the texts that differed before.
+#   The script fails if any output of clean_text or clean_text_expr differs from legacy_clean_text.
+# Then the three implementations are timed on a realistic tweet corpus.
+# [Configs]
+# num_texts:
+#   Number of texts for the benchmark.
+# num_check_texts:
+#   Number of adversarial texts for the equivalence check.
+# texts_path:
+#   If set, the benchmark uses text_column of this parquet file
+#   (e.g. the output of canonicalize_source_tweets.py) instead of synthetic tweets.
+#   The texts are also added to the equivalence check.
+# repeat:
+#   Number of runs per implementation. The best time is reported.
+# check_only:
+#   Only run the equivalence check (e.g. after changing clean_text).
+
+# 過去に結果が食い違ったテキスト。毎回必ず検査する
+REGRESSION_TEXTS = [
+    "http://https://video.twimg.com/https://pbs.twimg.com/a https://t.co/x",
+    "https://video.twimg.com/https://pbs.twimg.com/a",
+    "@user_https://video.twimg.com/https://pbs.twimg.com/a(^_^)",
+]
+
+SYMBOLIZE_OPTIONS = [
+    {"mention", "emoticon", "url"},
+    {"mention", "url"},
+    {"emoticon", "url"},
+    {"mention", "emoticon"},
+    {"url"},
+    {"emoticon"},
+    {"mention"},
+    set(),
+]
+
+
+# 以前の utils.clean_text
+def legacy_symbolize_mention(text):
+    return re.sub(r"@[a-zA-Z0-9_]+", " MENTIONSYM ", text)
+
+
+def legacy_symbolize_emoticon(text):
+    return RE_EMOTICON.sub(" EMOSYM ", text)
+
+
+def legacy_symbolize_url(text):
+    text = re.sub(r"https://pbs.twimg.com/[\w/:%#\$&\?\(\)~\.=\+\-]+", " IMGSYM ", text)
+    text = re.sub(r"https://video.twimg.com/[\w/:%#\$&\?\(\)~\.=\+\-]+", " VIDEOSYM ", text)
+    return re.sub(r"h?ttps?://?[\w/:%#\$&\?\(\)~\.=\+\-]+", " URLSYM ", text)
+
+
+def legacy_clean_text(text, symbolize={"mention", "emoticon", "url"}, remove_nlsp=True):
+    text = neologdn.normalize(text, tilde="normalize")
+    text = re.sub(r"(.+)(https?)", "\\1 \\2", text)
+
+    if "url" in symbolize:
+        text = legacy_symbolize_url(text)
+
+    if "emoticon" in symbolize:
+        text = legacy_symbolize_emoticon(text)
+
+    if "mention" in symbolize:
+        text = legacy_symbolize_mention(text)
+
+    if remove_nlsp:
+        text = text.replace("​", " ")
+        text = re.sub(r"(\n|\r\n|\r)+", "\n", text)
+        text = re.sub(r"\s+", " ", text)
+
+    return text
+
+
+def adversarial_texts(num_texts, rng):
+    # 置換どうしが重なる・隣接するケースを多く含む断片をつなげる
+    pieces = [
+        "https://pbs.twimg.com/media/Ab1.jpg", "https://video.twimg.com/ext/1.mp4",
+        "https://t.co/AbC12", "http://example.com/a?b=1&c=(2)", "ttps://x.jp/", "http:/",
+        "https://", "http", "https", "pbs.twimg.com/", "@user_1", "@", "@abc", "＠ユーザー",
+        "(^_^)", "(｀・ω・´)", "（＾ω＾）", "【・∀・】", "(~", "(@xy", "[", "(", "^_^",
+        "ω", "。", "ー", "今日は", "ｶﾞｯ", "晴れ", "ABC", "x", "1", "_", "/", ":", "#",
+        " ", "  ", "\n", "\r\n", "\r", "\t", "​", "　", "\xa0", "\x1c", "~", "〜",
+        "①", "²", "é", "́", "‿", "👍", "http://", "https://video.twimg.com/",
+    ]
+    return [
+        "".join(rng.choice(pieces) for _ in range(rng.randint(1, 12)))
+        for _ in range(num_texts)
+    ]
+
+
+def realistic_tweets(num_texts, rng):
+    sentences = [
+        "今日はとても良い天気ですね！", "新曲のMVが公開されました🎉", "拡散希望",
+        "詳しくはこちら", "ありがとうございます(^_^)", "明日のライブ楽しみすぎる",
+        "【お知らせ】本日20時から配信します", "これは本当にひどい…", "#拡散希望 #RTした人全員フォローする",
+        "Check this out!", "ｱｲｽ食べたい", "ＮＨＫのニュースより", "まじか（｀・ω・´）",
+    ]
+    extras = [
+        "https://t.co/{}", "https://pbs.twimg.com/media/{}.jpg", "https://video.twimg.com/ext/{}.mp4",
+        "@user{}", "\n", "\n\n", "​", "　",
+    ]
+    tweets = []
+    for _ in range(num_texts):
+        parts = [rng.choice(sentences) for _ in range(rng.randint(1, 4))]
+        for _ in range(rng.randint(0, 3)):
+            parts.insert(rng.randint(0, len(parts)), rng.choice(extras).format(rng.randint(0, 10**8)))
+        tweets.append("".join(parts))
+    return tweets
+
+
+def check(texts):
+    df = pl.DataFrame({"text": texts})
+    num_diffs = 0
+    for symbolize in SYMBOLIZE_OPTIONS:
+        for remove_nlsp in [True, False]:
+            expected = [legacy_clean_text(t, symbolize, remove_nlsp) for t in texts]
+            compiled = [clean_text(t, symbolize, remove_nlsp) for t in texts]
+            vectorized = df.select(clean_text_expr(pl.col("text"), symbolize, remove_nlsp))["text"].to_list()
+            for name, outputs in [("clean_text", compiled), ("clean_text_expr", vectorized)]:
+                diffs = [(t, e, o) for t, e, o in zip(texts, expected, outputs) if e != o]
+                num_diffs += len(diffs)
+                for text, e, o in diffs[:3]:
+                    print(f"{name} {sorted(symbolize)} {remove_nlsp}: {text!r} -> {o!r}, expected {e!r}")
+    return num_diffs
+
+
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    if args.texts_path:
+        texts = pl.read_parquet(args.texts_path, columns=[args.text_column])[args.text_column]
+        texts = texts.drop_nulls().head(args.num_texts).to_list()
+    else:
+        texts = realistic_tweets(args.num_texts, rng)
+
+    print("Checking the equivalence...")
+    num_diffs = check(REGRESSION_TEXTS + adversarial_texts(args.num_check_texts, rng) + texts)
+    if num_diffs > 0:
+        raise ValueError(f"{num_diffs} outputs differ from the previous clean_text")
+    print("All outputs are equal to the previous clean_text")
+    if args.check_only:
+        return
+
+    # 文字クラスの展開はキャッシュされるので、計測前に1回作っておく
+    df = pl.DataFrame({"text": texts})
+    df.head(1).select(clean_text_expr(pl.col("text")))
+
+    results = [
+        ("legacy", best_time(lambda: [legacy_clean_text(t) for t in texts], args.repeat)),
+        ("clean_text", best_time(lambda: [clean_text(t) for t in texts], args.repeat)),
+        ("clean_text_expr", best_time(lambda: df.select(clean_text_expr(pl.col("text"))), args.repeat)),
+    ]
+    print(f"{'implementation':<16} {'seconds':>8} {'texts/s':>10}")
+    for name, seconds in results:
+        print(f"{name:<16} {seconds:8.2f} {len(texts) / seconds:10.0f}")
+
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    main(args)
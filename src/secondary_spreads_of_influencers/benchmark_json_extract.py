@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import time
+import json
+import random
+import argparse
+import polars as pl
+from json_extract import BACKENDS, decode_dtype, extract_fields
+from format_retweet_data import TWEET_FIELDS
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("--num_lines", type=int, default=200_000)
+arg_parser.add_argument("--padding_bytes", type=int, default=2_000)
+arg_parser.add_argument("--batch_size", type=int, default=100_000)
+arg_parser.add_argument("--repeat", type=int, default=3)
+arg_parser.add_argument("--seed", type=int, default=0)
+
+
+# [File Summary]
+# This script compares the JSON extraction backends of json_extract.py
+#   on a synthetic hour of raw retweets.
+# "json_decode" is the previous format_retweet_data.py path,
+#   which decodes the whole line twice (once for the retweet schema and once for
+#   the source schema) with pl.Series.str.json_decode.
+# The other rows extract TWEET_FIELDS once with each backend.
+# The extracted columns of every backend are checked to be equal to the "polars" backend.
+# The orjson backend is skipped if orjson is not installed.
+# [Configs]
+# num_lines:
+#   Number of JSON lines (an hourly file has about this many retweets).
+# padding_bytes:
+#   Size of the unused fields added to each line, to mimic the full API response.
+# batch_size:
+#   Number of lines per batch of extract_fields.
+# repeat:
+#   Number of runs per backend. The best time is reported.
+
+
+def synthetic_user(rng, user_id):
+    return {
+        "id": user_id,
+        "name": f"name{user_id}",
+        "screen_name": f"screen{user_id}",
+        "description": "bio " * rng.randint(0, 20),
+        "followers_count": rng.randint(0, 10**6),
+        "friends_count": rng.randint(0, 10**4),
+        "created_at": "Mon Jan 03 10:00:00 +0000 2011",
+        "profile_image_url_https": "https://pbs.twimg.com/profile_images/0/x.jpg",
+        "verified": False,
+    }
+
+
+def synthetic_lines(num_lines, padding_bytes, seed):
+    rng = random.Random(seed)
+    padding = {f"unused_{i}": "x" * 90 for i in range(padding_bytes // 100)}
+    lines = []
+    for i in range(num_lines):
+        source = {
+            "id": rng.randint(1, 10**6),
+            "user": synthetic_user(rng, rng.randint(1, 10**5)),
+            "full_text": "source text " * rng.randint(1, 10),
+            "entities": {
+                "hashtags": [{"text": f"tag{rng.randint(0, 99)}", "indices": [0, 5]}
+                             for _ in range(rng.randint(0, 3))],
+                "urls": [{"expanded_url": "https://example.com/", "url": "https://t.co/x"}],
+            },
+            "extended_entities": {"media": [{"type": "photo", "id": i}]} if i % 3 == 0 else None,
+            **padding,
+        }
+        tweet = {
+            "id": 10**12 + i,
+            "user": synthetic_user(rng, rng.randint(1, 10**5)),
+            "full_text": "RT " + source["full_text"],
+            "retweeted_status": source,
+            **padding,
+        }
+        lines.append(json.dumps(tweet, ensure_ascii=False))
+    return pl.Series("json_data", lines)
+
+
+def legacy_json_decode(lines):
+    # format_retweet_data.py の以前の実装と同じく、スキーマごとに全体をデコードする
+    fields = {alias: (path, dtype) for alias, path, dtype in TWEET_FIELDS}
+    retweet_aliases = ["user_id", "name", "screen_name", "description", "followers_count",
+                       "friends_count", "user_created_at", "source_tweet_id", "full_text"]
+    source_aliases = [alias for alias in fields if alias not in retweet_aliases] + ["source_tweet_id"]
+    df = lines.to_frame()
+    for aliases in [retweet_aliases, source_aliases]:
+        dtype = decode_dtype([(alias, *fields[alias]) for alias in aliases])
+        df.with_columns(pl.col("json_data").str.json_decode(dtype))
+
+
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(args):
+    print(f"Generating {args.num_lines} lines...")
+    lines = synthetic_lines(args.num_lines, args.padding_bytes, args.seed)
+    mb = lines.str.len_bytes().sum() / 1024 ** 2
+    print(f"{mb:.1f} MB")
+
+    legacy_time, _ = best_time(lambda: legacy_json_decode(lines), args.repeat)
+    results = [("json_decode", legacy_time, "-")]
+
+    expected = None
+    for backend in BACKENDS:
+        try:
+            seconds, df = best_time(
+                lambda: extract_fields(lines, TWEET_FIELDS, backend=backend, batch_size=args.batch_size),
+                args.repeat)
+        except ImportError as err:
+            print(f"Skip {backend}: {err}")
+            continue
+        if expected is None:
+            expected = df
+        results.append((backend, seconds, df.equals(expected)))
+
+    print(f"{'backend':<12} {'seconds':>8} {'MB/s':>8} {'lines/s':>10}  equal")
+    for backend, seconds, equal in results:
+        print(f"{backend:<12} {seconds:8.2f} {mb / seconds:8.1f} {args.num_lines / seconds:10.0f}  {equal}")
+
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    main(args)
@@ -2,14 +2,16 @@
 
 import argparse
 import os
-from tqdm import tqdm
+from datetime import datetime
 import polars as pl
+from follower_graph import save_follow_store
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--save_path", type=str, required=True)
 arg_parser.add_argument("--follower_dir", type=str, required=True)
 arg_parser.add_argument("--following_dir", type=str, required=True)
+arg_parser.add_argument("--store_dir", type=str, default=None)
 
 
 # [File Summary]
@@ -30,51 +32,67 @@ arg_parser.add_argument("--following_dir", type=str, required=True)
 #     12872;11993
 # [Outputs]
 # save_path:
-#   Path to save the follower relations.
+#   Path to save the follower relations (follower, followee, first_seen, last_seen).
+#   first_seen / last_seen are the dates of the first and last snapshot files
+#   that contain the relation. They are used by the --as_of modes.
+# store_dir:
+#   If set, the follower graph is also saved here as memory-mappable .npy arrays
+#   (user id dictionary and followers-of / following-of CSR, see follower_graph.py).
 
 
-def main(args):
-    follower_files = os.listdir(args.follower_dir)
-    following_files = os.listdir(args.following_dir)
-
-    follower_target_files = []
-    for follower_file in follower_files:
-        if "unknown.err" in follower_file:
-            continue
-        follower_target_files.append(f"{args.follower_dir}/{follower_file}")
+def snapshot_date(path):
+    # follower_dir/2021-10-02.txt -> 2021-10-02. 日付でないファイル名は None
+    try:
+        return datetime.strptime(os.path.splitext(os.path.basename(path))[0], "%Y-%m-%d").date()
+    except ValueError:
+        return None
 
-    records = set()  # [(follower_id, user_id), ...)]
 
-    for follower_file in tqdm(follower_target_files):
-        df = pl.read_csv(
-            follower_file,
+def scan_relations(files, columns):
+    # columns: ファイルの2列の名前 (follower/followee)
+    return [
+        pl.scan_csv(
+            path,
             separator=";",
             has_header=False,
-            new_columns=["user_id", "follower_id"],
-            schema={"user_id": pl.Int64, "follower_id": pl.Int64},
+            new_columns=columns,
+            schema={columns[0]: pl.Int64, columns[1]: pl.Int64},
+        ).select(
+            "follower",
+            "followee",
+            pl.lit(snapshot_date(path), dtype=pl.Date).alias("date"),
         )
-        records.update(df[["follower_id", "user_id"]].rows())
+        for path in files
+    ]
 
-    following_target_files = []
-    for following_file in following_files:
-        if "unknown.err" in following_file:
-            continue
-        following_target_files.append(f"{args.following_dir}/{following_file}")
 
-    for following_file in tqdm(following_target_files):
-        df = pl.read_csv(
-            following_file,
-            separator=";",
-            has_header=False,
-            new_columns=["user_id", "following_id"],
-            schema={"user_id": pl.Int64, "following_id": pl.Int64},
-        )
-        records.update(df[["user_id", "following_id"]].rows())
+def main(args):
+    follower_target_files = [
+        os.path.join(args.follower_dir, f) for f in sorted(os.listdir(args.follower_dir))
+        if "unknown.err" not in f
+    ]
+    following_target_files = [
+        os.path.join(args.following_dir, f) for f in sorted(os.listdir(args.following_dir))
+        if "unknown.err" not in f
+    ]
+    print(f"Follower files: {len(follower_target_files)}, following files: {len(following_target_files)}")
 
-    df = pl.DataFrame(list(records),
-                      schema=["follower", "followee"],
-                      orient="row")
+    lf = pl.concat(
+        scan_relations(follower_target_files, ["followee", "follower"])
+        + scan_relations(following_target_files, ["follower", "followee"])
+    ).group_by(["follower", "followee"]).agg(
+        pl.col("date").min().alias("first_seen"),
+        pl.col("date").max().alias("last_seen"),
+    )
+
+    print("Deduplicating follow relations...")
+    df = lf.collect(streaming=True)
     df.write_parquet(args.save_path)
+    print(f"Number of follow relations: {len(df)}")
+
+    if args.store_dir:
+        print("Building the follower graph store...")
+        save_follow_store(df, args.store_dir)
 
 
 if __name__ == "__main__":
@@ -2,11 +2,20 @@
 
 import argparse
 import heapq
+import multiprocessing as mp
 import networkx as nx
 from tqdm import tqdm
+import numpy as np
 import polars as pl
 from models import Tweet
-import json
+from follower_graph import is_follow_store, load_follower_graph
+from cascade_engine import build_cascade
+from cascade_io import (
+    NdjsonCascadeWriter,
+    ParquetCascadeWriter,
+    part_path,
+    write_manifest,
+)
 
 
 arg_parser = argparse.ArgumentParser()
@@ -14,10 +23,42 @@ arg_parser.add_argument("--save_path", type=str, required=True)
 arg_parser.add_argument("--collected_retweets_path", type=str, required=True)
 arg_parser.add_argument("--qt_ids_path", type=str, required=True)
 arg_parser.add_argument("--follow_relation_data_path", type=str, required=True)
+arg_parser.add_argument("--engine", type=str, default="csr", choices=["csr", "networkx"])
+arg_parser.add_argument("--format", type=str, default="ndjson", choices=["ndjson", "parquet"])
+arg_parser.add_argument("--workers", type=int, default=1)
+arg_parser.add_argument("--num_shards", type=int, default=None)
+arg_parser.add_argument("--as_of", action="store_true")
 
 
 # [File Summary]
 # This script builds the retweet cascades from the collected retweets.
+# [Configs]
+# engine:
+#   "csr" builds the cascades with cascade_engine.py over a CSR follower graph.
+#   "networkx" uses the original build_social_graphs implementation.
+#   Both engines attach each retweet to the earliest followee's tweet.
+#   If several candidate parents share the same timestamp,
+#   "csr" picks the one collected first, while "networkx" depends on the heapq order.
+# format:
+#   "ndjson" saves networkx node_link_data graphs, one cascade per line.
+#   "parquet" saves flat edge and node tables under save_path/edges and save_path/nodes.
+#   See cascade_io.py for the columns. Requires the csr engine.
+# workers:
+#   Number of worker processes.
+#   The workers are forked after loading the follow relations,
+#   so they share the follower graph copy-on-write.
+#   The shards are converted to Python rows before forking, so the workers never call polars
+#   (its thread pool may deadlock in a forked child).
+#   If workers > 1, each shard of source tweets is written to its own part file
+#   (e.g. cascades.part-00000.jsonl, or cascades/edges/part-00000.parquet)
+#   and the part files are listed in cascades.manifest.json.
+#   Concatenating the parts gives the serial output.
+# num_shards:
+#   Number of contiguous shards of source tweets. Defaults to 4 * workers.
+# as_of:
+#   Only use the follow relations that existed on the day of each retweet
+#   (first_seen <= day <= last_seen), instead of the union of all snapshots.
+#   Requires the csr engine and follow relation data built with dates.
 # [Inputs]
 # collected_retweets_path:
 #   Path to the collected retweets.
@@ -29,9 +70,17 @@ arg_parser.add_argument("--follow_relation_data_path", type=str, required=True)
 # follow_relation_data_path:
 #   Path to the follow relation data.
 #   The follow relation data is generated by build_follow_relation_data.py.
+#   The store directory (build_follow_relation_data.py --store_dir) can be given instead
+#   with the csr engine. It is memory-mapped, so forked workers share one copy of it.
 # [Outputs]
 # save_path:
 #   Path to save the social graphs.
+#   A directory if format is "parquet".
+#   If workers > 1, the manifest is saved next to this path.
+
+
+# fork前に設定し、子プロセスからcopy-on-writeで参照する
+_worker_state = {}
 
 
 def build_social_graphs(row, users, users_ids, quote_ids):
@@ -112,31 +161,108 @@ def build_social_graphs(row, users, users_ids, quote_ids):
     return nx.node_link_data(G)
 
 
+def open_writer(format, save_path, part_idx=None):
+    if format == "parquet":
+        return ParquetCascadeWriter(save_path, part_idx or 0)
+    if part_idx is None:
+        return NdjsonCascadeWriter(save_path)
+    return NdjsonCascadeWriter(part_path(save_path, part_idx))
+
+
+def write_cascades(rows, build, writer):
+    num_cascades = 0
+    for row in rows:
+        cascade = build(row)
+        if cascade is None:
+            continue
+        writer.write(row["source_tweet_id"], cascade)
+        num_cascades += 1
+    return num_cascades
+
+
+def build_shard(part_idx):
+    rows = _worker_state["shard_rows"][part_idx]
+    with open_writer(_worker_state["format"], _worker_state["save_path"], part_idx) as writer:
+        num_cascades = write_cascades(rows, _worker_state["build"], writer)
+    return writer.paths, num_cascades
+
+
 def main(args):
+    if args.format == "parquet" and args.engine != "csr":
+        raise ValueError("--format parquet requires --engine csr")
+    if args.as_of and args.engine != "csr":
+        raise ValueError("--as_of requires --engine csr")
+
     df_rt = pl.read_parquet(args.collected_retweets_path)
 
     df_qt = pl.read_parquet(args.qt_ids_path)
-    quote_ids = set(df_qt["tweet_id"].unique().to_list())
+    df_rt = df_rt.filter(pl.col("cascade_size") > 1)
 
-    df_follow_relation = pl.read_parquet(args.follow_relation_data_path)
+    if args.engine == "csr":
+        quote_ids = np.sort(df_qt["tweet_id"].unique().cast(pl.Int64).to_numpy())
+        graph = load_follower_graph(args.follow_relation_data_path)
+        if args.as_of and not graph.has_dates:
+            raise ValueError("--as_of requires first_seen / last_seen in the follow relation data")
 
-    users_ids = set(df_follow_relation["followee"].unique().to_list())
-    users = dict(df_follow_relation.group_by("followee").agg(
-        pl.col("follower").alias("follower_ids")
-    ).rows())
-    df_rt = df_rt.filter(pl.col("cascade_size") > 1)
+        def build(row):
+            return build_cascade(
+                graph,
+                row["source_tweet_id"],
+                int(row["source_user_id"]),
+                row["source_timestamp"],
+                row["retweets"],
+                row["retweeted_user_ids"],
+                row["retweet_timestamps"],
+                quote_ids=quote_ids,
+                as_of=args.as_of,
+            )
+    else:
+        if is_follow_store(args.follow_relation_data_path):
+            raise ValueError("--engine networkx requires the follow relation parquet")
+        df_follow_relation = pl.read_parquet(args.follow_relation_data_path)
+        quote_ids = set(df_qt["tweet_id"].unique().to_list())
+        users_ids = set(df_follow_relation["followee"].unique().to_list())
+        users = dict(df_follow_relation.group_by("followee").agg(
+            pl.col("follower").alias("follower_ids")
+        ).rows())
 
-    with open(args.save_path, "w", encoding="utf-8") as f:
-        for row in tqdm(df_rt.rows(named=True), total=len(df_rt)):
-            G = build_social_graphs(row, users, users_ids, quote_ids)
-            if G is None:
-                continue
-            line = {
-                "source_tweet_id": row["source_tweet_id"],
-                "graph": G,
-            }
-            json.dump(line, f, ensure_ascii=False)
-            f.write("\n")
+        def build(row):
+            return build_social_graphs(row, users, users_ids, quote_ids)
+
+    if args.workers <= 1:
+        with open_writer(args.format, args.save_path) as writer:
+            write_cascades(tqdm(df_rt.rows(named=True), total=len(df_rt)), build, writer)
+        return
+
+    num_shards = args.num_shards or args.workers * 4
+    shard_size = max(-(-len(df_rt) // num_shards), 1)
+    _worker_state["shard_rows"] = [
+        df_rt.slice(offset, shard_size).rows(named=True)
+        for offset in range(0, len(df_rt), shard_size)
+    ]
+    shards = list(range(len(_worker_state["shard_rows"])))
+    del df_rt
+
+    _worker_state["build"] = build
+    _worker_state["format"] = args.format
+    _worker_state["save_path"] = args.save_path
+
+    with mp.get_context("fork").Pool(args.workers) as pool:
+        results = list(tqdm(pool.imap(build_shard, shards), total=len(shards)))
+
+    num_cascades = sum(n for _, n in results)
+    if args.format == "parquet":
+        path = write_manifest(
+            args.save_path,
+            [edges_path for (edges_path, _), _ in results],
+            num_cascades,
+            format="parquet",
+            node_part_paths=[nodes_path for (_, nodes_path), _ in results],
+        )
+    else:
+        path = write_manifest(
+            args.save_path, [path for (path,), _ in results], num_cascades)
+    print(f"Saved manifest: {path}")
 
 
 if __name__ == "__main__":
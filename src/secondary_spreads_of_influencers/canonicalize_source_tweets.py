@@ -3,15 +3,30 @@
 import argparse
 import polars as pl
 import os
-from utils import Tokenizer
+from utils import decompressed_dict_path, tokenize_batch
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--source_tweets_dir", type=str, required=True)
 arg_parser.add_argument("--data_save_path", type=str, required=True)
+arg_parser.add_argument("--workers", type=int, default=1)
+arg_parser.add_argument("--dict_path", type=str, default=None)
+arg_parser.add_argument("--token_cache_dir", type=str, default=None)
+arg_parser.add_argument("--token_cache_max_entries", type=int, default=10_000_000)
 
 # [File Summary]
 # This script canonicalizes the source tweets.
+# [Configs]
+# workers:
+#   Number of tokenizer processes (see utils.tokenize_batch).
+# dict_path:
+#   vibrato dictionary (.dic or .dic.zst). Defaults to $VIBRATO_DICT_PATH or utils.DEFAULT_DICT_PATH.
+#   A .zst dictionary is decompressed once into $VIBRATO_DICT_CACHE_DIR (see utils.load_tokenizer).
+# token_cache_dir:
+#   If set, the tokens are cached in token_cache_dir/tokens.parquet (see utils.tokenize_batch),
+#   and only the texts that are not in the cache are tokenized on the next run.
+# token_cache_max_entries:
+#   Maximum number of cached texts. The least recently used texts are evicted.
 # [Input]
 # source_tweets_dir:
 #   Directory containing the source tweets.
@@ -47,12 +62,16 @@ def main(args):
 
     df_source = df_source.rename({"source_tweet_id": "tweet_id"})
 
+    # .zst の辞書はworkerを起動する前に展開しておく
+    print(f"Dictionary: {decompressed_dict_path(args.dict_path)}")
+    stats = {}
     df_source = df_source.with_columns(
-        pl.col("tweet_text").map_elements(
-            Tokenizer(),
-            return_dtype=pl.List(pl.String)
-        ).alias("tokenized_text")
-    )
+        tokenize_batch(df_source["tweet_text"], workers=args.workers, dict_path=args.dict_path,
+                       cache_dir=args.token_cache_dir, cache_max_entries=args.token_cache_max_entries,
+                       stats=stats)
+        .alias("tokenized_text"))
+    if args.token_cache_dir:
+        print(f"Token cache hits: {stats['cache_hits']} / {stats['num_texts']}")
 
     df_source.write_parquet(args.data_save_path)
 
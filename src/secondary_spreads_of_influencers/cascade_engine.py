@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+from typing import NamedTuple
+import numpy as np
+from follower_graph import SECONDS_PER_DAY
+
+
+# [File Summary]
+# CSR-backed retweet cascade builder.
+# A retweet v is attached to the earliest tweet u in the cascade such that
+#   - the user of v follows the user of u, and
+#   - v was posted after u,
+# which is the same tree build_rt_cascades.build_social_graphs produces
+# with networkx and heapq, computed over numpy arrays instead.
+# Node 0 is always the source tweet and the other nodes are sorted by timestamp,
+# so a parent always has a smaller index than its children.
+# With as_of=True, a follow relation is only used if it existed on the day of the retweet
+#   (first_seen / last_seen in follower_graph.py).
+
+
+class Cascade(NamedTuple):
+    tweet_ids: np.ndarray
+    user_ids: np.ndarray
+    timestamps: np.ndarray
+    is_quote: np.ndarray
+    parents: np.ndarray  # parent node index of each node. -1 for the source tweet.
+
+    def __len__(self):
+        return len(self.tweet_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.tweet_ids) - 1
+
+
+def _cascade_nodes(source_tweet_id, source_user_id, source_timestamp,
+                   retweet_ids, retweeted_user_ids, retweet_timestamps):
+    tweet_ids = np.asarray(retweet_ids, dtype=np.int64)
+    user_ids = np.asarray(retweeted_user_ids, dtype=np.int64)
+    timestamps = np.asarray(retweet_timestamps, dtype=np.int64)
+
+    # 同じユーザが複数回RTしている場合は最後のRTを使う (dict(zip(...)) と同じ)
+    _, last_from_end = np.unique(user_ids[::-1], return_index=True)
+    keep = len(user_ids) - 1 - last_from_end
+    keep = keep[np.lexsort((keep, timestamps[keep]))]
+
+    tweet_ids = np.concatenate([[source_tweet_id], tweet_ids[keep]]).astype(np.int64)
+    user_ids = np.concatenate([[source_user_id], user_ids[keep]]).astype(np.int64)
+    timestamps = np.concatenate([[source_timestamp], timestamps[keep]]).astype(np.int64)
+    return tweet_ids, user_ids, timestamps
+
+
+def _candidate_edges(graph, user_ids, timestamps, max_items, as_of=False):
+    # sourceから到達できるノードを幅優先で広げ、(親, 子) の候補エッジをすべて列挙する
+    # as_of=True なら子のRT時点で存在したフォロー関係だけを使う
+    num_nodes = len(user_ids)
+    retweet_order = np.argsort(user_ids[1:], kind="stable") + 1
+    sorted_users = user_ids[retweet_order]
+
+    reached = np.zeros(num_nodes, dtype=bool)
+    reached[0] = True
+    frontier = np.zeros(1, dtype=np.int64)
+
+    parents, children = [], []
+    while len(frontier) > 0 and len(sorted_users) > 0:
+        rows = graph.rows(user_ids[frontier])
+        frontier = frontier[rows >= 0]
+        rows = rows[rows >= 0]
+
+        new_nodes = []
+        for owner, edges in graph.iter_edges(rows, max_items):
+            followers = graph.user_ids[graph.indices[edges]]
+            pos = np.minimum(np.searchsorted(sorted_users, followers), len(sorted_users) - 1)
+            hit = sorted_users[pos] == followers
+            u = frontier[owner[hit]]
+            v = retweet_order[pos[hit]]
+
+            later = timestamps[v] > timestamps[u]
+            if as_of:
+                later &= graph.valid_at(edges[hit], timestamps[v] // SECONDS_PER_DAY)
+            u, v = u[later], v[later]
+            parents.append(u)
+            children.append(v)
+            new_nodes.append(v[~reached[v]])
+
+        frontier = np.unique(np.concatenate(new_nodes)) if new_nodes else np.zeros(0, dtype=np.int64)
+        reached[frontier] = True
+
+    if len(parents) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(parents), np.concatenate(children)
+
+
+def build_cascade(graph, source_tweet_id, source_user_id, source_timestamp,
+                  retweet_ids, retweeted_user_ids, retweet_timestamps,
+                  quote_ids=None, max_items=1 << 24, as_of=False):
+    tweet_ids, user_ids, timestamps = _cascade_nodes(
+        source_tweet_id, source_user_id, source_timestamp,
+        retweet_ids, retweeted_user_ids, retweet_timestamps)
+
+    u, v = _candidate_edges(graph, user_ids, timestamps, max_items, as_of)
+    if len(v) == 0:
+        return None
+
+    # 子ごとに最も早い親を残す。ノードは時刻順なのでindexが小さいほど早い
+    order = np.lexsort((u, v))
+    u, v = u[order], v[order]
+    first = np.ones(len(v), dtype=bool)
+    first[1:] = v[1:] != v[:-1]
+    u, v = u[first], v[first]
+
+    nodes = np.concatenate([[0], v])
+    remap = np.full(len(tweet_ids), -1, dtype=np.int64)
+    remap[nodes] = np.arange(len(nodes))
+    parents = np.concatenate([[-1], remap[u]])
+
+    tweet_ids = tweet_ids[nodes]
+    if quote_ids is not None and len(quote_ids) > 0:
+        is_quote = np.isin(tweet_ids, quote_ids)
+        is_quote[0] = False
+    else:
+        is_quote = np.zeros(len(nodes), dtype=bool)
+
+    return Cascade(
+        tweet_ids=tweet_ids,
+        user_ids=user_ids[nodes],
+        timestamps=timestamps[nodes],
+        is_quote=is_quote,
+        parents=parents,
+    )
+
+
+def tree_roots_and_depths(parents):
+    # parents: 親ノードのindex (rootは -1)。複数の木をまとめて渡してもよい
+    # pointer jumping で各ノードのrootとrootからの深さを求める (再帰なし, O(n log depth))
+    parents = np.asarray(parents, dtype=np.int64)
+    is_root = parents < 0
+    ancestors = np.where(is_root, np.arange(len(parents)), parents)
+    depths = (~is_root).astype(np.int64)
+
+    while True:
+        next_ancestors = ancestors[ancestors]
+        if np.array_equal(next_ancestors, ancestors):
+            return ancestors, depths
+        depths = depths + depths[ancestors]
+        ancestors = next_ancestors
+
+
+def tree_depths(parents):
+    return tree_roots_and_depths(parents)[1]
+
+
+def to_node_link_data(cascade: Cascade):
+    # networkx.node_link_data と同じ形式
+    tweet_ids = cascade.tweet_ids.tolist()
+    nodes = [
+        {"data": {"tweet_id": tweet_id, "user_id": user_id,
+                  "timestamp": timestamp, "is_quote": is_quote},
+         "id": tweet_id}
+        for tweet_id, user_id, timestamp, is_quote in zip(
+            tweet_ids,
+            cascade.user_ids.tolist(),
+            cascade.timestamps.tolist(),
+            cascade.is_quote.tolist())
+    ]
+
+    order = np.lexsort((np.arange(1, len(cascade)), cascade.parents[1:]))
+    links = [
+        {"source": tweet_ids[parent], "target": tweet_ids[child]}
+        for parent, child in zip(cascade.parents[1:][order].tolist(), (order + 1).tolist())
+    ]
+
+    return {
+        "directed": True,
+        "multigraph": False,
+        "graph": {},
+        "nodes": nodes,
+        "links": links,
+    }
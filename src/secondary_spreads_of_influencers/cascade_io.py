@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import json
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cascade_engine import Cascade, to_node_link_data, tree_depths
+
+
+# [File Summary]
+# Read/write helpers for the retweet cascades generated by build_rt_cascades.py.
+# The cascades are saved in one of two formats.
+# ndjson:
+#   One networkx node_link_data graph per line.
+#   With --workers, part files are listed in a manifest (e.g. cascades.manifest.json).
+# parquet:
+#   A directory holding two flat tables.
+#     save_path/edges/part-00000.parquet
+#       source_tweet_id, parent_tweet_id, child_tweet_id,
+#       parent_user, child_user, depth, timestamp (of the child)
+#     save_path/nodes/part-00000.parquet
+#       source_tweet_id, tweet_id, user_id, timestamp, is_quote
+#   The source tweet itself is the node whose tweet_id equals source_tweet_id.
+# Consumers pass the NDJSON file, the manifest or the parquet directory
+# as rt_cascades_path, and load it with scan_rt_cascades,
+# or stream the edges cascade by cascade with iter_edge_batches.
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+EDGE_SCHEMA = {
+    "source_tweet_id": pl.Int64,
+    "parent_tweet_id": pl.Int64,
+    "child_tweet_id": pl.Int64,
+    "parent_user": pl.Int64,
+    "child_user": pl.Int64,
+    "depth": pl.Int64,
+    "timestamp": pl.Int64,
+}
+
+NODE_SCHEMA = {
+    "source_tweet_id": pl.Int64,
+    "tweet_id": pl.Int64,
+    "user_id": pl.Int64,
+    "timestamp": pl.Int64,
+    "is_quote": pl.Boolean,
+}
+
+
+# NDJSON (node_link_data) のカスケードを読んだときのスキーマ
+CASCADE_SCHEMA = {
+    "source_tweet_id": pl.Int64,
+    "graph": pl.Struct({
+        "directed": pl.Boolean,
+        "multigraph": pl.Boolean,
+        "nodes": pl.List(pl.Struct({
+            "data": pl.Struct({k: NODE_SCHEMA[k] for k in ["tweet_id", "user_id", "timestamp", "is_quote"]}),
+            "id": pl.Int64,
+        })),
+        "links": pl.List(pl.Struct({"source": pl.Int64, "target": pl.Int64})),
+    }),
+}
+
+
+def arrow_schema(schema):
+    # ParquetCascadeWriter はforkしたworkerで使うので、polarsを通さずにarrowの表を作る
+    types = {pl.Int64: pa.int64(), pl.Boolean: pa.bool_()}
+    return pa.schema([(name, types[dtype]) for name, dtype in schema.items()])
+
+
+def part_path(save_path, part_idx):
+    root, ext = os.path.splitext(save_path)
+    return f"{root}.part-{part_idx:05d}{ext}"
+
+
+def table_part_path(save_dir, table, part_idx):
+    return os.path.join(save_dir, table, f"part-{part_idx:05d}.parquet")
+
+
+def manifest_path(save_path):
+    root, _ = os.path.splitext(save_path.rstrip("/"))
+    return root + MANIFEST_SUFFIX
+
+
+def write_manifest(save_path, part_paths, num_cascades, format="ndjson", node_part_paths=None):
+    path = manifest_path(save_path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    manifest = {
+        "format": format,
+        "parts": [os.path.relpath(os.path.abspath(p), base_dir) for p in part_paths],
+        "num_cascades": num_cascades,
+    }
+    if node_part_paths is not None:
+        manifest["node_parts"] = [os.path.relpath(os.path.abspath(p), base_dir)
+                                  for p in node_part_paths]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def read_manifest(path):
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(path)
+    for key in ["parts", "node_parts"]:
+        if key in manifest:
+            manifest[key] = [os.path.join(base_dir, p) for p in manifest[key]]
+    return manifest
+
+
+def read_rt_cascades(path):
+    if path.endswith(MANIFEST_SUFFIX):
+        manifest = read_manifest(path)
+        if manifest["format"] != "ndjson":
+            raise ValueError(f"Not an ndjson manifest: {path}")
+        parts = [p for p in manifest["parts"] if os.path.getsize(p) > 0]
+        if len(parts) == 0:
+            return pl.DataFrame(schema=CASCADE_SCHEMA)
+        return pl.concat([pl.read_ndjson(p) for p in parts], how="vertical_relaxed")
+    if os.path.isdir(path):
+        raise ValueError(f"{path} is a parquet cascade directory. Use scan_rt_cascades instead.")
+    return pl.read_ndjson(path)
+
+
+def node_link_to_tables(df_rt_cascade):
+    # NDJSON (node_link_data) のカスケードを nodes / edges テーブルに変換する
+    data = pl.col("node").struct.field("data")
+    df_nodes = df_rt_cascade.select(
+        pl.col("source_tweet_id").cast(pl.Int64),
+        pl.col("graph").struct.field("nodes").alias("node"),
+    ).explode("node").drop_nulls("node").select(
+        "source_tweet_id",
+        data.struct.field("tweet_id").cast(pl.Int64),
+        data.struct.field("user_id").cast(pl.Int64),
+        data.struct.field("timestamp").cast(pl.Int64),
+        data.struct.field("is_quote").cast(pl.Boolean),
+    ).with_row_index("node_idx")
+
+    link = pl.col("link")
+    df_edges = df_rt_cascade.select(
+        pl.col("source_tweet_id").cast(pl.Int64),
+        pl.col("graph").struct.field("links").alias("link"),
+    ).explode("link").drop_nulls("link").select(
+        "source_tweet_id",
+        link.struct.field("source").cast(pl.Int64).alias("parent_tweet_id"),
+        link.struct.field("target").cast(pl.Int64).alias("child_tweet_id"),
+    )
+
+    df_edges = df_edges.join(
+        df_nodes.select(
+            "source_tweet_id",
+            pl.col("tweet_id").alias("parent_tweet_id"),
+            pl.col("user_id").alias("parent_user"),
+            pl.col("node_idx").alias("parent_idx")),
+        on=["source_tweet_id", "parent_tweet_id"],
+    ).join(
+        df_nodes.select(
+            "source_tweet_id",
+            pl.col("tweet_id").alias("child_tweet_id"),
+            pl.col("user_id").alias("child_user"),
+            "timestamp",
+            pl.col("node_idx").alias("child_idx")),
+        on=["source_tweet_id", "child_tweet_id"],
+    )
+
+    parents = np.full(len(df_nodes), -1, dtype=np.int64)
+    parents[df_edges["child_idx"].to_numpy()] = df_edges["parent_idx"].to_numpy()
+    depths = tree_depths(parents)
+    df_edges = df_edges.with_columns(
+        pl.Series("depth", depths[df_edges["child_idx"].to_numpy()]),
+    ).sort("child_idx").select(list(EDGE_SCHEMA))
+
+    return df_nodes.select(list(NODE_SCHEMA)), df_edges
+
+
+def scan_rt_cascades(path):
+    # (nodes, edges) の LazyFrame を返す。
+    # parquet形式ならfilter/selectはscanまでpushdownされる
+    if os.path.isdir(path):
+        return (pl.scan_parquet(os.path.join(path, "nodes", "*.parquet")),
+                pl.scan_parquet(os.path.join(path, "edges", "*.parquet")))
+
+    if path.endswith(MANIFEST_SUFFIX):
+        manifest = read_manifest(path)
+        if manifest["format"] == "parquet":
+            return pl.scan_parquet(manifest["node_parts"]), pl.scan_parquet(manifest["parts"])
+
+    df_nodes, df_edges = node_link_to_tables(read_rt_cascades(path))
+    return df_nodes.lazy(), df_edges.lazy()
+
+
+def _edge_parts(path):
+    if os.path.isdir(path):
+        return "parquet", sorted(
+            os.path.join(path, "edges", f) for f in os.listdir(os.path.join(path, "edges"))
+            if f.endswith(".parquet"))
+    if path.endswith(MANIFEST_SUFFIX):
+        manifest = read_manifest(path)
+        return manifest["format"], manifest["parts"]
+    return "ndjson", [path]
+
+
+def _iter_ndjson_edges(path, lines_per_batch):
+    with open(path, "rb") as f:
+        while True:
+            lines = [line for _, line in zip(range(lines_per_batch), f)]
+            if len(lines) == 0:
+                return
+            _, df_edges = node_link_to_tables(pl.read_ndjson(io.BytesIO(b"".join(lines))))
+            yield df_edges
+
+
+def iter_edge_batches(path, columns=None, batch_size=1 << 22, lines_per_batch=10000):
+    # edgesテーブルをカスケード単位で区切ったバッチとして順に返す。
+    # 1つのカスケードのedgesは連続して書かれているので、
+    # バッチ末尾のカスケードは次のバッチに持ち越して途中で切れないようにする。
+    # parquetは batch_size 行、NDJSONは lines_per_batch カスケードずつ読む
+    columns = list(EDGE_SCHEMA) if columns is None else list(columns)
+    if "source_tweet_id" not in columns:
+        columns = ["source_tweet_id", *columns]
+
+    format, parts = _edge_parts(path)
+    if format == "ndjson":
+        for part in parts:
+            if os.path.getsize(part) == 0:
+                continue
+            for df_edges in _iter_ndjson_edges(part, lines_per_batch):
+                if len(df_edges) > 0:
+                    yield df_edges.select(columns)
+        return
+
+    carry = None
+    for part in parts:
+        for batch in pq.ParquetFile(part).iter_batches(batch_size=batch_size, columns=columns):
+            df = pl.from_arrow(batch)
+            if carry is not None:
+                df = pl.concat([carry, df])
+            if len(df) == 0:
+                continue
+            is_last = df["source_tweet_id"] == df["source_tweet_id"][-1]
+            carry = df.filter(is_last)
+            if len(carry) < len(df):
+                yield df.filter(~is_last)
+    if carry is not None and len(carry) > 0:
+        yield carry
+
+
+def cascade_columns(source_tweet_id, cascade: Cascade):
+    num_nodes = len(cascade)
+    parents = cascade.parents[1:]
+    nodes = {
+        "source_tweet_id": np.full(num_nodes, source_tweet_id, dtype=np.int64),
+        "tweet_id": cascade.tweet_ids,
+        "user_id": cascade.user_ids,
+        "timestamp": cascade.timestamps,
+        "is_quote": cascade.is_quote,
+    }
+    edges = {
+        "source_tweet_id": np.full(num_nodes - 1, source_tweet_id, dtype=np.int64),
+        "parent_tweet_id": cascade.tweet_ids[parents],
+        "child_tweet_id": cascade.tweet_ids[1:],
+        "parent_user": cascade.user_ids[parents],
+        "child_user": cascade.user_ids[1:],
+        "depth": tree_depths(cascade.parents)[1:],
+        "timestamp": cascade.timestamps[1:],
+    }
+    return nodes, edges
+
+
+class NdjsonCascadeWriter:
+    def __init__(self, path):
+        self.path = path
+        self.paths = (path,)
+        self.f = open(path, "w", encoding="utf-8")
+
+    def write(self, source_tweet_id, cascade):
+        if isinstance(cascade, Cascade):
+            cascade = to_node_link_data(cascade)
+        line = {
+            "source_tweet_id": source_tweet_id,
+            "graph": cascade,
+        }
+        json.dump(line, self.f, ensure_ascii=False)
+        self.f.write("\n")
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParquetCascadeWriter:
+    # カスケードをバッファし、row_group_size 行ごとに row group として書き出す
+    def __init__(self, save_dir, part_idx=0, row_group_size=1 << 20):
+        self.nodes_path = table_part_path(save_dir, "nodes", part_idx)
+        self.edges_path = table_part_path(save_dir, "edges", part_idx)
+        self.paths = (self.edges_path, self.nodes_path)
+        os.makedirs(os.path.dirname(self.nodes_path), exist_ok=True)
+        os.makedirs(os.path.dirname(self.edges_path), exist_ok=True)
+
+        self.row_group_size = row_group_size
+        self.node_schema = arrow_schema(NODE_SCHEMA)
+        self.edge_schema = arrow_schema(EDGE_SCHEMA)
+        self.node_writer = pq.ParquetWriter(self.nodes_path, self.node_schema, compression="zstd")
+        self.edge_writer = pq.ParquetWriter(self.edges_path, self.edge_schema, compression="zstd")
+        self.node_buffer, self.edge_buffer = [], []
+        self.num_buffered = 0
+
+    def write(self, source_tweet_id, cascade: Cascade):
+        if not isinstance(cascade, Cascade):
+            raise ValueError("parquet format requires the csr engine")
+        nodes, edges = cascade_columns(source_tweet_id, cascade)
+        self.node_buffer.append(nodes)
+        self.edge_buffer.append(edges)
+        self.num_buffered += len(cascade)
+        if self.num_buffered >= self.row_group_size:
+            self.flush()
+
+    def _write_buffer(self, writer, buffer, schema):
+        writer.write_table(pa.table({
+            field.name: pa.array(np.concatenate([columns[field.name] for columns in buffer]), type=field.type)
+            for field in schema
+        }, schema=schema))
+
+    def flush(self):
+        if self.num_buffered == 0:
+            return
+        self._write_buffer(self.node_writer, self.node_buffer, self.node_schema)
+        self._write_buffer(self.edge_writer, self.edge_buffer, self.edge_schema)
+        self.node_buffer, self.edge_buffer = [], []
+        self.num_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.node_writer.close()
+        self.edge_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
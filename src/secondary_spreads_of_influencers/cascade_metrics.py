@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import polars as pl
+from cascade_engine import tree_roots_and_depths
+
+
+# [File Summary]
+# Batch structural virality over the cascade edge tables (see cascade_io.py).
+# v(T) = 1 / (|V| * (|V| - 1)) * sum_{u in V} ( sum_{v in V} (d(u, v)) )
+# For a tree, sum_{u, v} d(u, v) / 2 (the Wiener index) equals
+#   sum_{v in V} s(v) * (n - s(v)) = n * sum s(v) - sum s(v)^2
+# where s(v) is the subtree size of v and n = |V|.
+# Subtree sizes are accumulated level by level from the deepest nodes with np.add.at,
+# so every cascade in the batch is processed at once and no recursion is needed.
+#
+# The original subtree_moments implementation added 1 to sum s(v) and sum s(v)^2
+# for every internal node, which gives v(T) + 2 * (number of internal nodes) / n.
+# legacy_sv=True reproduces those values.
+
+
+def subtree_sizes(parents, depths):
+    sizes = np.ones(len(parents), dtype=np.int64)
+    order = np.argsort(depths, kind="stable")[::-1]
+    level_ends = np.cumsum(np.bincount(depths)[::-1])
+
+    start = 0
+    for end in level_ends[:-1]:  # depth 0 (roots) has no parent
+        idx = order[start:end]
+        np.add.at(sizes, parents[idx], sizes[idx])
+        start = end
+    return sizes
+
+
+def forest_moments(parents):
+    # 各rootについて num_nodes, max_depth, sum s(v), sum s(v)^2, 内部ノード数を求める
+    parents = np.asarray(parents, dtype=np.int64)
+    roots, depths = tree_roots_and_depths(parents)
+    sizes = subtree_sizes(parents, depths)
+
+    root_nodes = np.flatnonzero(parents < 0)
+    tree_of_root = np.zeros(len(parents), dtype=np.int64)
+    tree_of_root[root_nodes] = np.arange(len(root_nodes))
+    trees = tree_of_root[roots]
+    num_trees = len(root_nodes)
+
+    has_child = np.zeros(len(parents), dtype=np.int64)
+    has_child[parents[parents >= 0]] = 1
+
+    max_depth = np.zeros(num_trees, dtype=np.int64)
+    np.maximum.at(max_depth, trees, depths)
+    sum_sizes = np.zeros(num_trees, dtype=np.int64)
+    np.add.at(sum_sizes, trees, sizes)
+    sum_sizes_sqr = np.zeros(num_trees, dtype=np.int64)
+    np.add.at(sum_sizes_sqr, trees, sizes * sizes)
+    num_internal = np.zeros(num_trees, dtype=np.int64)
+    np.add.at(num_internal, trees, has_child)
+
+    return {
+        "root": root_nodes,
+        "num_nodes": np.bincount(trees, minlength=num_trees).astype(np.int64),
+        "max_depth": max_depth,
+        "sum_sizes": sum_sizes,
+        "sum_sizes_sqr": sum_sizes_sqr,
+        "num_internal": num_internal,
+    }
+
+
+def structural_virality(num_nodes, sum_sizes, sum_sizes_sqr, num_internal=None):
+    n = num_nodes.astype(np.float64)
+    wiener_index = num_nodes * sum_sizes - sum_sizes_sqr
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sv = 2 * wiener_index / (n * (n - 1))
+        if num_internal is not None:
+            sv = sv + 2 * num_internal / n
+    return wiener_index, np.where(num_nodes > 1, sv, 0.0)
+
+
+def forest_metrics(df_nodes, by=("source_tweet_id",), legacy_sv=True):
+    # df_nodes: by, tweet_id, parent_tweet_id (rootはnull)
+    # rootごとに1行: by, tweet_id (root), num_nodes, max_depth,
+    #   sum_sizes, sum_sizes_sqr, wiener_index, structural_virality
+    by = list(by)
+    df = df_nodes.select(*by, "tweet_id", "parent_tweet_id").with_row_index("node_idx")
+    df = df.join(
+        df.select(*by,
+                  pl.col("tweet_id").alias("parent_tweet_id"),
+                  pl.col("node_idx").alias("parent_idx")),
+        on=[*by, "parent_tweet_id"],
+        how="left",
+    ).sort("node_idx")
+
+    parents = df["parent_idx"].fill_null(-1).cast(pl.Int64).to_numpy()
+    moments = forest_moments(parents)
+    wiener_index, sv = structural_virality(
+        moments["num_nodes"],
+        moments["sum_sizes"],
+        moments["sum_sizes_sqr"],
+        moments["num_internal"] if legacy_sv else None,
+    )
+
+    return df[moments["root"]].select(*by, "tweet_id").with_columns(
+        pl.Series("num_nodes", moments["num_nodes"]),
+        pl.Series("max_depth", moments["max_depth"]),
+        pl.Series("sum_sizes", moments["sum_sizes"]),
+        pl.Series("sum_sizes_sqr", moments["sum_sizes_sqr"]),
+        pl.Series("wiener_index", wiener_index),
+        pl.Series("structural_virality", sv),
+    )
+
+
+def cascade_metrics(df_edges, legacy_sv=True):
+    # edgesテーブル (複数カスケード) から、カスケードごとの指標を求める
+    if not isinstance(df_edges, pl.DataFrame):
+        df_edges = pl.from_arrow(df_edges)
+
+    df_roots = df_edges.select("source_tweet_id").unique(maintain_order=True).select(
+        "source_tweet_id",
+        pl.col("source_tweet_id").alias("tweet_id"),
+        pl.lit(None, dtype=pl.Int64).alias("parent_tweet_id"),
+    )
+    df_nodes = pl.concat([
+        df_roots,
+        df_edges.select(
+            "source_tweet_id",
+            pl.col("child_tweet_id").alias("tweet_id"),
+            pl.col("parent_tweet_id").cast(pl.Int64),
+        ),
+    ])
+    return forest_metrics(df_nodes, legacy_sv=legacy_sv).drop("tweet_id")
+
+
+def first_reposter_metrics(df_edges, legacy_sv=True):
+    # sourceを除いた部分木 (sourceを直接RTした first reposter をrootとする) ごとの指標
+    if not isinstance(df_edges, pl.DataFrame):
+        df_edges = pl.from_arrow(df_edges)
+
+    df_nodes = df_edges.select(
+        "source_tweet_id",
+        pl.col("child_tweet_id").alias("tweet_id"),
+        pl.when(pl.col("parent_tweet_id") == pl.col("source_tweet_id"))
+        .then(None)
+        .otherwise(pl.col("parent_tweet_id"))
+        .cast(pl.Int64)
+        .alias("parent_tweet_id"),
+    )
+    return forest_metrics(df_nodes, legacy_sv=legacy_sv)
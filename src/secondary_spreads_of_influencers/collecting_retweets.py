@@ -1,10 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
-import os
-import json
-from tqdm import tqdm
 import polars as pl
+from ingest_retweets import ingest_directory, scan_ingested_retweets
 
 
 arg_parser = argparse.ArgumentParser()
@@ -13,6 +11,10 @@ arg_parser.add_argument("--retweet_ym", type=str, required=True)
 arg_parser.add_argument("--retweets_dir", type=str, required=True)
 arg_parser.add_argument("--qt", action="store_true")
 arg_parser.add_argument("--rt", action="store_true")
+arg_parser.add_argument("--ingest_dir", type=str, default=None)
+arg_parser.add_argument("--workers", type=int, default=1)
+arg_parser.add_argument("--num_buckets", type=int, default=64)
+arg_parser.add_argument("--format", type=str, default="jsonl", choices=["jsonl", "parquet"])
 
 
 # [File Summary]
@@ -25,59 +27,53 @@ arg_parser.add_argument("--rt", action="store_true")
 #   If True, the quoted tweets are extracted.
 # retweet_ym:
 #   Year and month of the retweets.
+# ingest_dir:
+#   Directory of the deduplicated parquet dataset built by ingest_retweets.py.
+#   It is built here if missing or older than the .gz files, and reused by
+#   collecting_retweets.py and extract_rt_timestamps.py. If not set, a temporary directory is used.
+# workers, num_buckets:
+#   Passed to ingest_retweets.py when the dataset is built.
+# format:
+#   "jsonl" saves one source tweet per line (save_path/YYYY-MM_retweets.jsonl).
+#   "parquet" saves the same columns with list columns
+#   (save_path/YYYY-MM_retweets.parquet), which build_rt_cascades.py reads directly.
 # [Inputs]
 # retweets_dir:
 #   X (Twitter) API's retweets saved directory.
 # [Outputs]
 # save_path:
-#   Path to save the retweets with timestamps.
+#   Directory to save the retweets grouped by the source tweet.
+#   Columns: source_tweet_id, source_user_id, source_timestamp, retweets,
+#   retweeted_user_ids, retweet_timestamps, cascade_size
+
+
+def aggregate_cascades(df_rt):
+    # source tweetごとにRTをリスト列にまとめる (リスト内はRTの読み込み順)
+    return df_rt.group_by("source_tweet_id").agg(
+        pl.col("source_user_id").first(),
+        pl.col("source_timestamp").first(),
+        pl.col("tweet_id").alias("retweets"),
+        pl.col("user_id").alias("retweeted_user_ids"),
+        pl.col("timestamp").alias("retweet_timestamps"),
+        pl.len().alias("cascade_size"),
+    )
 
 
 def main(args):
     if not args.rt and not args.qt:
         raise ValueError("Either --rt or --qt must be set")
 
-    retweet_files = []
-    for retweet_file in os.listdir(f"{args.retweets_dir}/{args.retweet_ym}"):
-        if retweet_file.endswith('.gz'):
-            if (args.rt and "rt_" in retweet_file) or (args.qt and "qt_" in retweet_file):
-                retweet_files.append(f"{args.retweet_ym}/{retweet_file}")
-
-    df_rt = []
-
-    for retweet_file in tqdm(retweet_files):
-        df = pl.read_csv(f"{args.retweets_dir}/{retweet_file}", has_header=False, separator='\t')
-        df_rt.append(df)
-
-    df_rt = pl.concat(df_rt)
-
-    df_rt.columns = [
-        "tweet_id",
-        "user_id",
-        "user_screen_name",
-        "timestamp",
-        "source_tweet_id",
-        "source_user_id",
-        "source_user_screen_name",
-        "source_timestamp",
-    ]
-
-    df_rt = df_rt.unique(subset=["tweet_id", "source_tweet_id"])
-
-    with open(f"{args.save_path}/{args.retweet_ym}_retweets.jsonl", "w") as f:
-        for source_tweet_id, df_rt_k in df_rt.group_by("source_tweet_id"):
-            retweet_data = {
-                "source_tweet_id": source_tweet_id,
-                "source_user_id": df_rt_k["source_user_id"].to_list()[0],
-                "source_timestamp": df_rt_k["source_timestamp"].to_list()[0],
-                "retweets": df_rt_k["tweet_id"].to_list(),
-                "retweeted_user_ids": df_rt_k["user_id"].to_list(),
-                "retweet_timestamps": df_rt_k["timestamp"].to_list(),
-                "cascade_size": len(df_rt_k),
-            }
-
-            f.write(json.dumps(retweet_data, ensure_ascii=False))
-            f.write("\n")
+    with ingest_directory(args.ingest_dir) as ingest_dir:
+        lf_rt = scan_ingested_retweets(
+            args.retweets_dir, args.retweet_ym, ingest_dir, rt=args.rt, qt=args.qt,
+            workers=args.workers, num_buckets=args.num_buckets,
+        )
+        df_cascades = aggregate_cascades(lf_rt).collect()
+
+    if args.format == "parquet":
+        df_cascades.write_parquet(f"{args.save_path}/{args.retweet_ym}_retweets.parquet")
+    else:
+        df_cascades.write_ndjson(f"{args.save_path}/{args.retweet_ym}_retweets.jsonl")
 
 
 if __name__ == "__main__":
@@ -2,16 +2,14 @@
 
 
 import argparse
-import polars as pl
 from time import time
-import networkx as nx
-import pickle
+from retweet_graph import CENTRALITIES, centrality_frame, load_retweet_graph
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--saved_graph_path", type=str, required=True)
 arg_parser.add_argument("--save_path", type=str, required=True)
-arg_parser.add_argument("--algorithm", type=str, default="degree")
+arg_parser.add_argument("--algorithm", type=str, default="degree", choices=CENTRALITIES)
 arg_parser.add_argument("--follower_relations_path", type=str, default=None)
 
 
@@ -19,11 +17,17 @@ arg_parser.add_argument("--follower_relations_path", type=str, default=None)
 # This script computes the centrality of the users.
 # [Configs]
 # algorithm:
-#   The algorithm to compute the centrality.
+#   The algorithm to compute the centrality (see retweet_graph.py).
+#   "degree": weighted in-degree (number of retweets received).
+#   "out_degree": weighted out-degree (number of retweets made).
+#   "pagerank": PageRank. "hits": hub and authority scores.
+#   "eigenvector": eigenvector centrality.
+#   All of them run on the scipy CSR matrix of the graph.
 # [Inputs]
 # saved_graph_path:
 #   Path to the saved graph.
-#   The graph is generated by rt_path_clustering.py.
+#   The graph is generated by rt_path_clustering.py, either the .npz of
+#   --csr_graph_save_path or the networkx pickle of --graph_save_path.
 # follower_relations_path:
 #   Path to the follower relations.
 # [Outputs]
@@ -34,28 +38,11 @@ arg_parser.add_argument("--follower_relations_path", type=str, default=None)
 def main(args):
     t0 = time()
     print("Loading Graph...")
-    G = pickle.load(open(args.saved_graph_path, "rb"))
-    G = G.to_directed()
-
-    user_ids = G.nodes
+    user_ids, A = load_retweet_graph(args.saved_graph_path)
     print("Number of Users: ", len(user_ids))
 
     print("Computing Centrality...")
-    if args.algorithm == "degree":
-        degrees = G.in_degree(weight="weight")
-        pl.DataFrame(
-            list(degrees),
-            orient="row",
-            schema=["user_id", "degree"],
-        ).write_parquet(args.save_path)
-    elif args.algorithm == "pagerank":
-        pr = nx.pagerank(G, weight="weight")
-        pl.DataFrame(
-            list(pr.items()),
-            orient="row",
-            schema=["user_id", "pagerank"]
-        ).write_parquet(args.save_path)
-
+    centrality_frame(user_ids, A, args.algorithm).write_parquet(args.save_path)
 
     t1 = time()
     print("Time: ", t1 - t0)
@@ -1,22 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
-import os
 import polars as pl
 from polars import col
 from time import time
 import numpy as np
+from retweet_io import scan_retweeted_tweets
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--save_path", type=str, required=True)
 arg_parser.add_argument("--canonicalized_source_tweets_path", type=str, required=True)
 arg_parser.add_argument("--retweeted_tweets_dir", type=str, required=True)
+arg_parser.add_argument("--rt_cache_dir", type=str, default=None)
 arg_parser.add_argument("--follower_relations_path", type=str, default=None)
 
 
 # [File Summary]
 # This script computes the h-index and hg-index of the users.
+# [Configs]
+# rt_cache_dir:
+#   Cache directory of the cleaned retweeted tweets (see retweet_io.py).
 # [Inputs]
 # canonicalized_source_tweets_path:
 #   Path to the canonicalized source tweets.
@@ -38,20 +42,8 @@ def main(args):
     df_source = df_source[["tweet_id", "user_id"]]
 
     print("Loading retweeted tweets...")
-    retweeted_tweets_files = os.listdir(args.retweeted_tweets_dir)
-    retweeted_tweets_paths = [os.path.join(args.retweeted_tweets_dir, f)
-                              for f in retweeted_tweets_files]
-
-    df_list = []
-    for i, path in enumerate(retweeted_tweets_paths):
-        df_rt = pl.read_parquet(path)
-        df_list.append(df_rt)
-    df_rt = pl.concat(df_list)
-    del df_list
-
-    df_rt = df_rt.filter(df_rt["user_id"].is_not_null())
-    df_rt = df_rt[["source_tweet_id", "user_id", "tweet_id"]]
-    df_rt = df_rt.filter(df_rt["source_tweet_id"].is_not_null())
+    df_rt = scan_retweeted_tweets(
+        args.retweeted_tweets_dir, cache_dir=args.rt_cache_dir).collect()
 
     if args.follower_relations_path:
         df_follower_relations = pl.read_parquet(args.follower_relations_path)
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
-import os
 import polars as pl
+from retweet_io import scan_retweeted_tweets
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--canonicalized_source_tweets_path", type=str, required=True)
 arg_parser.add_argument("--retweeted_tweets_dir", type=str, required=True)
+arg_parser.add_argument("--rt_cache_dir", type=str, default=None)
 arg_parser.add_argument("--user_influence_score_path", type=str, required=True)
 arg_parser.add_argument("--influence_column_name", type=str, default="h-index")
 
@@ -17,6 +18,8 @@ arg_parser.add_argument("--influence_column_name", type=str, default="h-index")
 # [Configs]
 # influence_column_name:
 #   The column name of the influence score.
+# rt_cache_dir:
+#   Cache directory of the cleaned retweeted tweets (see retweet_io.py).
 # [Inputs]
 # canonicalized_source_tweets_path:
 #   Path to the canonicalized source tweets.
@@ -31,19 +34,8 @@ arg_parser.add_argument("--influence_column_name", type=str, default="h-index")
 
 def main(args):
     print("Loading retweeted tweets...")
-    retweeted_tweets_files = os.listdir(args.retweeted_tweets_dir)
-    retweeted_tweets_paths = [os.path.join(args.retweeted_tweets_dir, f)
-                              for f in retweeted_tweets_files]
-
-    df_list = []
-    for i, path in enumerate(retweeted_tweets_paths):
-        df_rt = pl.read_parquet(path)
-        df_list.append(df_rt)
-    df_rt = pl.concat(df_list)
-    del df_list
-    df_rt = df_rt.filter(pl.col("user_id").is_not_null())
-    df_rt = df_rt[["source_tweet_id", "user_id", "tweet_id"]]
-    df_rt = df_rt.filter(pl.col("source_tweet_id").is_not_null())
+    df_rt = scan_retweeted_tweets(
+        args.retweeted_tweets_dir, cache_dir=args.rt_cache_dir).collect()
 
     df_rt = df_rt.group_by("source_tweet_id").agg(
         pl.col("user_id").n_unique().alias("num_retweets")
@@ -1,39 +1,66 @@
 #!/usr/bin/env python3
 
-import argparse
 import os
+import math
+import argparse
 import polars as pl
+from tqdm import tqdm
+from retweet_io import scan_retweeted_tweets
+from follower_graph import (
+    SECONDS_PER_DAY,
+    FollowerGraph,
+    date_bounds,
+    is_follow_store,
+    open_ended_dates,
+    valid_at,
+)
 
 
 arg_parser = argparse.ArgumentParser()
-arg_parser.add_argument("--n", type=int, required=True)
-arg_parser.add_argument("--offset", type=int, required=True)
+arg_parser.add_argument("--memory_budget_gb", type=float, default=8)
+arg_parser.add_argument("--num_buckets", type=int, default=0)
 arg_parser.add_argument("--userinfo_path", type=str, required=True)
 arg_parser.add_argument("--retweeted_tweets_dir", type=str, required=True)
+arg_parser.add_argument("--rt_cache_dir", type=str, default=None)
 arg_parser.add_argument("--exclude_qt", action="store_true")
 arg_parser.add_argument("--qt_ids_path", type=str, required=False)
 arg_parser.add_argument("--exploded_rt_cascades_path", type=str, required=True)
 arg_parser.add_argument("--follower_relations_path", type=str, required=True)
 arg_parser.add_argument("--rt_timestamps_path", type=str, required=False)
 arg_parser.add_argument("--filter_by_timestamps", action="store_true")
+arg_parser.add_argument("--as_of", action="store_true")
 arg_parser.add_argument("--save_dir", type=str, required=True)
 
 
+GB = 1024 ** 3
+ROW_BYTES = 256  # joinの中間結果を含めた出力1行あたりのおおよそのバイト数
+
+
 # [File Summary]
 # This script computes the second spreaders.
 # [Configs]
-# n:
-#   Number of second spreaders to compute.
-#   The number of rows is Num of Second Spraders * Num of spreaders' followers.
-#   In other words, it consumes a huge amount of memory, so to avoid this,
-#   the number of users to be calculated is controlled.
-# offset:
-#   The offset of the user to be calculated.
-#   If n=1000 and offset=1000, the 1000th to 2000th users are calculated.
+# memory_budget_gb:
+#   The number of rows is Num of Second Spraders * Num of spreaders' followers,
+#   which consumes a huge amount of memory.
+#   The follower relations are split into buckets by the hash of the followee
+#   so that the join of each bucket fits in this budget, and the buckets are processed
+#   one by one with the polars streaming engine.
+#   The size of the join is estimated as ROW_BYTES per output row, which is a rough guess.
+#   The retweets and the exploded cascades are scanned per bucket, keeping only the
+#   source tweets retweeted by the bucket's followees. These tables are not counted
+#   in the budget, so the peak memory can exceed it when a bucket covers many source tweets.
+# num_buckets:
+#   Number of followee hash buckets. If 0, it is estimated from memory_budget_gb.
 # exclude_qt:
 #   If True, exclude quoted tweets from the analysis.
 # filter_by_timestamps:
 #   If True, filter the follower relations by timestamps.
+# as_of:
+#   If True, a follower only sees the retweets of the followee made while
+#   the follow relation existed (first_seen <= day of the retweet <= last_seen).
+#   Requires rt_timestamps_path and follower relations built with dates.
+# rt_cache_dir:
+#   Cache directory of the cleaned retweeted tweets (see retweet_io.py).
 # [Inputs]
 # userinfo_path:
 #   Path to the user bio information file.
@@ -49,44 +76,26 @@ arg_parser.add_argument("--save_dir", type=str, required=True)
 # follower_relations_path:
 #   Path to the follower relations.
 #   This file is generated by build_follower_relations_data.py.
+#   The store directory (build_follower_relations_data.py --store_dir) can be given instead.
+#   Then only the followers of the target followees are read from the memory-mapped graph.
 # rt_timestamps_path:
 #   Path to the retweet timestamps.
 #   Ths file is generated by extract_rt_timestamps.py.
 # [Outputs]
 # save_dir:
 #   Directory to save the computed second spreaders.
+#   One file per bucket: bucket-00000-of-00016.parquet, ...
 
 
-def main(args):
-    print("Loading User Information...")
-
-    df_userinfo = pl.read_parquet(args.userinfo_path)
-    user_ids = df_userinfo["user_id"].sort(descending=True).to_list()
-    print(f"Number of Users: {len(user_ids)}")
-    target_user_ids = user_ids[args.offset: args.offset + args.n]
-    print(f"Number of Target Users: {len(target_user_ids)}")
-
-    df_pc_nodes = pl.read_parquet(args.exploded_rt_cascades_path)
-
-    print("Loading retweeted tweets...")
-    retweeted_tweets_files = os.listdir(args.retweeted_tweets_dir)
-    retweeted_tweets_paths = [os.path.join(args.retweeted_tweets_dir, f)
-                              for f in retweeted_tweets_files]
-
-    df_list = []
-    for i, path in enumerate(retweeted_tweets_paths):
-        df_rt = pl.read_parquet(path)
-        df_list.append(df_rt)
-    df_rt = pl.concat(df_list)
-    del df_list
-    df_rt = df_rt.filter(df_rt["user_id"].is_not_null())
-    df_rt = df_rt[["source_tweet_id", "user_id", "tweet_id"]]
-    df_rt = df_rt.filter(df_rt["source_tweet_id"].is_not_null())
+def scan_retweets(args, source_tweet_ids=None):
+    # source_tweet_ids (LazyFrame) を指定すると、そのsource tweetのRTだけを読む
+    lf_rt = scan_retweeted_tweets(args.retweeted_tweets_dir, cache_dir=args.rt_cache_dir)
+    if source_tweet_ids is not None:
+        lf_rt = lf_rt.join(source_tweet_ids, on="source_tweet_id", how="semi")
 
     if args.rt_timestamps_path:
-        df_rt_timestamps = pl.read_parquet(args.rt_timestamps_path)
-        df_rt = df_rt.join(
-            df_rt_timestamps,
+        lf_rt = lf_rt.join(
+            pl.scan_parquet(args.rt_timestamps_path),
             left_on="tweet_id",
             right_on="tweet_id",
             how="inner"
@@ -96,110 +105,207 @@ def main(args):
         if not args.qt_ids_path:
             raise ValueError("qt_ids_path is required when exclude_qt is True")
         df_qt_ids = pl.read_parquet(args.qt_ids_path)
-        df_rt = df_rt.filter(~df_rt["source_tweet_id"].is_in(df_qt_ids["tweet_id"]))
+        lf_rt = lf_rt.filter(~pl.col("source_tweet_id").is_in(df_qt_ids["tweet_id"]))
+    return lf_rt
+
+
+def count_retweets(args):
+    # ユーザごとのRT数 (user_id, num_retweets)。RTのテーブル全体は読み込まない
+    return scan_retweets(args).group_by("user_id").agg(
+        pl.len().alias("num_retweets")).collect(streaming=True)
+
+
+def load_followee_retweets(args, followees):
+    # followeesがRTしたsource tweetのRTとカスケードの行だけを読む
+    source_tweet_ids = scan_retweets(args).filter(
+        pl.col("user_id").is_in(followees)
+    ).select("source_tweet_id").unique().collect(streaming=True).lazy()
+    df_rt = scan_retweets(args, source_tweet_ids).collect(streaming=True)
+    df_pc_nodes = pl.scan_parquet(args.exploded_rt_cascades_path).join(
+        source_tweet_ids, on="source_tweet_id", how="semi").collect(streaming=True)
+    return df_rt, df_pc_nodes
+
+
+def follow_date_bounds(follower_relations_path, as_of):
+    # parquetでas_ofのときに使う最初と最後のスナップショットの日付
+    # 全体をscanするので、バケットごとではなく1回だけ求めて scan_follower_relations に渡す
+    if not as_of or is_follow_store(follower_relations_path):
+        return None
+    return date_bounds(pl.scan_parquet(follower_relations_path))
+
+
+def scan_follower_relations(follower_relations_path, retweeted_user_ids, target_user_ids,
+                            followees=None, as_of=False, bounds=None):
+    # retweeted_user_ids: 1回以上RTしたユーザ (df_rt["user_id"].unique())
+    # followees: 対象とするfolloweeをさらに絞り込む場合に指定する
+    # as_of: first_seen, last_seen (期限なしはnull) の列も返す
+    # bounds: follow_date_bounds の値。None ならここで求める
+    if is_follow_store(follower_relations_path):
+        # storeならfolloweeのfollowerスライスだけをmmapから読む
+        if followees is None:
+            followees = retweeted_user_ids.filter(retweeted_user_ids.is_in(target_user_ids))
+        # RTしたことのないfollowerはスライスを取り出すときに落とす
+        graph = FollowerGraph.load(follower_relations_path)
+        lf = graph.follow_relations(
+            followees.cast(pl.Int64).to_numpy(),
+            with_dates=as_of,
+            followers=retweeted_user_ids.cast(pl.Int64).to_numpy(),
+        ).lazy()
+    else:
+        lf = pl.scan_parquet(follower_relations_path)
+        if as_of:
+            if bounds is None:
+                bounds = date_bounds(lf)
+            lf = open_ended_dates(lf, bounds).select(
+                "follower", "followee", "first_seen", "last_seen")
+        else:
+            lf = lf.select("follower", "followee")
+        if followees is not None:
+            lf = lf.filter(pl.col("followee").is_in(followees))
 
-    print("Grouping by user_id...")
-    df_user_retweets = df_rt.group_by("user_id").agg(
-        pl.col("tweet_id"),
-        pl.col("source_tweet_id"),
+    # RTを1回以上しているユーザのみを対象にする
+    # 休眠アカウントやRTをしないアカウントを除外
+    return lf.filter(
+        pl.col("followee").is_in(retweeted_user_ids)
+        & pl.col("follower").is_in(retweeted_user_ids)
+        & pl.col("followee").is_in(target_user_ids)
     )
 
-    print("Loading follower relations...")
-    df_follower_relations = pl.read_parquet(args.follower_relations_path)
 
-    retweeted_user_ids = df_rt["user_id"].unique().to_list()
+def count_followers(follower_relations_path, retweeted_user_ids, target_user_ids):
+    # followeeごとの、RTしたことのあるfollowerの数 (followee, num_followers)
+    if is_follow_store(follower_relations_path):
+        # storeならfollowerのDataFrameを作らずにindptrとfollowerのマスクから数える
+        followees = retweeted_user_ids.filter(retweeted_user_ids.is_in(target_user_ids)).cast(pl.Int64)
+        graph = FollowerGraph.load(follower_relations_path)
+        counts = graph.follower_counts(
+            followees.to_numpy(), followers=retweeted_user_ids.cast(pl.Int64).to_numpy())
+        return pl.DataFrame({
+            "followee": followees,
+            "num_followers": pl.Series(counts, dtype=pl.UInt32),
+        }).filter(pl.col("num_followers") > 0)
+
+    lf_follower_relations = scan_follower_relations(
+        follower_relations_path, retweeted_user_ids, target_user_ids)
+    return lf_follower_relations.group_by("followee").agg(
+        pl.len().alias("num_followers")
+    ).collect(streaming=True)
+
+
+def estimate_num_rows(df_follower_counts, df_retweet_counts):
+    # 出力行数 = sum_{followee} (followerの数 * followeeのRT数)
+    df_counts = df_follower_counts.join(
+        df_retweet_counts,
+        left_on="followee",
+        right_on="user_id",
+    )
+    return int((df_counts["num_followers"] * df_counts["num_retweets"]).sum())
 
-    print(f"Number of retweeted users: {len(retweeted_user_ids)}")
-    print(f"Number of followees: {df_follower_relations['followee'].n_unique()}")
-    print(f"Number of followers: {df_follower_relations['follower'].n_unique()}")
-    print(f"Number of followers: {len(df_follower_relations['follower'].unique())}")
 
-    # RTを1回以上しているユーザのみを対象にする
-    df_follower_relations = df_follower_relations.filter(
-        df_follower_relations["followee"].is_in(retweeted_user_ids))
-    print(f"Number of followees: {df_follower_relations['followee'].n_unique()}")
-    # 休眠アカウントやRTをしないアカウントを除外
-    df_follower_relations = df_follower_relations.filter(
-        df_follower_relations["follower"].is_in(retweeted_user_ids))
-    print(f"Number of followees: {df_follower_relations['followee'].n_unique()}")
-    print(f"Number of followers: {df_follower_relations['follower'].n_unique()}")
-    del retweeted_user_ids
-
-    # カスケードに現れるアカウントのみをfolloweeの対象とする
-    # カスケードに現れないとSecond Spreadの親が存在しないため
-    # parent_ids = df_pc_nodes["parent"].unique().to_list()
-    # child_ids = df_pc_nodes["child"].unique().to_list()
-    # df_follower_relations = df_follower_relations.filter(
-    #     df_follower_relations["followee"].is_in(set(parent_ids + child_ids)))
-
-    df_follower_relations = df_follower_relations.filter(
-        pl.col("followee").is_in(target_user_ids))
-
-    print(f"Number of followees: {df_follower_relations['followee'].n_unique()}")
-    print(f"Number of followers: {df_follower_relations['follower'].n_unique()}")
-
-    print("Joining retweet information...")
-    df_follower_relations = df_follower_relations.join(
-        df_user_retweets, left_on="followee", right_on="user_id", how="inner"
-    )
-    del df_user_retweets
-    print(f"Number of followees: {df_follower_relations['followee'].n_unique()}")
-    print(f"Number of followers: {df_follower_relations['follower'].n_unique()}")
+def bucket_filter(num_buckets, bucket):
+    return pl.col("followee").hash(seed=0) % num_buckets == bucket
+
+
+def bucket_followees(retweeted_user_ids, target_user_ids, num_buckets, bucket):
+    return retweeted_user_ids.alias("followee").to_frame().filter(
+        pl.col("followee").is_in(target_user_ids) & bucket_filter(num_buckets, bucket)
+    )["followee"]
 
-    print("Exploding retweets...")
-    df_follower_relations = df_follower_relations.explode(
-        ["tweet_id", "source_tweet_id"])
 
-    print("Joining parent-child relations...")
+def virtual_timeline(lf_follower_relations, df_rt, df_pc_nodes, filter_by_timestamps=False,
+                     as_of=False):
+    # followee x follower x (followeeのRT) の行を作り、
+    # followerがカスケード上でそのRTから再RTしたかを付与する
+    lf_follower_relations = lf_follower_relations.join(
+        df_rt.lazy().select(pl.col("user_id").alias("followee"), "tweet_id", "source_tweet_id"),
+        on="followee",
+    )
+
     # カスケードでRTされなかったものを補完
     # 正しいパスだけ残すってことはできているだろうか
     # 例えば、あるsource_tweetについて、prentとchildのパスは原則1つだけ
-    df_follower_relations = df_follower_relations.join(
-        df_pc_nodes,
+    lf_follower_relations = lf_follower_relations.join(
+        df_pc_nodes.lazy(),
         left_on=["source_tweet_id", "followee", "follower", "tweet_id"],
         right_on=["source_tweet_id", "parent", "child", "parent_tweet_id"],
         how="left").rename({"tweet_id": "parent_tweet_id"})
-    print(f"Number of followees: {df_follower_relations['followee'].n_unique()}")
-    print(f"Number of followers: {df_follower_relations['follower'].n_unique()}")
 
-    print("Joining tweet information...")
-    rename_dict = {"timestamp": "followee_timestamp"}
-    df_follower_relations = df_follower_relations.join(
-        df_rt,
+    lf_follower_relations = lf_follower_relations.join(
+        df_rt.lazy(),
         left_on=["source_tweet_id", "parent_tweet_id", "followee"],
         right_on=["source_tweet_id", "tweet_id", "user_id"],
-    ).rename(rename_dict)
-    print(f"Number of followees: {df_follower_relations['followee'].n_unique()}")
-    print(f"Number of followers: {df_follower_relations['follower'].n_unique()}")
+    ).rename({"timestamp": "followee_timestamp"})
 
-    df_follower_relations = df_follower_relations.join(
-        df_rt[["source_tweet_id", "tweet_id", "user_id", "timestamp"]],
+    if as_of:
+        # followeeがRTした日に存在したフォロー関係だけを残す
+        lf_follower_relations = lf_follower_relations.filter(
+            valid_at(pl.col("followee_timestamp") // SECONDS_PER_DAY)
+        ).drop("first_seen", "last_seen")
+
+    lf_follower_relations = lf_follower_relations.join(
+        df_rt.lazy().select("source_tweet_id", "tweet_id", "user_id", "timestamp"),
         left_on=["source_tweet_id", "child_tweet_id", "follower"],
         right_on=["source_tweet_id", "tweet_id", "user_id"],
         how="left"
     ).rename({"timestamp": "follower_timestamp"})
-    print(f"Number of followees: {df_follower_relations['followee'].n_unique()}")
-    print(f"Number of followers: {df_follower_relations['follower'].n_unique()}")
-
-    df_follower_relations = df_follower_relations.with_columns(
-        df_follower_relations["child_tweet_id"].is_not_null().alias("is_retweeted"))
-
-    is_in_cascade_tweets = df_pc_nodes["source_tweet_id"].unique().to_list()
-    df_follower_relations = df_follower_relations.with_columns(
-        pl.col("source_tweet_id").is_in(is_in_cascade_tweets).alias("is_in_cascade"))
-
-    if args.filter_by_timestamps:
-        if not args.rt_timestamps_path:
-            raise ValueError("rt_timestamps_path is required when filter_by_timestamps is True")
-        df_follower_relations = df_follower_relations.with_columns(
-            pl.col("follower_timestamp").fill_null(float("inf")))
-        df_follower_relations = df_follower_relations.filter(
-            pl.col("follower_timestamp") > pl.col("followee_timestamp"))
-    print(f"Number of followees: {df_follower_relations['followee'].n_unique()}")
-    print(f"Number of followers: {df_follower_relations['follower'].n_unique()}")
-
-    print("Writing data...")
-    df_follower_relations.write_parquet(f"{args.save_dir}/{args.offset}_to_{args.offset + args.n}.parquet")
+
+    is_in_cascade_tweets = df_pc_nodes["source_tweet_id"].unique()
+    lf_follower_relations = lf_follower_relations.with_columns(
+        pl.col("child_tweet_id").is_not_null().alias("is_retweeted"),
+        pl.col("source_tweet_id").is_in(is_in_cascade_tweets).alias("is_in_cascade"),
+    )
+
+    if filter_by_timestamps:
+        lf_follower_relations = lf_follower_relations.with_columns(
+            pl.col("follower_timestamp").fill_null(float("inf"))
+        ).filter(pl.col("follower_timestamp") > pl.col("followee_timestamp"))
+    return lf_follower_relations
+
+
+def bucket_path(save_dir, bucket, num_buckets):
+    return os.path.join(save_dir, f"bucket-{bucket:05d}-of-{num_buckets:05d}.parquet")
+
+
+def main(args):
+    if args.filter_by_timestamps and not args.rt_timestamps_path:
+        raise ValueError("rt_timestamps_path is required when filter_by_timestamps is True")
+    if args.as_of and not args.rt_timestamps_path:
+        raise ValueError("rt_timestamps_path is required when as_of is True")
+
+    print("Loading User Information...")
+    target_user_ids = pl.read_parquet(args.userinfo_path, columns=["user_id"])["user_id"].unique()
+    print(f"Number of Users: {len(target_user_ids)}")
+
+    print("Counting retweets...")
+    df_retweet_counts = count_retweets(args)
+    retweeted_user_ids = df_retweet_counts["user_id"]
+
+    num_buckets = args.num_buckets
+    if num_buckets <= 0:
+        print("Estimating the number of rows...")
+        df_follower_counts = count_followers(
+            args.follower_relations_path, retweeted_user_ids, target_user_ids)
+        num_rows = estimate_num_rows(df_follower_counts, df_retweet_counts)
+        num_buckets = max(1, math.ceil(num_rows * ROW_BYTES / (args.memory_budget_gb * GB)))
+        print(f"Estimated rows: {num_rows}")
+    print(f"Number of buckets: {num_buckets}")
+
+    bounds = follow_date_bounds(args.follower_relations_path, args.as_of)
+    os.makedirs(args.save_dir, exist_ok=True)
+    for bucket in tqdm(range(num_buckets)):
+        followees = bucket_followees(retweeted_user_ids, target_user_ids, num_buckets, bucket)
+        df_rt, df_pc_nodes = load_followee_retweets(args, followees)
+        lf_bucket = scan_follower_relations(
+            args.follower_relations_path, retweeted_user_ids, target_user_ids,
+            followees=followees, as_of=args.as_of, bounds=bounds)
+        lf = virtual_timeline(
+            lf_bucket,
+            df_rt,
+            df_pc_nodes,
+            filter_by_timestamps=args.filter_by_timestamps,
+            as_of=args.as_of,
+        )
+        lf.sink_parquet(bucket_path(args.save_dir, bucket, num_buckets))
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import os
 import argparse
 import polars as pl
 import matplotlib as mpl
@@ -9,10 +8,12 @@ mpl.rc("webagg", port=8899, port_retries=10, open_in_browser=False)
 import matplotlib.pyplot as plt
 import seaborn as sns
 import scienceplots
+from retweet_io import scan_retweeted_tweets
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--retweeted_tweets_dir", type=str, required=True)
+arg_parser.add_argument("--rt_cache_dir", type=str, default=None)
 arg_parser.add_argument("--aggregated_second_sperads", type=str, required=True)
 arg_parser.add_argument("--user_influence_score_path", type=str, required=True)
 arg_parser.add_argument("--influence_column_name", type=str, default="hg-index")
@@ -33,6 +34,8 @@ arg_parser.add_argument("--min_rt", type=int, default=0)
 #   If True, exclude the official accounts from the analysis.
 # min_rt:
 #   The minimum number of retweets to be considered.
+# rt_cache_dir:
+#   Cache directory of the cleaned retweeted tweets (see retweet_io.py).
 # [Inputs]
 # retweeted_tweets_dir:
 #   Directory path where the retweeted tweets are stored.
@@ -46,19 +49,8 @@ arg_parser.add_argument("--min_rt", type=int, default=0)
 
 def main(args):
     print("Loading retweeted tweets...")
-    retweeted_tweets_files = os.listdir(args.retweeted_tweets_dir)
-    retweeted_tweets_paths = [os.path.join(args.retweeted_tweets_dir, f)
-                              for f in retweeted_tweets_files]
-
-    df_list = []
-    for i, path in enumerate(retweeted_tweets_paths):
-        df_rt = pl.read_parquet(path)
-        df_list.append(df_rt)
-    df_rt = pl.concat(df_list)
-    del df_list
-    df_rt = df_rt.filter(df_rt["user_id"].is_not_null())
-    df_rt = df_rt[["source_tweet_id", "user_id", "tweet_id"]]
-    df_rt = df_rt.filter(df_rt["source_tweet_id"].is_not_null())
+    df_rt = scan_retweeted_tweets(
+        args.retweeted_tweets_dir, cache_dir=args.rt_cache_dir).collect()
     df_rt = df_rt.group_by("source_tweet_id").agg(
         pl.col("user_id").n_unique().alias("num_retweets")
     )
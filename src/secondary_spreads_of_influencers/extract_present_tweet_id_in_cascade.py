@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
-import os
 import argparse
 import polars as pl
+from cascade_io import scan_rt_cascades
+from retweet_io import scan_retweeted_tweets
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--retweeted_tweets_dir", type=str, required=True)
+arg_parser.add_argument("--rt_cache_dir", type=str, default=None)
 arg_parser.add_argument("--rt_cascades_path", type=str, required=True)
 arg_parser.add_argument("--save_presence_tweet_ids_path", type=str, required=True)
 arg_parser.add_argument("--save_cover_rate_path", type=str, required=True)
@@ -14,11 +16,13 @@ arg_parser.add_argument("--save_cover_rate_path", type=str, required=True)
 
 # [File Summary]
 # This script extracts the tweet ids that are present in the retweet cascades.
+# [Configs]
+# rt_cache_dir:
+#   Cache directory of the cleaned retweeted tweets (see retweet_io.py).
 # [Inputs]
 # rt_cascades_path:
 #    Path to the retweet cascades.
-#    The retweet cascades are saved in the ndjson format.
-#    This file is outputed by build_rt_cascades.py.
+#    NDJSON, manifest or parquet directory generated by build_rt_cascades.py.
 # retweeted_tweets_dir:
 #   Directory path where the retweeted tweets are stored.
 #   This files outputed by format_retweeted_data.py.
@@ -31,30 +35,14 @@ arg_parser.add_argument("--save_cover_rate_path", type=str, required=True)
 
 def main(args):
     print("Loading retweet cascades...")
-    df_rt_cascade = pl.read_ndjson(args.rt_cascades_path)
-    df_rt_cascade = df_rt_cascade.with_columns(
-        pl.col("graph").struct[3].list.len().alias("num_nodes"),
-        pl.col("graph").struct[3].alias("data"),
-    ).drop("graph")
-    df_nodes = df_rt_cascade.explode("data")
-    df_nodes = df_nodes.with_columns(
-        pl.col("data").struct[1].alias("tweet_id")).drop("data")
-    df_rt_cascade = df_rt_cascade.drop("data")
+    lf_nodes, _ = scan_rt_cascades(args.rt_cascades_path)
+    df_nodes = lf_nodes.select("source_tweet_id", "tweet_id").with_columns(
+        pl.len().over("source_tweet_id").alias("num_nodes")
+    ).collect()
 
     print("Loading retweeted tweets...")
-    retweeted_tweets_files = os.listdir(args.retweeted_tweets_dir)
-    retweeted_tweets_paths = [os.path.join(args.retweeted_tweets_dir, f)
-                              for f in retweeted_tweets_files]
-
-    df_list = []
-    for i, path in enumerate(retweeted_tweets_paths):
-        df_rt = pl.read_parquet(path)
-        df_list.append(df_rt)
-    df_rt = pl.concat(df_list)
-    del df_list
-    df_rt = df_rt.filter(df_rt["user_id"].is_not_null())
-    df_rt = df_rt[["source_tweet_id", "user_id", "tweet_id"]]
-    df_rt = df_rt.filter(df_rt["source_tweet_id"].is_not_null())
+    df_rt = scan_retweeted_tweets(
+        args.retweeted_tweets_dir, cache_dir=args.rt_cache_dir).collect()
 
     df_rt = df_rt.join(
         df_nodes, on=["source_tweet_id", "tweet_id"], how="left")
@@ -62,9 +50,9 @@ def main(args):
     # nullでないtweet_idを持つ行を保存 = present ids
     df_rt.filter(
         ~pl.col("num_nodes").is_null()
-    )[["tweet_id"]].write_parquet(args.save_path)
+    )[["tweet_id"]].write_parquet(args.save_presence_tweet_ids_path)
 
-    df_rt.groupby("source_tweet_id").agg(
+    df_rt.group_by("source_tweet_id").agg(
         pl.len().alias("num_retweets"),
         (~pl.col("num_nodes").is_null()).sum().alias("num_nodes"),
     ).with_columns(
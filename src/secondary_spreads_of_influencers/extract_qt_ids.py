@@ -4,12 +4,17 @@ import os
 import argparse
 import polars as pl
 from tqdm import tqdm
+from json_extract import BACKENDS, extract_fields
+from format_retweet_data import read_hour
+from pipeline_utils import spawn_pool, write_atomic
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--retweets_dir", type=str, required=True)
 arg_parser.add_argument("--save_path", type=str, required=True)
 arg_parser.add_argument("--only_qt_ids", action="store_true")
+arg_parser.add_argument("--workers", type=int, default=1)
+arg_parser.add_argument("--json_backend", type=str, default="polars", choices=BACKENDS)
 
 
 # [File Summary]
@@ -18,6 +23,12 @@ arg_parser.add_argument("--only_qt_ids", action="store_true")
 # only_qt_ids:
 #   If True, only the quoted tweet ids are extracted.
 #   If False, the full text of the quoted tweets are extracted.
+#   Each hourly json_*.txt.gz file is semi-joined with the quoted tweet ids,
+#   and only the remaining lines are decoded.
+# workers:
+#   Number of worker processes. Each worker processes one hourly file at a time.
+# json_backend:
+#   Backend of json_extract.py ("polars", "orjson" or "json").
 # [Inputs]
 # retweets_dir:
 #   X (Twitter) API's retweets saved directory
@@ -26,6 +37,48 @@ arg_parser.add_argument("--only_qt_ids", action="store_true")
 # [Outputs]
 # save_path:
 #  Path to save the extracted retweets.
+#  If only_qt_ids, a parquet file of tweet_id.
+#  Otherwise, a directory of parquet files (tweet_id, full_text), one per hourly file
+#  (save_path/json_2021-10-01-00.parquet, ...). Existing files are skipped,
+#  so an interrupted run can be resumed with the same command.
+
+QT_FIELDS = [("full_text", "full_text", pl.String)]
+
+_worker_state = {}
+
+
+def read_qt_ids(qt_pathes):
+    return pl.concat([
+        pl.read_csv(qt_path, separator="\t", has_header=False, columns=[0], new_columns=["tweet_id"])
+        for qt_path in qt_pathes
+    ]).unique("tweet_id")
+
+
+def output_path(save_path, json_path):
+    name = os.path.basename(json_path).removesuffix(".gz").removesuffix(".txt")
+    return os.path.join(save_path, f"{name}.parquet")
+
+
+def init_worker(df_qt_ids, args):
+    _worker_state["df_qt_ids"] = df_qt_ids
+    _worker_state["args"] = args
+
+
+def extract_hour(json_path):
+    args = _worker_state["args"]
+    df_hour, _ = read_hour(json_path)
+    df_hour = df_hour.with_columns(pl.col("tweet_id").cast(pl.Int64, strict=False)).join(
+        _worker_state["df_qt_ids"], on="tweet_id", how="semi")
+    df_hour = pl.concat([
+        df_hour.select("tweet_id"),
+        extract_fields(df_hour["json_data"], QT_FIELDS, backend=args.json_backend).select("full_text"),
+    ], how="horizontal")
+
+    write_atomic(
+        output_path(args.save_path, json_path),
+        lambda path: df_hour.write_parquet(path, compression="lz4"),
+    )
+    return len(df_hour)
 
 
 def main(args):
@@ -39,40 +92,28 @@ def main(args):
         if retweet_file.startswith('qt_'):
             qt_pathes.append(f"{args.retweets_dir}/{retweet_file}")
 
-    df_qt = pl.concat([pl.read_csv(qt_path, separator="\t", has_header=False)
-                       for qt_path in qt_pathes])
+    df_qt_ids = read_qt_ids(qt_pathes)
 
     if args.only_qt_ids:
-        df_qt = df_qt.rename({"column_1": "tweet_id"})
-        df_qt = df_qt[["tweet_id"]].unique(["tweet_id"])
-        df_qt.write_parquet(args.save_path, compression="lz4")
+        df_qt_ids.write_parquet(args.save_path, compression="lz4")
         return
-    qt_ids = df_qt["column_1"].to_list()
-
-    retweet_dtype = pl.Struct([
-        pl.Field("full_text", pl.String),
-    ])
-
-    df_list = []
-    for json_path in tqdm(json_pathes):
-        df_hour = pl.read_csv(json_path, separator="\t", has_header=False)
-        df_hour.columns = ["tweet_id", "json_data"]
-        df_hour = df_hour.filter(df_hour["tweet_id"].is_in(qt_ids))
-        df_hour = df_hour.with_columns(
-            pl.col("json_data").str.json_decode(retweet_dtype).alias("extracted_json_data"),
-        ).with_columns(
-            pl.col("extracted_json_data").struct[0].alias("full_text"),
-        ).drop("json_data", "extracted_json_data")
-        df_list.append(df_hour)
-
-    df_rt_json = pl.concat(df_list)
-
-    df_rt_json.with_columns(
-        pl.col("json_data").str.json_decode(retweet_dtype).alias("extracted_json_data"),
-    ).with_columns(
-        pl.col("extracted_json_data").struct[0].alias("full_text"),
-    ).drop("json_data", "extracted_json_data")
-    df_rt_json.write_parquet(args.save_path, compression="lz4")
+
+    os.makedirs(args.save_path, exist_ok=True)
+    json_pathes = [
+        json_path for json_path in sorted(json_pathes)
+        if not os.path.exists(output_path(args.save_path, json_path))
+    ]
+    print(f"Number of quoted tweet ids: {len(df_qt_ids)}, hourly files: {len(json_pathes)}")
+
+    if args.workers <= 1:
+        init_worker(df_qt_ids, args)
+        results = map(extract_hour, json_pathes)
+        num_rows = sum(tqdm(results, total=len(json_pathes)))
+    else:
+        with spawn_pool(args.workers, initializer=init_worker, initargs=(df_qt_ids, args)) as pool:
+            results = pool.imap_unordered(extract_hour, json_pathes)
+            num_rows = sum(tqdm(results, total=len(json_pathes)))
+    print(f"Number of quoted tweets: {num_rows}")
 
 
 if __name__ == "__main__":
@@ -1,9 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
-import os
-from tqdm import tqdm
-import polars as pl
+from ingest_retweets import ingest_directory, scan_ingested_retweets
 
 
 arg_parser = argparse.ArgumentParser()
@@ -12,6 +10,9 @@ arg_parser.add_argument("--retweet_ym", type=str, required=True)
 arg_parser.add_argument("--retweets_dir", type=str, required=True)
 arg_parser.add_argument("--qt", action="store_true")
 arg_parser.add_argument("--rt", action="store_true")
+arg_parser.add_argument("--ingest_dir", type=str, default=None)
+arg_parser.add_argument("--workers", type=int, default=1)
+arg_parser.add_argument("--num_buckets", type=int, default=64)
 
 
 # [File Summary]
@@ -21,6 +22,12 @@ arg_parser.add_argument("--rt", action="store_true")
 #   If True, the retweets are extracted.
 # qt:
 #   If True, the quoted tweets are extracted.
+# ingest_dir:
+#   Directory of the deduplicated parquet dataset built by ingest_retweets.py.
+#   It is built here if missing or older than the .gz files, and reused by
+#   collecting_retweets.py and extract_rt_timestamps.py. If not set, a temporary directory is used.
+# workers, num_buckets:
+#   Passed to ingest_retweets.py when the dataset is built.
 # [Inputs]
 # retweets_dir:
 #   X (Twitter) API's retweets saved directory
@@ -38,36 +45,14 @@ def main(args):
     if not args.rt and not args.qt:
         raise ValueError("Either --rt or --qt must be set")
 
-    retweet_files = []
-    for retweet_file in os.listdir(f"{args.retweets_dir}/{args.retweet_ym}"):
-        if retweet_file.endswith('.gz'):
-            if (args.rt and "rt_" in retweet_file) or (args.qt and "qt_" in retweet_file):
-                retweet_files.append(f"{args.retweet_ym}/{retweet_file}")
+    with ingest_directory(args.ingest_dir) as ingest_dir:
+        df_rt = scan_ingested_retweets(
+            args.retweets_dir, args.retweet_ym, ingest_dir, rt=args.rt, qt=args.qt,
+            workers=args.workers, num_buckets=args.num_buckets,
+        ).select("tweet_id", "timestamp", "source_tweet_id", "source_timestamp").collect()
 
-    df_rt = []
-
-    for retweet_file in tqdm(retweet_files):
-        df = pl.read_csv(f"{args.retweets_dir}/{retweet_file}", has_header=False, separator='\t')
-        df_rt.append(df)
-
-    df_rt = pl.concat(df_rt)
-
-    df_rt.columns = [
-        "tweet_id",
-        "user_id",
-        "user_screen_name",
-        "timestamp",
-        "source_tweet_id",
-        "source_user_id",
-        "source_user_screen_name",
-        "source_timestamp",
-    ]
-
-    df_rt = df_rt[["tweet_id", "timestamp", "source_tweet_id", "source_timestamp"]]
-
-    df_rt_ = df_rt.unique(subset=["tweet_id"])
-    df_rt_ = df_rt.sort("timestamp")
-    df_rt_.write_parquet(args.save_path)
+    # scan_ingested_retweets の行は (tweet_id, source_tweet_id) で重複がない
+    df_rt.sort("timestamp").write_parquet(args.rt_save_path)
 
 
 if __name__ == "__main__":
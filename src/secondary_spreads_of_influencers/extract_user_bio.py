@@ -3,17 +3,32 @@
 import argparse
 import polars as pl
 import os
-from utils import clean_text, Tokenizer
+from utils import clean_text_expr, decompressed_dict_path, tokenize_batch
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--canonicalized_source_tweets_path", type=str, required=True)
 arg_parser.add_argument("--retweeted_tweets_dir", type=str, required=True)
 arg_parser.add_argument("--data_save_path", type=str, required=True)
+arg_parser.add_argument("--workers", type=int, default=1)
+arg_parser.add_argument("--dict_path", type=str, default=None)
+arg_parser.add_argument("--token_cache_dir", type=str, default=None)
+arg_parser.add_argument("--token_cache_max_entries", type=int, default=10_000_000)
 
 
 # [File Summary]
 # This script extracts the user bio information from the source and retweeted tweets.
+# [Configs]
+# workers:
+#   Number of tokenizer processes (see utils.tokenize_batch).
+# dict_path:
+#   vibrato dictionary (.dic or .dic.zst). Defaults to $VIBRATO_DICT_PATH or utils.DEFAULT_DICT_PATH.
+#   A .zst dictionary is decompressed once into $VIBRATO_DICT_CACHE_DIR (see utils.load_tokenizer).
+# token_cache_dir:
+#   If set, the tokens are cached in token_cache_dir/tokens.parquet (see utils.tokenize_batch),
+#   and only the texts that are not in the cache are tokenized on the next run.
+# token_cache_max_entries:
+#   Maximum number of cached texts. The least recently used texts are evicted.
 # [Inputs]
 # canonicalized_source_tweets_path:
 #   Path to the canonicalized source tweets.
@@ -58,18 +73,22 @@ def main(args):
     df = df.unique(subset=["user_id"])
     df = df.filter(df["description"].is_not_null())
     df = df.with_columns(
-        pl.col("description").map_elements(lambda x: clean_text(
-            x), return_dtype=pl.String).alias("cleaned_description"))
+        clean_text_expr(pl.col("description")).alias("cleaned_description"))
     df = df.with_columns(
-        pl.col("description").map_elements(
-            lambda x: clean_text(x, symbolize=set(), remove_nlsp=False),
-            return_dtype=pl.String).alias("text_for_topic_model"))
+        clean_text_expr(
+            pl.col("description"), symbolize=set(), remove_nlsp=False
+        ).alias("text_for_topic_model"))
 
-    tokenize = Tokenizer()
+    # .zst の辞書はworkerを起動する前に展開しておく
+    print(f"Dictionary: {decompressed_dict_path(args.dict_path)}")
+    stats = {}
     df = df.with_columns(
-        pl.col("description").map_elements(
-            lambda x: tokenize(x),
-            return_dtype=pl.List(pl.String)).alias("tokenized_description"))
+        tokenize_batch(df["description"], workers=args.workers, dict_path=args.dict_path,
+                       cache_dir=args.token_cache_dir, cache_max_entries=args.token_cache_max_entries,
+                       stats=stats)
+        .alias("tokenized_description"))
+    if args.token_cache_dir:
+        print(f"Token cache hits: {stats['cache_hits']} / {stats['num_texts']}")
 
     df.write_parquet(args.data_save_path)
 
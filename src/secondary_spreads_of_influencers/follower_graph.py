@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import numpy as np
+import polars as pl
+
+
+# [File Summary]
+# Follower adjacency in the compressed sparse row (CSR) format.
+# User ids are dictionary encoded: user_ids is the sorted int64 id of every user
+#   in the follow relations, and a user is referred to by its position (int32 code).
+# user_ids[i] の followers のcodeは indices[indptr[i]:indptr[i + 1]] に昇順で格納する。
+# All ids are numpy arrays, so no Python objects are created per user.
+#
+# A store directory (build_follow_relations_data.py --store_dir) holds
+#   user_ids.npy
+#   followers_indptr.npy, followers_indices.npy  (followers of each user)
+#   following_indptr.npy, following_indices.npy  (followees of each user)
+#   followers_first_seen.npy, followers_last_seen.npy, ... (optional, see below)
+#   meta.json
+# and FollowerGraph.load reads it back without re-grouping the parquet.
+# The arrays are opened with np.load(mmap_mode="r"), so processes on the same host
+#   share one physical copy of the graph through the page cache.
+#
+# If the follow relations have first_seen / last_seen dates (the first and last snapshot
+#   that contained the edge), they are kept per edge as int32 days since 1970-01-01.
+# The graph is unknown before the first snapshot and after the last one,
+#   so first_seen on the first snapshot date and last_seen on the last one are open ended
+#   (OPEN_FIRST / OPEN_LAST in the store, null in the DataFrames).
+
+CODE_DTYPE = np.int32
+DAY_DTYPE = np.int32
+OPEN_FIRST = np.iinfo(DAY_DTYPE).min
+OPEN_LAST = np.iinfo(DAY_DTYPE).max
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def date_bounds(lf):
+    # 最初と最後のスナップショットの日付
+    bounds = lf.select(pl.col("first_seen").min(), pl.col("last_seen").max()).collect()
+    return bounds["first_seen"][0], bounds["last_seen"][0]
+
+
+def open_ended_dates(lf, bounds):
+    # 最初/最後のスナップショットの日付を null (期限なし) にする
+    first_date, last_date = bounds
+    return lf.with_columns(
+        pl.when(pl.col("first_seen") > first_date).then(pl.col("first_seen")).alias("first_seen"),
+        pl.when(pl.col("last_seen") < last_date).then(pl.col("last_seen")).alias("last_seen"),
+    )
+
+
+def valid_at(day):
+    # day (polars式, 1970-01-01からの日数) にエッジが存在したか
+    first_seen = pl.col("first_seen").cast(pl.Int32)
+    last_seen = pl.col("last_seen").cast(pl.Int32)
+    return ((first_seen.is_null() | (first_seen <= day))
+            & (last_seen.is_null() | (last_seen >= day)))
+
+
+class FollowerGraph:
+    def __init__(self, user_ids, indptr, indices, first_seen=None, last_seen=None):
+        self.user_ids = user_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.first_seen = first_seen  # indices と同じ並びのエッジごとの日付
+        self.last_seen = last_seen
+
+    @property
+    def has_dates(self):
+        return self.first_seen is not None
+
+    @classmethod
+    def from_follow_relations(cls, df_follow_relation: pl.DataFrame):
+        followees = df_follow_relation["followee"].cast(pl.Int64).to_numpy()
+        followers = df_follow_relation["follower"].cast(pl.Int64).to_numpy()
+        user_ids = np.unique(np.concatenate([followees, followers]))
+        if len(user_ids) > np.iinfo(CODE_DTYPE).max:
+            raise ValueError(f"Too many users for {np.dtype(CODE_DTYPE).name} codes: {len(user_ids)}")
+
+        first_seen, last_seen = None, None
+        if "first_seen" in df_follow_relation.columns:
+            lf = df_follow_relation.lazy()
+            df_dates = open_ended_dates(lf, date_bounds(lf)).select(
+                pl.col("first_seen").cast(pl.Int32).fill_null(OPEN_FIRST),
+                pl.col("last_seen").cast(pl.Int32).fill_null(OPEN_LAST),
+            ).collect()
+            first_seen = df_dates["first_seen"].to_numpy()
+            last_seen = df_dates["last_seen"].to_numpy()
+
+        return cls.from_codes(
+            user_ids,
+            np.searchsorted(user_ids, followees).astype(CODE_DTYPE),
+            np.searchsorted(user_ids, followers).astype(CODE_DTYPE),
+            first_seen,
+            last_seen,
+        )
+
+    @classmethod
+    def from_codes(cls, user_ids, owners, neighbors, first_seen=None, last_seen=None):
+        # (owner, neighbor) のcodeの組から、ownerごとに neighbor を並べたCSRを作る
+        order = np.lexsort((neighbors, owners))
+        counts = np.bincount(owners, minlength=len(user_ids))
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        if first_seen is not None:
+            first_seen, last_seen = first_seen[order], last_seen[order]
+        return cls(user_ids, indptr, neighbors[order], first_seen, last_seen)
+
+    def reverse(self):
+        # followers-of を following-of (各ユーザがフォローしているユーザ) に変換する
+        owners = np.repeat(np.arange(len(self), dtype=CODE_DTYPE), np.diff(self.indptr))
+        return FollowerGraph.from_codes(
+            self.user_ids, self.indices, owners, self.first_seen, self.last_seen)
+
+    def save(self, store_dir, name="followers"):
+        os.makedirs(store_dir, exist_ok=True)
+        np.save(os.path.join(store_dir, "user_ids.npy"), self.user_ids)
+        np.save(os.path.join(store_dir, f"{name}_indptr.npy"), self.indptr)
+        np.save(os.path.join(store_dir, f"{name}_indices.npy"), self.indices)
+        if self.has_dates:
+            np.save(os.path.join(store_dir, f"{name}_first_seen.npy"), self.first_seen)
+            np.save(os.path.join(store_dir, f"{name}_last_seen.npy"), self.last_seen)
+
+    @classmethod
+    def load(cls, store_dir, name="followers", mmap=True):
+        # mmap=True なら配列はページキャッシュ上で共有され、必要な部分だけ読まれる
+        mmap_mode = "r" if mmap else None
+
+        def load_array(array_name):
+            path = os.path.join(store_dir, f"{array_name}.npy")
+            return np.load(path, mmap_mode=mmap_mode) if os.path.exists(path) else None
+
+        return cls(
+            load_array("user_ids"),
+            load_array(f"{name}_indptr"),
+            load_array(f"{name}_indices"),
+            load_array(f"{name}_first_seen"),
+            load_array(f"{name}_last_seen"),
+        )
+
+    def valid_at(self, edges, days):
+        # edges (indices 上の位置) が days (1970-01-01からの日数) に存在したか
+        if not self.has_dates:
+            return np.ones(len(edges), dtype=bool)
+        return ((np.asarray(self.first_seen[edges]) <= days)
+                & (np.asarray(self.last_seen[edges]) >= days))
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @property
+    def num_edges(self):
+        return int(self.indptr[-1])
+
+    def rows(self, user_ids):
+        # user_ids のcode (行番号) を返す。グラフに現れないユーザは -1
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if len(self.user_ids) == 0:
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        pos = np.searchsorted(self.user_ids, user_ids)
+        pos = np.minimum(pos, len(self.user_ids) - 1)
+        return np.where(self.user_ids[pos] == user_ids, pos, -1)
+
+    def followers_of(self, user_id):
+        row = self.rows([user_id])[0]
+        if row < 0:
+            return self.user_ids[:0]
+        return self.user_ids[self.indices[self.indptr[row]:self.indptr[row + 1]]]
+
+    def is_follower(self, user_ids, follower_ids):
+        # 各 i について follower_ids[i] が user_ids[i] をフォローしているか。
+        # 昇順に並んだ follower スライスを全組同時に二分探索する
+        rows = self.rows(user_ids)
+        codes = self.rows(follower_ids)
+        valid = (rows >= 0) & (codes >= 0)
+        rows, codes = rows[valid], codes[valid]
+
+        lo = np.asarray(self.indptr[rows])
+        hi = np.asarray(self.indptr[rows + 1])
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = (lo + hi) // 2
+            go_right = active & (np.asarray(self.indices[np.minimum(mid, self.num_edges - 1)]) < codes)
+            lo = np.where(go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+
+        found = np.zeros(len(valid), dtype=bool)
+        in_slice = lo < np.asarray(self.indptr[rows + 1])
+        found[np.flatnonzero(valid)[in_slice]] = (
+            np.asarray(self.indices[lo[in_slice]]) == codes[in_slice])
+        return found
+
+    def code_mask(self, user_ids):
+        # user_ids に含まれるユーザのcodeがTrueの配列
+        mask = np.zeros(len(self), dtype=bool)
+        rows = self.rows(user_ids)
+        mask[rows[rows >= 0]] = True
+        return mask
+
+    def follower_counts(self, user_ids, followers=None, max_items=1 << 24):
+        # user_ids の各ユーザの follower の数。followers を指定するとその中の follower だけを数える
+        rows = self.rows(user_ids)
+        valid = rows >= 0
+        counts = np.zeros(len(rows), dtype=np.int64)
+        if followers is None:
+            counts[valid] = np.asarray(self.indptr[rows[valid] + 1]) - np.asarray(self.indptr[rows[valid]])
+            return counts
+
+        keep = self.code_mask(followers)
+        valid_counts = np.zeros(int(valid.sum()), dtype=np.int64)
+        for owner, edges in self.iter_edges(rows[valid], max_items):
+            valid_counts += np.bincount(owner[keep[self.indices[edges]]], minlength=len(valid_counts))
+        counts[valid] = valid_counts
+        return counts
+
+    def follow_relations(self, user_ids, with_dates=False, followers=None, max_items=1 << 24):
+        # user_ids をfolloweeとする (follower, followee) のDataFrameを返す。
+        # with_dates=True なら first_seen, last_seen (pl.Date, 期限なしはnull) も付ける
+        # followers を指定すると、その中の follower だけをスライスから取り出す
+        schema = {"follower": pl.Int64, "followee": pl.Int64}
+        if with_dates:
+            if not self.has_dates:
+                raise ValueError("The follower graph has no first_seen / last_seen dates")
+            schema.update({"first_seen": pl.Int32, "last_seen": pl.Int32})
+
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        rows = self.rows(user_ids)
+        user_ids, rows = user_ids[rows >= 0], rows[rows >= 0]
+        keep = None if followers is None else self.code_mask(followers)
+        columns = {name: [] for name in schema}
+        for owner, edges in self.iter_edges(rows, max_items):
+            if keep is not None:
+                selected = keep[self.indices[edges]]
+                owner, edges = owner[selected], edges[selected]
+            columns["follower"].append(self.user_ids[self.indices[edges]])
+            columns["followee"].append(user_ids[owner])
+            if with_dates:
+                columns["first_seen"].append(np.asarray(self.first_seen[edges]))
+                columns["last_seen"].append(np.asarray(self.last_seen[edges]))
+
+        if len(columns["follower"]) == 0:
+            df = pl.DataFrame(schema=schema)
+        else:
+            df = pl.DataFrame({name: np.concatenate(arrays) for name, arrays in columns.items()},
+                              schema=schema)
+        if with_dates:
+            df = df.with_columns(
+                pl.when(pl.col("first_seen") != OPEN_FIRST).then(pl.col("first_seen")).cast(pl.Date),
+                pl.when(pl.col("last_seen") != OPEN_LAST).then(pl.col("last_seen")).cast(pl.Date),
+            )
+        return df
+
+    def iter_followers(self, rows, max_items=1 << 24):
+        # rows の follower スライスをまとめて取り出す。
+        # (owner, followers) を返し、owner は rows 内の位置、followers はユーザIDを表す。
+        # 一度に展開する要素数は max_items 程度に抑える。
+        for owner, edges in self.iter_edges(rows, max_items):
+            yield owner, self.user_ids[self.indices[edges]]
+
+    def iter_edges(self, rows, max_items=1 << 24):
+        # iter_followers と同じだが、indices 上のエッジ位置を返す
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = np.asarray(self.indptr[rows])
+        lens = np.asarray(self.indptr[rows + 1]) - starts
+        cum_lens = np.cumsum(lens)
+
+        begin = 0
+        while begin < len(rows):
+            budget = (cum_lens[begin - 1] if begin > 0 else 0) + max_items
+            end = max(int(np.searchsorted(cum_lens, budget, side="right")), begin + 1)
+
+            chunk_lens = lens[begin:end]
+            owner = np.repeat(np.arange(begin, end), chunk_lens)
+            offsets = np.arange(chunk_lens.sum()) - np.repeat(np.cumsum(chunk_lens) - chunk_lens, chunk_lens)
+            yield owner, starts[owner] + offsets
+            begin = end
+
+
+def is_follow_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "user_ids.npy"))
+
+
+def load_follower_graph(path, mmap=True):
+    # path は store_dir か (follower, followee) のparquet
+    if is_follow_store(path):
+        return FollowerGraph.load(path, mmap=mmap)
+    return FollowerGraph.from_follow_relations(pl.read_parquet(path))
+
+
+def save_follow_store(df_follow_relation: pl.DataFrame, store_dir):
+    graph = FollowerGraph.from_follow_relations(df_follow_relation)
+    graph.save(store_dir, "followers")
+    graph.reverse().save(store_dir, "following")
+
+    meta = {
+        "num_users": len(graph),
+        "num_edges": graph.num_edges,
+        "code_dtype": np.dtype(CODE_DTYPE).name,
+        "has_dates": graph.has_dates,
+    }
+    with open(os.path.join(store_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return graph
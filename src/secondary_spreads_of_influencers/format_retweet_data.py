@@ -5,6 +5,8 @@ import os
 from collections import defaultdict
 from tqdm import tqdm
 import polars as pl
+from json_extract import BACKENDS, extract_fields
+from pipeline_utils import spawn_pool
 
 
 arg_parser = argparse.ArgumentParser()
@@ -12,10 +14,23 @@ arg_parser.add_argument("--retweets_dir", type=str, required=True)
 arg_parser.add_argument("--save_sources_dir", type=str, required=True)
 arg_parser.add_argument("--save_retweets_dir", type=str, required=True)
 arg_parser.add_argument("--force_overwrite", action="store_true")
+arg_parser.add_argument("--workers", type=int, default=1)
+arg_parser.add_argument("--quarantine_dir", type=str, default=None)
+arg_parser.add_argument("--json_backend", type=str, default="polars", choices=BACKENDS)
 
 
 # [File Summary]
 # This script extracts and formats the retweets from the raw api response.
+# Each JSON line is parsed once, only the TWEET_FIELDS paths are extracted
+#   (see json_extract.py), and both the retweet and the source outputs are
+#   selected from the extracted columns.
+# [Configs]
+# workers:
+#   Number of worker processes. Each worker formats one date at a time.
+# json_backend:
+#   Backend of json_extract.py ("polars", "orjson" or "json").
+# force_overwrite:
+#   If True, dates whose outputs already exist are formatted again.
 # [Inputs]
 # retweets_dir:
 #   X (Twitter) API's retweets saved directory
@@ -26,6 +41,160 @@ arg_parser.add_argument("--force_overwrite", action="store_true")
 # save_retweets_dir:
 #   Directory to save the retweets.
 #   The retweets are saved in the parquet format.
+# quarantine_dir:
+#   Directory to save the lines that could not be read or decoded
+#   (path, tweet_id, json_data, error), one parquet file per date.
+#   Defaults to save_retweets_dir + ".quarantine". Only written if there are such lines.
+
+
+# retweetとsourceの両方に必要なフィールド (alias, path, dtype)
+TWEET_FIELDS = [
+    ("user_id", "user.id", pl.Int64),
+    ("name", "user.name", pl.String),
+    ("screen_name", "user.screen_name", pl.String),
+    ("description", "user.description", pl.String),
+    ("followers_count", "user.followers_count", pl.Int64),
+    ("friends_count", "user.friends_count", pl.Int64),
+    ("user_created_at", "user.created_at", pl.String),
+    ("source_tweet_id", "retweeted_status.id", pl.Int64),
+    ("full_text", "full_text", pl.String),
+    ("source_user_id", "retweeted_status.user.id", pl.Int64),
+    ("source_name", "retweeted_status.user.name", pl.String),
+    ("source_screen_name", "retweeted_status.user.screen_name", pl.String),
+    ("source_description", "retweeted_status.user.description", pl.String),
+    ("source_followers_count", "retweeted_status.user.followers_count", pl.Int64),
+    ("source_friends_count", "retweeted_status.user.friends_count", pl.Int64),
+    ("source_user_created_at", "retweeted_status.user.created_at", pl.String),
+    ("source_full_text", "retweeted_status.full_text", pl.String),
+    ("source_entities", "retweeted_status.entities", pl.Struct([
+        pl.Field("hashtags",
+                 pl.List(pl.Struct([
+                     pl.Field("text", pl.String)]))),
+        pl.Field("urls",
+                 pl.List(pl.Struct([
+                     pl.Field("expanded_url", pl.String)
+                 ]))),
+    ])),
+    ("source_extended_entities", "retweeted_status.extended_entities", pl.Struct([
+        pl.Field("media",
+                 pl.List(pl.Struct([
+                     pl.Field("type", pl.String)
+                 ])))
+    ])),
+]
+
+QUARANTINE_SCHEMA = {"path": pl.String, "tweet_id": pl.String, "json_data": pl.String, "error": pl.String}
+
+
+def quarantine_dir(args):
+    return args.quarantine_dir or args.save_retweets_dir.rstrip("/") + ".quarantine"
+
+
+def read_hour(json_path):
+    # (正しい行, 除外した行) を返す
+    df_hour = pl.read_csv(
+        json_path,
+        separator="\t",
+        has_header=False,
+        truncate_ragged_lines=True,
+        schema={"tweet_id": pl.String, "json_data": pl.String})
+    is_object = (
+        pl.col("json_data").str.starts_with("{")
+        & pl.col("json_data").str.ends_with("}")
+    )
+    df_hour = df_hour.with_columns(pl.lit(json_path).alias("path"))
+    df_bad = df_hour.filter(~is_object.fill_null(False)).select(
+        "path", "tweet_id", "json_data", pl.lit("not a JSON object").alias("error"))
+    return df_hour.filter(is_object), df_bad
+
+
+def decode(df_rt_json, backend):
+    # 1行につき1回だけパースし、壊れたJSONの行は除外した行として返す
+    df_fields = extract_fields(df_rt_json["json_data"], TWEET_FIELDS, backend=backend)
+    df_decoded = pl.concat([df_rt_json, df_fields], how="horizontal")
+    df_bad = df_decoded.filter(~pl.col("is_valid_json")).select(
+        "path", "tweet_id", "json_data", pl.lit("invalid JSON").alias("error"))
+    return df_decoded.filter(pl.col("is_valid_json")), df_bad
+
+
+def retweets(df_decoded):
+    return df_decoded.select(
+        "tweet_id",
+        "user_id",
+        "name",
+        "screen_name",
+        "description",
+        "followers_count",
+        "friends_count",
+        pl.col("user_created_at").str.strptime(
+            pl.Datetime, "%a %b %d %H:%M:%S %z %Y"
+        ).dt.epoch(time_unit="s").alias("user_created_at"),
+        "source_tweet_id",
+        "full_text",
+    )
+
+
+def sources(df_decoded):
+    return df_decoded.select(
+        "tweet_id",
+        "source_tweet_id",
+        "source_user_id",
+        "source_name",
+        "source_screen_name",
+        "source_description",
+        "source_followers_count",
+        "source_friends_count",
+        "source_user_created_at",
+        "source_full_text",
+        "source_entities",
+        "source_extended_entities",
+    ).filter(
+        pl.col("source_user_created_at") != "Thu Jan 01 00:00:00 +0000 1970"
+    ).with_columns(
+        pl.col("source_user_created_at").str.strptime(
+            pl.Datetime, "%a %b %d %H:%M:%S %z %Y"
+        ).dt.timestamp(time_unit="ms").cast(pl.String).str.strip_chars_end(
+            "000").cast(pl.Int64).alias("source_user_created_at"),
+    )
+
+
+def format_date(task):
+    date, json_pathes, args = task
+    df_list_by_date, df_quarantine = [], []
+    for json_path in json_pathes:
+        try:
+            df_hour, df_bad = read_hour(json_path)
+        except Exception as err:
+            print(f"Error: {json_path}: {err}")
+            df_quarantine.append(pl.DataFrame(
+                {"path": [json_path], "tweet_id": [None], "json_data": [None], "error": [str(err)]},
+                schema=QUARANTINE_SCHEMA))
+            continue
+        df_list_by_date.append(df_hour)
+        df_quarantine.append(df_bad)
+
+    df_rt_json = pl.concat(df_list_by_date) if df_list_by_date else pl.DataFrame(
+        schema={"tweet_id": pl.String, "json_data": pl.String, "path": pl.String})
+    df_decoded, df_bad = decode(df_rt_json, args.json_backend)
+    df_quarantine.append(df_bad)
+    df_decoded = df_decoded.with_columns(pl.col("tweet_id").cast(pl.Int64, strict=False))
+
+    retweets(df_decoded).write_parquet(
+        f"{args.save_retweets_dir}/{date}.parquet", compression="lz4")
+    sources(df_decoded).write_parquet(
+        f"{args.save_sources_dir}/{date}.parquet", compression="lz4")
+
+    df_quarantine = pl.concat(df_quarantine) if df_quarantine else pl.DataFrame(schema=QUARANTINE_SCHEMA)
+    if len(df_quarantine) > 0:
+        os.makedirs(quarantine_dir(args), exist_ok=True)
+        df_quarantine.write_parquet(f"{quarantine_dir(args)}/{date}.parquet")
+    return date, len(df_decoded), len(df_quarantine)
+
+
+def report(results, total):
+    for date, num_rows, num_quarantined in tqdm(results, total=total):
+        if num_quarantined > 0:
+            print(f"{date}: {num_rows} rows, {num_quarantined} quarantined lines")
 
 
 def main(args):
@@ -37,123 +206,20 @@ def main(args):
             date = retweet_file.split('_')[1].strip('.txt.gz')[:-3]
             json_pathes_dict[date].append(f"{args.retweets_dir}/{retweet_file}")
 
-    for date, json_pathes in tqdm(json_pathes_dict.items()):
+    tasks = []
+    for date, json_pathes in sorted(json_pathes_dict.items()):
         if not args.force_overwrite and (
                 os.path.exists(f"{args.save_retweets_dir}/{date}.parquet")
                 and os.path.exists(f"{args.save_sources_dir}/{date}.parquet")):
             print(f"Skip {date}")
             continue
+        tasks.append((date, sorted(json_pathes), args))
 
-        df_list_by_date = []
-        for json_path in tqdm(json_pathes):
-            print(f"Reading {json_path}")
-            try:
-                df_hour = pl.read_csv(
-                    json_path,
-                    separator="\t",
-                    has_header=False,
-                    truncate_ragged_lines=True)
-                df_hour.columns = ["tweet_id", "json_data"]
-                df_hour = df_hour.filter(
-                    df_hour["json_data"].str.starts_with("{")
-                    & df_hour["json_data"].str.ends_with("}")
-                )
-            except Exception as err:
-                print(f"Error: {err}")
-                import ipdb; ipdb.set_trace()
-            df_list_by_date.append(df_hour)
-
-        df_rt_json = pl.concat(df_list_by_date)
-
-        retweet_dtype = pl.Struct([
-            pl.Field("user",
-                     pl.Struct([
-                         pl.Field("id", pl.Int64),
-                         pl.Field("name", pl.String),
-                         pl.Field("screen_name", pl.String),
-                         pl.Field("description", pl.String),
-                         pl.Field("followers_count", pl.Int64),
-                         pl.Field("friends_count", pl.Int64),
-                         pl.Field("created_at", pl.String)
-                     ])),
-            pl.Field("retweeted_status", pl.Struct([pl.Field("id", pl.Int64)])),
-            pl.Field("full_text", pl.String),
-        ])
-
-        df_rt_json.with_columns(
-            pl.col("json_data").str.json_decode(retweet_dtype).alias("extracted_json_data"),
-        ).with_columns(
-            pl.col("extracted_json_data").struct[0].struct[0].alias("user_id"),
-            pl.col("extracted_json_data").struct[0].struct[1].alias("name"),
-            pl.col("extracted_json_data").struct[0].struct[2].alias("screen_name"),
-            pl.col("extracted_json_data").struct[0].struct[3].alias("description"),
-            pl.col("extracted_json_data").struct[0].struct[4].alias("followers_count"),
-            pl.col("extracted_json_data").struct[0].struct[5].alias("friends_count"),
-            pl.col("extracted_json_data").struct[0].struct[6].alias("user_created_at"),
-            pl.col("extracted_json_data").struct[1].struct[0].alias("source_tweet_id"),
-            pl.col("extracted_json_data").struct[2].alias("full_text"),
-        ).drop("json_data", "extracted_json_data").with_columns(
-            pl.col("user_created_at").str.strptime(
-                pl.Datetime, "%a %b %d %H:%M:%S %z %Y"
-            ).dt.epoch(time_unit="s").alias("user_created_at"),
-        ).write_parquet(
-            f"{args.save_retweets_dir}/{date}.parquet", compression="lz4")
-
-        source_dtype = pl.Struct([
-            pl.Field("retweeted_status",
-                     pl.Struct([
-                         pl.Field("id", pl.Int64),
-                         pl.Field("user",
-                                 pl.Struct([
-                                     pl.Field("id", pl.Int64),
-                                     pl.Field("name", pl.String),
-                                     pl.Field("screen_name", pl.String),
-                                     pl.Field("description", pl.String),
-                                     pl.Field("followers_count", pl.Int64),
-                                     pl.Field("friends_count", pl.Int64),
-                                     pl.Field("created_at", pl.String),
-                                    ])),
-                         pl.Field("full_text", pl.String),
-                         pl.Field("entities", pl.Struct([
-                             pl.Field("hashtags",
-                                      pl.List(pl.Struct([
-                                          pl.Field("text", pl.String)]))),
-                             pl.Field("urls",
-                                      pl.List(pl.Struct([
-                                          pl.Field("expanded_url", pl.String)
-                                      ]))),
-                            ])),
-                         pl.Field("extended_entities", pl.Struct([
-                             pl.Field("media",
-                                      pl.List(pl.Struct([
-                                          pl.Field("type", pl.String)
-                                      ])))
-                            ]))
-                     ]))
-        ])
-
-        df_rt_json.with_columns(
-            pl.col("json_data").str.json_decode(source_dtype).alias("extracted_json_data"),
-        ).with_columns(
-            pl.col("extracted_json_data").struct[0].struct[0].alias("source_tweet_id"),
-            pl.col("extracted_json_data").struct[0].struct[1].struct[0].alias("source_user_id"),
-            pl.col("extracted_json_data").struct[0].struct[1].struct[1].alias("source_name"),
-            pl.col("extracted_json_data").struct[0].struct[1].struct[2].alias("source_screen_name"),
-            pl.col("extracted_json_data").struct[0].struct[1].struct[3].alias("source_description"),
-            pl.col("extracted_json_data").struct[0].struct[1].struct[4].alias("source_followers_count"),
-            pl.col("extracted_json_data").struct[0].struct[1].struct[5].alias("source_friends_count"),
-            pl.col("extracted_json_data").struct[0].struct[1].struct[6].alias("source_user_created_at"),
-            pl.col("extracted_json_data").struct[0].struct[2].alias("source_full_text"),
-            pl.col("extracted_json_data").struct[0].struct[3].alias("source_entities"),
-            pl.col("extracted_json_data").struct[0].struct[4].alias("source_extended_entities"),
-        ).drop("json_data", "extracted_json_data").filter(
-            pl.col("source_user_created_at") != "Thu Jan 01 00:00:00 +0000 1970"
-        ).with_columns(
-            pl.col("source_user_created_at").str.strptime(
-                pl.Datetime, "%a %b %d %H:%M:%S %z %Y"
-            ).dt.timestamp(time_unit="ms").cast(pl.String).str.strip_chars_end(
-                "000").cast(pl.Int64).alias("source_user_created_at"),
-        ).write_parquet(f"{args.save_sources_dir}/{date}.parquet", compression="lz4")
+    if args.workers <= 1:
+        report(map(format_date, tasks), len(tasks))
+    else:
+        with spawn_pool(args.workers) as pool:
+            report(pool.imap_unordered(format_date, tasks), len(tasks))
 
 
 if __name__ == "__main__":
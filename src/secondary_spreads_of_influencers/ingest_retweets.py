@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from tqdm import tqdm
+import polars as pl
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("--retweet_ym", type=str, required=True)
+arg_parser.add_argument("--retweets_dir", type=str, required=True)
+arg_parser.add_argument("--ingest_dir", type=str, required=True)
+arg_parser.add_argument("--qt", action="store_true")
+arg_parser.add_argument("--rt", action="store_true")
+arg_parser.add_argument("--workers", type=int, default=1)
+arg_parser.add_argument("--num_buckets", type=int, default=64)
+
+
+# [File Summary]
+# This script decompresses the raw retweet dumps of a month once and saves them
+#   as a deduplicated parquet dataset, which collecting_retweets.py and
+#   extract_rt_timestamps.py read instead of the .gz files.
+# The .gz files are parsed concurrently by a process pool. At most 2 * workers files
+#   are in flight, so the memory is bounded by the size of a few files.
+# Each parsed file is split by the hash of source_tweet_id, and each bucket is
+#   deduplicated on (tweet_id, source_tweet_id) independently.
+#   The same source tweet always falls in the same bucket, so this equals
+#   deduplicating the whole month.
+# The dataset is rebuilt only when the .gz files of the month change
+#   (the (name, size, mtime) of the files are recorded in manifest.json).
+# [Configs]
+# rt:
+#   If True, the retweets (rt_*.gz) are ingested.
+# qt:
+#   If True, the quoted tweets (qt_*.gz) are ingested.
+# workers:
+#   Number of worker processes.
+# num_buckets:
+#   Number of source_tweet_id hash buckets per month.
+# [Inputs]
+# retweets_dir:
+#   X (Twitter) API's retweets saved directory.
+# retweet_ym:
+#   Year and month of the retweets. The format is "YYYY-MM".
+# [Outputs]
+# ingest_dir:
+#   ingest_dir/YYYY-MM/{rt,qt}/bucket-00000-of-00064.parquet, ...
+#   Columns are the same as the raw dumps, with the types of RAW_SCHEMA.
+
+# ファイルごとに型を推論すると、数字だけのscreen_nameがInt64になるなどバケット間で型がずれる
+RAW_SCHEMA = {
+    "tweet_id": pl.Int64,
+    "user_id": pl.Int64,
+    "user_screen_name": pl.String,
+    "timestamp": pl.Int64,
+    "source_tweet_id": pl.Int64,
+    "source_user_id": pl.Int64,
+    "source_user_screen_name": pl.String,
+    "source_timestamp": pl.Int64,
+}
+KINDS = ("rt", "qt")
+
+
+def raw_retweet_files(retweets_dir, retweet_ym, kind):
+    month_dir = os.path.join(retweets_dir, retweet_ym)
+    return sorted(
+        os.path.join(month_dir, f) for f in os.listdir(month_dir)
+        if f.endswith(".gz") and f"{kind}_" in f
+    )
+
+
+def partition_dir(ingest_dir, retweet_ym, kind):
+    return os.path.join(ingest_dir, retweet_ym, kind)
+
+
+def bucket_name(bucket, num_buckets):
+    return f"bucket-{bucket:05d}-of-{num_buckets:05d}.parquet"
+
+
+def _files_key(paths, num_buckets):
+    stats = [
+        (os.path.basename(p), os.stat(p).st_size, os.stat(p).st_mtime_ns)
+        for p in paths
+    ]
+    return hashlib.sha1(json.dumps([num_buckets, stats]).encode()).hexdigest()
+
+
+def _read_manifest(path):
+    manifest = os.path.join(path, "manifest.json")
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _split_file(path, staging_dir, part, num_buckets):
+    # 1ファイルを読んでsource_tweet_idのハッシュでバケットに分けて書き出す
+    df = pl.read_csv(path, has_header=False, separator="\t", schema=RAW_SCHEMA)
+    df = df.unique(subset=["tweet_id", "source_tweet_id"]).with_columns(
+        (pl.col("source_tweet_id").hash(seed=0) % num_buckets).alias("bucket")
+    )
+    for (bucket,), df_bucket in df.partition_by("bucket", as_dict=True).items():
+        bucket_dir = os.path.join(staging_dir, f"{bucket:05d}")
+        os.makedirs(bucket_dir, exist_ok=True)
+        df_bucket.drop("bucket").write_parquet(os.path.join(bucket_dir, f"part-{part:05d}.parquet"))
+    return path
+
+
+def _merge_bucket(staging_dir, out_dir, bucket, num_buckets):
+    parts = sorted(glob.glob(os.path.join(staging_dir, f"{bucket:05d}", "*.parquet")))
+    if len(parts) == 0:
+        df = pl.DataFrame(schema=RAW_SCHEMA)
+    else:
+        df = pl.concat([pl.read_parquet(p) for p in parts], how="vertical_relaxed")
+        df = df.unique(subset=["tweet_id", "source_tweet_id"])
+    df.write_parquet(os.path.join(out_dir, bucket_name(bucket, num_buckets)))
+    return bucket
+
+
+def _run_bounded(pool, fn, tasks, max_in_flight, desc):
+    # 投入済みのタスクを max_in_flight 個までに抑える
+    pending = set()
+    with tqdm(total=len(tasks), desc=desc) as pbar:
+        for task in tasks:
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    pbar.update(1)
+            pending.add(pool.submit(fn, *task))
+        for future in wait(pending).done:
+            future.result()
+            pbar.update(1)
+
+
+def ingest_month(retweets_dir, retweet_ym, ingest_dir, kind, workers=1, num_buckets=64):
+    paths = raw_retweet_files(retweets_dir, retweet_ym, kind)
+    out_dir = partition_dir(ingest_dir, retweet_ym, kind)
+    key = _files_key(paths, num_buckets)
+    manifest = _read_manifest(out_dir)
+    if manifest is not None and manifest["key"] == key:
+        return out_dir
+
+    print(f"Ingesting {len(paths)} {kind} files of {retweet_ym} into {out_dir}")
+    tmp_dir = f"{out_dir}.{os.getpid()}.tmp"
+    staging_dir = os.path.join(tmp_dir, "staging")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn")) as pool:
+        _run_bounded(
+            pool, _split_file,
+            [(path, staging_dir, part, num_buckets) for part, path in enumerate(paths)],
+            max_in_flight=2 * workers, desc="Parsing",
+        )
+        _run_bounded(
+            pool, _merge_bucket,
+            [(staging_dir, tmp_dir, bucket, num_buckets) for bucket in range(num_buckets)],
+            max_in_flight=2 * workers, desc="Deduplicating",
+        )
+    shutil.rmtree(staging_dir)
+
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"key": key, "num_buckets": num_buckets, "files": len(paths)}, f, indent=2)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def ingest_directory(ingest_dir):
+    # ingest_dir が未指定なら処理の間だけ一時ディレクトリを使う
+    if ingest_dir is None:
+        return tempfile.TemporaryDirectory()
+    return contextlib.nullcontext(ingest_dir)
+
+
+def scan_ingested_retweets(retweets_dir, retweet_ym, ingest_dir, rt=False, qt=False,
+                           workers=1, num_buckets=64):
+    # 未作成・古いデータセットは作り直してから (tweet_id, source_tweet_id) で重複のない LazyFrame を返す
+    if not rt and not qt:
+        raise ValueError("Either rt or qt must be set")
+    kinds = [kind for kind, use in zip(KINDS, (rt, qt)) if use]
+    lfs = []
+    for kind in kinds:
+        out_dir = ingest_month(retweets_dir, retweet_ym, ingest_dir, kind,
+                               workers=workers, num_buckets=num_buckets)
+        lfs.append(pl.scan_parquet(os.path.join(out_dir, "bucket-*.parquet")))
+    if len(lfs) == 1:
+        return lfs[0]
+    return pl.concat(lfs, how="vertical_relaxed").unique(subset=["tweet_id", "source_tweet_id"])
+
+
+def main(args):
+    if not args.rt and not args.qt:
+        raise ValueError("Either --rt or --qt must be set")
+    for kind, use in zip(KINDS, (args.rt, args.qt)):
+        if use:
+            ingest_month(args.retweets_dir, args.retweet_ym, args.ingest_dir, kind,
+                         workers=args.workers, num_buckets=args.num_buckets)
+
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    main(args)
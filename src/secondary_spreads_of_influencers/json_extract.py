@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import json
+import polars as pl
+
+
+# [File Summary]
+# Selective field extraction from the raw X (Twitter) API JSON lines.
+# A field is (alias, path, dtype), where path is a dot-separated key path, e.g.
+#   ("user_id", "user.id", pl.Int64)
+#   ("source_full_text", "retweeted_status.full_text", pl.String)
+#   ("hashtags", "entities.hashtags[].text", pl.List(pl.String))
+# "[]" maps the rest of the path over a list. If dtype is a pl.Struct, the whole
+#   subtree is kept but pruned to the fields of the dtype (e.g. retweeted_status.user).
+# extract_fields returns one column per field plus "is_valid_json".
+#   Lines that are not valid JSON get nulls and is_valid_json = False, instead of
+#   failing the whole batch.
+# Backends:
+#   "polars": one str.json_decode per batch with the minimal struct built from the paths.
+#     Only the requested keys are materialized.
+#   "orjson": orjson.loads per line and a walk of the requested paths.
+#     orjson is not a dependency of this project, install it to use this backend.
+#   "json": the same as "orjson" with the standard library json module.
+# See benchmark_json_extract.py for a comparison of the backends.
+
+BACKENDS = ("polars", "orjson", "json")
+
+
+def parse_path(path):
+    # "entities.hashtags[].text" -> [("entities", False), ("hashtags", True), ("text", False)]
+    return [(key[:-2], True) if key.endswith("[]") else (key, False) for key in path.split(".")]
+
+
+def _node(dtype, is_list=False):
+    # Struct (とListのStruct) は木に展開して、他のパスとマージできるようにする
+    if not is_list and isinstance(dtype, pl.List) and isinstance(dtype.inner, pl.Struct):
+        return _node(dtype.inner, is_list=True)
+    if isinstance(dtype, pl.Struct):
+        return {"list": is_list, "fields": {f.name: _node(f.dtype) for f in dtype.fields}}
+    return pl.List(dtype) if is_list else dtype
+
+
+def _merge_node(tree, key, node, path):
+    if key not in tree:
+        tree[key] = node
+        return
+    current = tree[key]
+    if isinstance(current, dict) and isinstance(node, dict) and current["list"] == node["list"]:
+        for child_key, child in node["fields"].items():
+            _merge_node(current["fields"], child_key, child, path)
+    elif current != node:
+        raise ValueError(f"{path} overlaps with another field of a different dtype")
+
+
+def _merge_dtype(tree, segments, dtype, path):
+    (key, is_list), rest = segments[0], segments[1:]
+    if len(rest) == 0:
+        _merge_node(tree, key, _node(dtype, is_list), path)
+        return
+    child = {"list": is_list, "fields": {}}
+    _merge_dtype(child["fields"], rest, dtype, path)
+    _merge_node(tree, key, child, path)
+
+
+def _to_dtype(tree):
+    fields = []
+    for key, node in tree.items():
+        if isinstance(node, dict):
+            inner = _to_dtype(node["fields"])
+            node = pl.List(inner) if node["list"] else inner
+        fields.append(pl.Field(key, node))
+    return pl.Struct(fields)
+
+
+def decode_dtype(fields):
+    # 指定したパスだけを含む最小のStruct
+    tree = {}
+    for _, path, dtype in fields:
+        segments = parse_path(path)
+        # dtype は出力の型なので、"[]" の数だけListを外したものが葉の型
+        for _ in range(sum(is_list for _, is_list in segments)):
+            if not isinstance(dtype, pl.List):
+                raise ValueError(f"dtype of {path} must be a pl.List for each []")
+            dtype = dtype.inner
+        _merge_dtype(tree, segments, dtype, path)
+    return _to_dtype(tree)
+
+
+def _path_expr(expr, segments):
+    (key, is_list), rest = segments[0], segments[1:]
+    expr = expr.struct.field(key)
+    if is_list and len(rest) > 0:
+        return expr.list.eval(_path_expr(pl.element(), rest))
+    if len(rest) == 0:
+        return expr
+    return _path_expr(expr, rest)
+
+
+def _extract_polars(lines, fields):
+    dtype = decode_dtype(fields)
+    df = lines.to_frame("json_data")
+    try:
+        df = df.with_columns(
+            pl.col("json_data").str.json_decode(dtype),
+            pl.col("json_data").is_not_null().alias("is_valid_json"),
+        )
+    except pl.exceptions.ComputeError:
+        # 壊れた行があるとバッチ全体のデコードが失敗するので、その行をnullにしてやり直す
+        is_valid = pl.col("json_data").str.json_path_match("$").is_not_null()
+        df = df.with_columns(is_valid.alias("is_valid_json")).with_columns(
+            pl.when(pl.col("is_valid_json")).then(pl.col("json_data")).str.json_decode(dtype))
+    return df.select(
+        *[_path_expr(pl.col("json_data"), parse_path(path)).alias(alias)
+          for alias, path, _ in fields],
+        "is_valid_json",
+    )
+
+
+def _conform(value, dtype):
+    # Structのdtypeに含まれないキーを落とす
+    if value is None:
+        return None
+    if isinstance(dtype, pl.Struct):
+        if not isinstance(value, dict):
+            return None
+        return {f.name: _conform(value.get(f.name), f.dtype) for f in dtype.fields}
+    if isinstance(dtype, pl.List):
+        if not isinstance(value, list):
+            return None
+        return [_conform(v, dtype.inner) for v in value]
+    return value
+
+
+def _walk(obj, segments):
+    for i, (key, is_list) in enumerate(segments):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+        if is_list:
+            if not isinstance(obj, list):
+                return None
+            return [_walk(v, segments[i + 1:]) for v in obj] if i + 1 < len(segments) else obj
+    return obj
+
+
+def _extract_python(lines, fields, loads):
+    segments = [parse_path(path) for _, path, _ in fields]
+    columns = [[] for _ in fields]
+    is_valid_json = []
+    for line in lines:
+        try:
+            obj = loads(line) if line is not None else None
+        except ValueError:
+            obj = None
+        is_valid_json.append(obj is not None)
+        for column, path, (_, _, dtype) in zip(columns, segments, fields):
+            column.append(_conform(_walk(obj, path), dtype) if obj is not None else None)
+    return pl.DataFrame(
+        [pl.Series(alias, column, dtype=dtype, strict=False)
+         for column, (alias, _, dtype) in zip(columns, fields)]
+        + [pl.Series("is_valid_json", is_valid_json, dtype=pl.Boolean)]
+    )
+
+
+def _loads(backend):
+    if backend == "json":
+        return json.loads
+    try:
+        import orjson
+    except ImportError as err:
+        raise ImportError("The orjson backend requires orjson (pip install orjson)") from err
+    return orjson.loads
+
+
+def extract_fields(lines, fields, backend="polars", batch_size=100_000):
+    # lines: JSON文字列のSeries, fields: [(alias, path, dtype), ...]
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}. Choose from {BACKENDS}")
+    if backend != "polars":
+        loads = _loads(backend)
+
+    dfs = []
+    for offset in range(0, max(len(lines), 1), batch_size):
+        batch = lines.slice(offset, batch_size)
+        if backend == "polars":
+            dfs.append(_extract_polars(batch, fields))
+        else:
+            dfs.append(_extract_python(batch.to_list(), fields, loads))
+    return pl.concat(dfs)
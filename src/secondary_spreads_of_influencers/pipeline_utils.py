@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+import os
+import multiprocessing as mp
+
+
+# [File Summary]
+# Small helpers shared by the parallel pipeline scripts.
+# Kept free of heavy imports (vibrato etc.) so that any script can use them.
+# spawn_pool: a multiprocessing Pool started with the spawn method.
+#   polars can deadlock in forked children, so every pool that runs polars
+#   code in its workers is created here.
+# write_atomic: calls write(path + ".tmp") and renames the result to path,
+#   so an interrupted run never leaves a partially written file at path.
+
+
+def spawn_pool(workers, initializer=None, initargs=()):
+    # polarsはfork先でデッドロックすることがあるのでspawnする
+    return mp.get_context("spawn").Pool(workers, initializer=initializer, initargs=initargs)
+
+
+def write_atomic(path, write):
+    # write: 受け取ったパスにファイルを書く関数
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import argparse
-import os
 import polars as pl
 import matplotlib as mpl
 mpl.use("WebAgg")
@@ -9,11 +8,13 @@ mpl.rc("webagg", port=8899, port_retries=10, open_in_browser=False)
 import matplotlib.pyplot as plt
 import seaborn as sns
 import scienceplots
+from retweet_io import scan_retweeted_tweets
 
 
 arg_parser = argparse.ArgumentParser()
 # arg_parser.add_argument("--userinfo_path", type=str, required=True)
 arg_parser.add_argument("--retweeted_tweets_dir", type=str, required=True)
+arg_parser.add_argument("--rt_cache_dir", type=str, default=None)
 arg_parser.add_argument("--exclude_qt", action="store_true")
 arg_parser.add_argument("--qt_ids_path", type=str, required=False)
 arg_parser.add_argument("--user_influence_score_path", type=str, required=True)
@@ -47,19 +48,8 @@ def main(args):
         df_userinfo["is_official"])["user_id"].to_list()
 
     print("Loading retweeted tweets...")
-    retweeted_tweets_files = os.listdir(args.retweeted_tweets_dir)
-    retweeted_tweets_paths = [os.path.join(args.retweeted_tweets_dir, f)
-                              for f in retweeted_tweets_files]
-
-    df_list = []
-    for i, path in enumerate(retweeted_tweets_paths):
-        df_rt = pl.read_parquet(path)
-        df_list.append(df_rt)
-    df_rt = pl.concat(df_list)
-    del df_list
-    df_rt = df_rt.filter(df_rt["user_id"].is_not_null())
-    df_rt = df_rt[["source_tweet_id", "user_id", "tweet_id"]]
-    df_rt = df_rt.filter(df_rt["source_tweet_id"].is_not_null())
+    df_rt = scan_retweeted_tweets(
+        args.retweeted_tweets_dir, cache_dir=args.rt_cache_dir).collect()
 
     if args.exclude_qt:
         if not args.qt_ids_path:
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import pickle
+import numpy as np
+import scipy as sp
+import scipy.sparse.linalg
+import polars as pl
+
+
+# [File Summary]
+# The user retweet graph as a scipy CSR matrix over dense user indices, and
+#   centralities computed directly on the matrix.
+# A graph is (user_ids, A):
+#   user_ids: np.ndarray of the user ids. Row/column i of A is user_ids[i].
+#   A: scipy.sparse.csr_array of shape (n, n). A[i, j] is the number of retweets
+#     of user j by user i (the edge user_id -> source_user_id of rt_path_clustering.py).
+# save_retweet_graph / load_retweet_graph use a single .npz file.
+#   load_retweet_graph also reads the networkx pickle of rt_path_clustering.py.
+# Centralities (one value per row of A, in the order of user_ids):
+#   in_degree / out_degree: weighted column / row sums.
+#   pagerank: the same power iteration as networkx.pagerank.
+#   hits: hub and authority scores from the leading singular vectors of A
+#     (scipy.sparse.linalg.svds), normalized to sum to 1 like networkx.hits.
+#   eigenvector: the same power iteration as networkx.eigenvector_centrality.
+# The iterative ones raise ValueError if they do not converge within max_iter.
+# centrality_frame passes max_iter / tol to them.
+
+CENTRALITIES = ("degree", "out_degree", "pagerank", "hits", "eigenvector")
+
+
+def build_retweet_graph(df_edges, source="user_id", target="source_user_id", weight="num_rt_users"):
+    # df_edges: (source, target, weight) の辺のDataFrame。同じ辺が複数あれば重みを足す
+    user_ids = pl.concat([df_edges[source], df_edges[target]]).unique().sort()
+    df_index = user_ids.to_frame("user_id").with_row_index("index")
+    rows = df_edges.select(source).join(df_index, left_on=source, right_on="user_id", how="left")["index"]
+    cols = df_edges.select(target).join(df_index, left_on=target, right_on="user_id", how="left")["index"]
+    n = len(user_ids)
+    A = sp.sparse.coo_array(
+        (df_edges[weight].cast(pl.Float64).to_numpy(), (rows.to_numpy(), cols.to_numpy())),
+        shape=(n, n),
+    ).tocsr()
+    A.sum_duplicates()
+    return user_ids.to_numpy(), A
+
+
+def graph_from_networkx(G):
+    import networkx as nx
+
+    user_ids = np.array(list(G.nodes))
+    A = nx.to_scipy_sparse_array(G, nodelist=list(G.nodes), weight="weight", dtype=float, format="csr")
+    return user_ids, A
+
+
+def save_retweet_graph(path, user_ids, A):
+    A = A.tocsr()
+    # np.savez は拡張子 .npz を付け足すので、ファイルオブジェクトに書く
+    with open(path, "wb") as f:
+        np.savez(f, user_ids=user_ids, data=A.data, indices=A.indices, indptr=A.indptr, shape=A.shape)
+
+
+def load_retweet_graph(path):
+    # .npz なら save_retweet_graph の形式、それ以外は rt_path_clustering.py の networkx の pickle
+    if path.endswith(".npz"):
+        with np.load(path) as f:
+            A = sp.sparse.csr_array((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+            return f["user_ids"], A
+    with open(path, "rb") as f:
+        return graph_from_networkx(pickle.load(f))
+
+
+def in_degree(A):
+    return np.asarray(A.sum(axis=0)).ravel()
+
+
+def out_degree(A):
+    return np.asarray(A.sum(axis=1)).ravel()
+
+
+def _row_normalize(A):
+    # 各行を重みの和で割る。出次数0の行はそのまま (全て0)
+    s = out_degree(A)
+    s[s != 0] = 1.0 / s[s != 0]
+    # CSRのdataは行順に並んでいるので、各要素にその行の係数を掛ける
+    P = A.tocsr(copy=True)
+    P.data = P.data * np.repeat(s, np.diff(P.indptr))
+    return P
+
+
+def pagerank(A, alpha=0.85, max_iter=100, tol=1.0e-6):
+    n = A.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    # x @ P を P.T @ x で計算するため、転置をCSRで持っておく
+    PT = _row_normalize(A).T.tocsr()
+    is_dangling = out_degree(A) == 0
+    p = np.repeat(1.0 / n, n)
+    x = p
+    for _ in range(max_iter):
+        xlast = x
+        x = alpha * (PT @ x + x[is_dangling].sum() * p) + (1 - alpha) * p
+        if np.abs(x - xlast).sum() < n * tol:
+            return x
+    raise ValueError(f"pagerank did not converge in {max_iter} iterations")
+
+
+def hits(A, max_iter=100, tol=1.0e-8):
+    # (hubs, authorities)
+    # べき乗法は収束しないことがあるので、networkx.hits と同じく最大特異値の右特異ベクトルを
+    # authority、A @ authority を hub とする
+    n = A.shape[0]
+    if n == 0:
+        return np.zeros(0), np.zeros(0)
+    if A.nnz == 0:
+        return np.zeros(n), np.zeros(n)
+    if n == 1:
+        # svds は k < min(A.shape) が必要
+        a = np.ones(1)
+    else:
+        try:
+            _, _, vt = sp.sparse.linalg.svds(
+                A, k=1, v0=np.repeat(1.0 / n, n), maxiter=max_iter, tol=tol)
+        except sp.sparse.linalg.ArpackNoConvergence as e:
+            raise ValueError(f"hits did not converge in {max_iter} iterations") from e
+        # 特異ベクトルの符号は不定なので絶対値を取る (非負行列の最大特異値の特異ベクトルは非負にできる)
+        a = np.abs(vt.ravel().real)
+    h = A @ a
+    return h / (h.sum() or 1), a / (a.sum() or 1)
+
+
+def eigenvector(A, max_iter=100, tol=1.0e-6):
+    n = A.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    AT = A.T.tocsr()
+    x = np.repeat(1.0 / n, n)
+    for _ in range(max_iter):
+        xlast = x
+        # (A + I) で反復する
+        x = xlast + AT @ xlast
+        x /= np.linalg.norm(x) or 1
+        if np.abs(x - xlast).sum() < n * tol:
+            return x
+    raise ValueError(f"eigenvector centrality did not converge in {max_iter} iterations")
+
+
+def centrality_frame(user_ids, A, algorithm, **options):
+    # algorithm ごとの列を持つ user_id のDataFrame
+    # options: pagerank / hits / eigenvector に渡す max_iter, tol
+    if algorithm == "degree":
+        columns = {"degree": in_degree(A)}
+    elif algorithm == "out_degree":
+        columns = {"out_degree": out_degree(A)}
+    elif algorithm == "pagerank":
+        columns = {"pagerank": pagerank(A, **options)}
+    elif algorithm == "hits":
+        hubs, authorities = hits(A, **options)
+        columns = {"hub": hubs, "authority": authorities}
+    elif algorithm == "eigenvector":
+        columns = {"eigenvector": eigenvector(A, **options)}
+    else:
+        raise ValueError(f"Unknown algorithm: {algorithm}. Choose from {CENTRALITIES}")
+    return pl.DataFrame({"user_id": user_ids, **columns})
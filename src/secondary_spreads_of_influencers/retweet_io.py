@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import hashlib
+import polars as pl
+
+
+# [File Summary]
+# Shared loader for the retweeted tweets written by format_retweet_data.py
+#   (retweeted_tweets_dir/YYYY-MM-DD.parquet).
+# scan_retweeted_tweets scans every partition with pl.scan_parquet, so only the
+# requested columns are decoded and the rows whose user_id or source_tweet_id
+# is null are dropped inside the scan.
+# With cache_dir (the --rt_cache_dir option of the scripts that read the retweets),
+# the cleaned (source_tweet_id, user_id, tweet_id[, timestamp]) table
+# is saved once as a single parquet file and reused while the partitions are unchanged.
+# The cache key is the directory path and the (name, size, mtime) of every partition,
+# so adding or rewriting a partition invalidates it.
+
+RT_COLUMNS = ("source_tweet_id", "user_id", "tweet_id", "timestamp")
+
+
+def retweeted_tweets_paths(retweeted_tweets_dir):
+    return sorted(glob.glob(os.path.join(retweeted_tweets_dir, "*.parquet")))
+
+
+def _scan_partitions(retweeted_tweets_dir):
+    paths = retweeted_tweets_paths(retweeted_tweets_dir)
+    if len(paths) == 0:
+        raise ValueError(f"No parquet files in {retweeted_tweets_dir}")
+    return pl.scan_parquet(paths).filter(
+        pl.col("user_id").is_not_null() & pl.col("source_tweet_id").is_not_null()
+    )
+
+
+def _cache_key(retweeted_tweets_dir):
+    dir_key = hashlib.sha1(os.path.abspath(retweeted_tweets_dir).encode()).hexdigest()[:16]
+    stats = [
+        (os.path.basename(p), os.stat(p).st_size, os.stat(p).st_mtime_ns)
+        for p in retweeted_tweets_paths(retweeted_tweets_dir)
+    ]
+    files_key = hashlib.sha1(json.dumps(stats).encode()).hexdigest()[:16]
+    return dir_key, files_key
+
+
+def _cached_table(retweeted_tweets_dir, cache_dir):
+    dir_key, files_key = _cache_key(retweeted_tweets_dir)
+    cache_path = os.path.join(cache_dir, f"retweeted_tweets-{dir_key}-{files_key}.parquet")
+    if os.path.exists(cache_path):
+        return cache_path
+
+    print(f"Caching retweeted tweets to {cache_path}")
+    os.makedirs(cache_dir, exist_ok=True)
+    lf = _scan_partitions(retweeted_tweets_dir)
+    columns = [c for c in RT_COLUMNS if c in lf.collect_schema()]
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    lf.select(columns).collect().write_parquet(tmp_path)
+    os.replace(tmp_path, cache_path)
+
+    # 同じディレクトリの古いキャッシュは削除する
+    for path in glob.glob(os.path.join(cache_dir, f"retweeted_tweets-{dir_key}-*.parquet")):
+        if path != cache_path:
+            os.remove(path)
+    return cache_path
+
+
+def scan_retweeted_tweets(retweeted_tweets_dir,
+                          columns=("source_tweet_id", "user_id", "tweet_id"),
+                          cache_dir=None):
+    # user_id, source_tweet_id が null の行を除いた LazyFrame を返す
+    columns = list(columns)
+    if cache_dir is None:
+        return _scan_partitions(retweeted_tweets_dir).select(columns)
+
+    lf = pl.scan_parquet(_cached_table(retweeted_tweets_dir, cache_dir))
+    missing = [c for c in columns if c not in lf.collect_schema()]
+    if missing:
+        raise ValueError(f"{missing} are not cached. Cached columns are {RT_COLUMNS}")
+    return lf.select(columns)
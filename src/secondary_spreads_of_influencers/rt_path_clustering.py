@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 
 import pickle
-import os
 import argparse
 import polars as pl
 import networkx as nx
+from retweet_io import scan_retweeted_tweets
+from retweet_graph import build_retweet_graph, graph_from_networkx, save_retweet_graph
 
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("--canonicalized_source_tweets_path", type=str, required=False)
 arg_parser.add_argument("--retweeted_tweets_dir", type=str, required=False)
+arg_parser.add_argument("--rt_cache_dir", type=str, default=None)
 arg_parser.add_argument("--saved_graph_path", type=str, required=False)
 arg_parser.add_argument("--graph_save_path", type=str, required=False)
+arg_parser.add_argument("--csr_graph_save_path", type=str, default=None)
 arg_parser.add_argument("--clusters_save_path", type=str, required=True)
 arg_parser.add_argument("--algorithm", type=str, default="louvain")
 arg_parser.add_argument("--undirected", action="store_true")
@@ -25,6 +28,8 @@ arg_parser.add_argument("--undirected", action="store_true")
 #   Currently, only "louvain" is supported.
 # undirected:
 #   If this is provided, the graph is treated as undirected.
+# rt_cache_dir:
+#   Cache directory of the cleaned retweeted tweets (see retweet_io.py).
 # [Inputs]
 # canonicalized_source_tweets_path:
 #   Path to the canonicalized source tweets.
@@ -40,6 +45,9 @@ arg_parser.add_argument("--undirected", action="store_true")
 # graph_save_path:
 #   Path to save the graph.
 #   The graph is saved in the pickle format.
+# csr_graph_save_path:
+#   If set, the graph is also saved as a scipy CSR matrix (.npz, see retweet_graph.py).
+#   compute_centrality_from_retweets.py loads it much faster than the pickle.
 # clusters_save_path:
 #   Path to save the clusters.
 #   The clusters are saved in the parquet format.
@@ -50,25 +58,15 @@ def main(args):
         print("Loading Graph...")
         G = pickle.load(open(args.saved_graph_path, "rb"))
         user_ids = list(G.nodes)
+        if args.csr_graph_save_path is not None:
+            save_retweet_graph(args.csr_graph_save_path, *graph_from_networkx(G))
     else:
         if args.graph_save_path is None:
             raise ValueError("graph_save_path is required when saved_graph_path is not provided.")
 
         print("Loading retweeted tweets...")
-        retweeted_tweets_files = os.listdir(args.retweeted_tweets_dir)
-        retweeted_tweets_paths = [os.path.join(args.retweeted_tweets_dir, f)
-                                  for f in retweeted_tweets_files]
-
-        df_list = []
-        for i, path in enumerate(retweeted_tweets_paths):
-            df_rt = pl.read_parquet(path)
-            df_list.append(df_rt)
-        df_rt = pl.concat(df_list)
-        del df_list
-
-        df_rt = df_rt.filter(df_rt["user_id"].is_not_null())
-        df_rt = df_rt[["source_tweet_id", "user_id", "tweet_id"]]
-        df_rt = df_rt.filter(df_rt["source_tweet_id"].is_not_null())
+        df_rt = scan_retweeted_tweets(
+            args.retweeted_tweets_dir, cache_dir=args.rt_cache_dir).collect()
 
         df_source = pl.read_parquet(args.canonicalized_source_tweets_path)
         df_source = df_source.filter(df_source["tweet_id"].is_not_null())
@@ -96,6 +94,8 @@ def main(args):
 
         print("Saving Graph...")
         pickle.dump(G, open(args.graph_save_path, "wb"), protocol=4)
+        if args.csr_graph_save_path is not None:
+            save_retweet_graph(args.csr_graph_save_path, *build_retweet_graph(df))
 
     if args.undirected:
         G = G.to_undirected()
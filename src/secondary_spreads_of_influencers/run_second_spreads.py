@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import glob
+import hashlib
+import argparse
+from tqdm import tqdm
+import polars as pl
+from cascade_io import MANIFEST_SUFFIX
+from compute_second_spread_ratio import (
+    GB,
+    ROW_BYTES,
+    count_followers,
+    count_retweets,
+    follow_date_bounds,
+    load_followee_retweets,
+    scan_follower_relations,
+    scan_retweets,
+    virtual_timeline,
+)
+from pipeline_utils import spawn_pool, write_atomic
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("--workers", type=int, default=1)
+arg_parser.add_argument("--memory_budget_gb", type=float, default=8)
+arg_parser.add_argument("--restart", action="store_true")
+arg_parser.add_argument("--userinfo_path", type=str, required=True)
+arg_parser.add_argument("--retweeted_tweets_dir", type=str, required=True)
+arg_parser.add_argument("--rt_cache_dir", type=str, default=None)
+arg_parser.add_argument("--exclude_qt", action="store_true")
+arg_parser.add_argument("--qt_ids_path", type=str, required=False)
+arg_parser.add_argument("--exploded_rt_cascades_path", type=str, required=True)
+arg_parser.add_argument("--follower_relations_path", type=str, required=True)
+arg_parser.add_argument("--rt_timestamps_path", type=str, required=False)
+arg_parser.add_argument("--filter_by_timestamps", action="store_true")
+arg_parser.add_argument("--as_of", action="store_true")
+arg_parser.add_argument("--save_dir", type=str, required=True)
+
+
+# [File Summary]
+# This script runs compute_second_spread_ratio.py over all users with a process pool.
+# The followees are packed into windows by the estimated number of output rows
+#   (followers * retweets of the followee), not by the number of users.
+# Influencers whose rows exceed the per-worker budget get a window of their own,
+#   and the long-tail users are batched together until the budget is reached.
+# The plan and the completed windows are recorded next to save_dir
+#   (save_dir.plan.parquet and save_dir.manifest.json),
+#   so rerunning the same command resumes from the unfinished windows.
+# [Configs]
+# workers:
+#   Number of worker processes.
+#   The workers are spawned, not forked, because polars may deadlock in a forked child.
+#   A worker keeps only the ids of the users who retweeted and the target users.
+#   For each window it scans the retweets of the source tweets retweeted by
+#   the window's followees and the matching rows of the exploded cascades,
+#   so the full tables are never held by the workers (use rt_cache_dir to make the scans cheap).
+#   If follower_relations_path is a follower graph store, the workers share
+#   the memory-mapped graph through the page cache.
+# memory_budget_gb:
+#   Total memory budget. Each window is sized to memory_budget_gb / workers.
+# restart:
+#   Discard the plan, the manifest and the window files, and start over.
+# Other configs and inputs are the same as compute_second_spread_ratio.py.
+# [Outputs]
+# save_dir:
+#   Directory to save the computed second spreaders, one file per window
+#   (window-00000.parquet, ...). Pass it to aggregate_second_spreads.py.
+
+PLAN_SUFFIX = ".plan.parquet"
+
+_worker_state = {}
+
+
+def plan_path(save_dir):
+    return save_dir.rstrip("/") + PLAN_SUFFIX
+
+
+def progress_path(save_dir):
+    # save_dir の拡張子を外さない (ss.a と ss.b で別のファイルにする)
+    return save_dir.rstrip("/") + MANIFEST_SUFFIX
+
+
+def window_path(save_dir, window):
+    return os.path.join(save_dir, f"window-{window:05d}.parquet")
+
+
+def fingerprint(args):
+    # 出力に影響する設定が変わったら再開できないようにする
+    keys = ["userinfo_path", "retweeted_tweets_dir", "exclude_qt",
+            "qt_ids_path", "exploded_rt_cascades_path", "follower_relations_path",
+            "rt_timestamps_path", "filter_by_timestamps", "as_of"]
+    config = {key: getattr(args, key) for key in keys}
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def read_target_user_ids(args):
+    return pl.read_parquet(args.userinfo_path, columns=["user_id"])["user_id"].unique()
+
+
+def plan_windows(df_follower_counts, df_retweet_counts, max_rows):
+    # 行数の多いfolloweeから順に、max_rows を超えるまで同じwindowに詰める
+    df_plan = df_follower_counts.join(
+        df_retweet_counts,
+        left_on="followee",
+        right_on="user_id",
+    ).select(
+        "followee",
+        (pl.col("num_followers") * pl.col("num_retweets")).alias("estimated_rows"),
+    ).sort(["estimated_rows", "followee"], descending=True)
+
+    windows = []
+    window, window_rows = 0, 0
+    for estimated_rows in df_plan["estimated_rows"].to_list():
+        if window_rows > 0 and window_rows + estimated_rows > max_rows:
+            window, window_rows = window + 1, 0
+        windows.append(window)
+        window_rows += estimated_rows
+    return df_plan.with_columns(pl.Series("window", windows, dtype=pl.Int64))
+
+
+def read_progress(args):
+    path = progress_path(args.save_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_progress(args, progress):
+    def write(path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(progress, f, ensure_ascii=False, indent=2)
+    write_atomic(progress_path(args.save_dir), write)
+
+
+def init_worker(args, bounds):
+    _worker_state["bounds"] = bounds
+    _worker_state["target_user_ids"] = read_target_user_ids(args)
+    _worker_state["retweeted_user_ids"] = scan_retweets(args).select(
+        pl.col("user_id").unique()).collect(streaming=True)["user_id"]
+    _worker_state["df_plan"] = pl.read_parquet(plan_path(args.save_dir))
+    _worker_state["args"] = args
+
+
+def run_window(window):
+    args = _worker_state["args"]
+    df_plan = _worker_state["df_plan"]
+    followees = df_plan.filter(pl.col("window") == window)["followee"]
+    df_rt, df_pc_nodes = load_followee_retweets(args, followees)
+
+    lf_follower_relations = scan_follower_relations(
+        args.follower_relations_path,
+        _worker_state["retweeted_user_ids"],
+        _worker_state["target_user_ids"],
+        followees=followees,
+        as_of=args.as_of,
+        bounds=_worker_state["bounds"],
+    )
+    lf = virtual_timeline(
+        lf_follower_relations,
+        df_rt,
+        df_pc_nodes,
+        filter_by_timestamps=args.filter_by_timestamps,
+        as_of=args.as_of,
+    )
+    write_atomic(window_path(args.save_dir, window), lf.sink_parquet)
+    return window
+
+
+def main(args):
+    if args.filter_by_timestamps and not args.rt_timestamps_path:
+        raise ValueError("rt_timestamps_path is required when filter_by_timestamps is True")
+    if args.as_of and not args.rt_timestamps_path:
+        raise ValueError("rt_timestamps_path is required when as_of is True")
+
+    os.makedirs(args.save_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(args.save_dir, "window-*.parquet.tmp")):
+        os.remove(path)
+
+    progress = read_progress(args)
+    if args.restart and progress is not None:
+        for path in glob.glob(os.path.join(args.save_dir, "window-*.parquet")):
+            os.remove(path)
+        progress = None
+    if progress is not None and progress["fingerprint"] != fingerprint(args):
+        raise ValueError(f"{args.save_dir} was planned with other configs. Use --restart to start over.")
+
+    if progress is None:
+        print("Planning windows...")
+        target_user_ids = read_target_user_ids(args)
+        df_retweet_counts = count_retweets(args)
+        df_follower_counts = count_followers(
+            args.follower_relations_path, df_retweet_counts["user_id"], target_user_ids)
+        max_rows = args.memory_budget_gb * GB / args.workers / ROW_BYTES
+        df_plan = plan_windows(df_follower_counts, df_retweet_counts, max_rows)
+        df_plan.write_parquet(plan_path(args.save_dir))
+        del df_retweet_counts, df_follower_counts
+
+        num_windows = int(df_plan["window"].max()) + 1 if len(df_plan) > 0 else 0
+        progress = {
+            "fingerprint": fingerprint(args),
+            "num_windows": num_windows,
+            "completed": [],
+        }
+        write_progress(args, progress)
+
+    completed = set(progress["completed"])
+    windows = [w for w in range(progress["num_windows"]) if w not in completed]
+    print(f"Number of windows: {progress['num_windows']} ({len(windows)} remaining)")
+    if len(windows) == 0:
+        return
+
+    bounds = follow_date_bounds(args.follower_relations_path, args.as_of)
+    with spawn_pool(args.workers, initializer=init_worker, initargs=(args, bounds)) as pool:
+        for window in tqdm(pool.imap_unordered(run_window, windows), total=len(windows)):
+            progress["completed"].append(window)
+            write_progress(args, progress)
+
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    main(args)
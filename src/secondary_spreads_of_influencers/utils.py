@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 
+import os
 import re
+import sys
+import json
+import time
+import hashlib
+import functools
 import vibrato
 import zstandard
 import neologdn
@@ -8,6 +14,8 @@ import numpy as np
 from scipy.special import kl_div
 import matplotlib.colors as mcolors
 import numpy as np
+import polars as pl
+from pipeline_utils import spawn_pool
 
 
 BRACKET = "\\[|\\(|\\（|\\【|\\{|\\〈|\\［|\\｛|\\＜|\\｜|\\|"
@@ -15,8 +23,33 @@ EMOTICON_CHARS = "￣|◕|´|_|ﾟ|・|｀|\\-|\\^|\\ |･|＾|ω|\\`|＿|゜|
 RE_EMOTICON = re.compile('('+BRACKET+')(['+EMOTICON_CHARS+']{3,}).*')
 SYMBOLS = {"MENTIONSYM", "EMOSYM", "IMGSYM", "URLSYM"}
 
+URL_CHARS = r"[\w/:%#\$&\?\(\)~\.=\+\-]"
+IMG_URL = r"https://pbs.twimg.com/" + URL_CHARS + "+"
+VIDEO_URL = r"https://video.twimg.com/" + URL_CHARS + "+"
+ANY_URL = r"h?ttps?://?" + URL_CHARS + "+"
+MENTION = r"@[a-zA-Z0-9_]+"
+
+RE_SPLIT_URL = re.compile(r"(.+)(https?)")
+RE_IMG_URL = re.compile(IMG_URL)
+RE_VIDEO_URL = re.compile(VIDEO_URL)
+RE_ANY_URL = re.compile(ANY_URL)
+RE_MENTION = re.compile(MENTION)
+# \u200bは\sに含まれない。改行もまとめて1つの空白になる
+RE_SPACES = re.compile(r"[\s\u200b]+")
+
 STOPWORDS = ["日", "中", "・ﾟ", "・", "する"]
-_vib_tokenizer = None
+_worker_tokenizer = None
+
+# vibratoの辞書。環境変数か Tokenizer(dict_path=...) で変えられる
+DEFAULT_DICT_PATH = "/data_pwdtms04/niitsuma-t/projects/vibrato-dict-ipa-neologd/dict/mecab-ipadic-neologd.dic.zst"
+DICT_PATH_ENV = "VIBRATO_DICT_PATH"
+DICT_CACHE_DIR_ENV = "VIBRATO_DICT_CACHE_DIR"
+DEFAULT_DICT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "vibrato_dict")
+_tokenizers = {}
+
+# トークナイズ結果のキャッシュ。Tokenizerの処理を変えたら TOKEN_CACHE_VERSION を上げる
+TOKEN_CACHE_VERSION = 2
+TOKEN_CACHE_FILE = "tokens.parquet"
 
 CLUSTER_NUMBER_TO_NAME = {
     0: "Others (Popular Topics)",
@@ -57,7 +90,7 @@ def identity(x):
 
 
 def symbolize_mention(text):
-    return re.sub(r"@[a-zA-Z0-9_]+", " MENTIONSYM ", text)
+    return RE_MENTION.sub(" MENTIONSYM ", text)
 
 
 def symbolize_emoticon(text):
@@ -66,23 +99,116 @@ def symbolize_emoticon(text):
 
 def symbolize_url(text):
     # https://pbs.twimg.com/から始まるURLはIMGSYMに置換
-    text = re.sub(r"https://pbs.twimg.com/[\w/:%#\$&\?\(\)~\.=\+\-]+", " IMGSYM ", text)
+    text = RE_IMG_URL.sub(" IMGSYM ", text)
 
     # https://video.twimg.com/から始まるURLはVIDEOSYMに置換
-    text = re.sub(r"https://video.twimg.com/[\w/:%#\$&\?\(\)~\.=\+\-]+", " VIDEOSYM ", text)
+    text = RE_VIDEO_URL.sub(" VIDEOSYM ", text)
 
     # https?://から始まるURLはURLSYMに置換
     # HOSTNAMEをSYMNOLにするということは可能？
     # tokenizerで1単語で認識
-    return re.sub(r"h?ttps?://?[\w/:%#\$&\?\(\)~\.=\+\-]+", " URLSYM ", text)
+    return RE_ANY_URL.sub(" URLSYM ", text)
+
+
+def _until(chars, *patterns):
+    # patterns のどれかが始まる位置の手前で止まる chars
+    return "(?:" + "".join(f"(?!{p})" for p in patterns) + chars + ")"
+
+
+@functools.lru_cache(maxsize=None)
+def symbolize_passes(symbolize):
+    # symbolize_url -> symbolize_emoticon -> symbolize_mention を順に適用した結果と同じになるように、
+    # 置換を名前付きグループの選択 (グループ名が記号) にまとめる。
+    # IMGは単独の回にする。VIDEOがマッチするかはIMGを置換した後の文字列で決まるため
+    # (例: "https://video.twimg.com/https://pbs.twimg.com/a" はIMGの置換後はVIDEOにならない)。
+    # VIDEO -> URL の順の置換は、URLがVIDEOの開始位置で止まるようにすれば1回で済む。
+    # 顔文字は行末まで置換し、URLを置換した後の文字列に対してマッチするので、URLとは別の回にする。
+    # メンションは前の回の置換と同じ回にまとめる (URLと同じ回ならURLの開始位置で止める)。
+    # VIDEOを置換した後の文字列でURLSYMになる部分
+    any_url = f"h?ttps?://?{_until(URL_CHARS, VIDEO_URL)}+"
+    passes = []
+    if "url" in symbolize:
+        passes.append([f"(?P<IMGSYM>{IMG_URL})"])
+        passes.append([f"(?P<VIDEOSYM>{VIDEO_URL})", f"(?P<URLSYM>{any_url})"])
+    if "emoticon" in symbolize:
+        passes.append([f"(?P<EMOSYM>{RE_EMOTICON.pattern})"])
+    if "mention" in symbolize:
+        if "url" in symbolize and "emoticon" not in symbolize:
+            passes[-1].append(f"(?P<MENTIONSYM>@{_until('[a-zA-Z0-9_]', any_url)}+)")
+        elif passes:
+            passes[-1].append(f"(?P<MENTIONSYM>{MENTION})")
+        else:
+            passes.append([f"(?P<MENTIONSYM>{MENTION})"])
+    return [re.compile("|".join(alternatives)) for alternatives in passes]
+
+
+def _symbol(match):
+    return f" {match.lastgroup} "
+
+
+def dict_path_of(dict_path=None):
+    return os.path.abspath(dict_path or os.environ.get(DICT_PATH_ENV, DEFAULT_DICT_PATH))
+
 
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            h.update(block)
+    return h.hexdigest()
 
-def load_tokenizer():
-    dctx = zstandard.ZstdDecompressor()
-    with open("/data_pwdtms04/niitsuma-t/projects/vibrato-dict-ipa-neologd/dict/mecab-ipadic-neologd.dic.zst", "rb") as fp:
-        with dctx.stream_reader(fp) as reader:
-            tokenizer = vibrato.Vibrato(reader.read())
-    return tokenizer
+
+def dict_hash(dict_path=None, cache_dir=None):
+    # 辞書ファイルの内容のハッシュ。(size, mtime) が同じ間は index.json の値を使う
+    dict_path = dict_path_of(dict_path)
+    cache_dir = cache_dir or os.environ.get(DICT_CACHE_DIR_ENV, DEFAULT_DICT_CACHE_DIR)
+    index_path = os.path.join(cache_dir, "index.json")
+    stat = os.stat(dict_path)
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    entry = index.get(dict_path)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["hash"]
+
+    digest = _file_hash(dict_path)
+    index[dict_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest}
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, index_path)
+    return digest
+
+
+def decompressed_dict_path(dict_path=None, cache_dir=None):
+    # .zst の辞書は内容のハッシュをキーに1回だけ展開して cache_dir に置く
+    dict_path = dict_path_of(dict_path)
+    if not dict_path.endswith(".zst"):
+        return dict_path
+
+    cache_dir = cache_dir or os.environ.get(DICT_CACHE_DIR_ENV, DEFAULT_DICT_CACHE_DIR)
+    cache_path = os.path.join(cache_dir, f"{dict_hash(dict_path, cache_dir)[:16]}.dic")
+    if os.path.exists(cache_path):
+        return cache_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(dict_path, "rb") as fp, open(tmp_path, "wb") as out:
+        zstandard.ZstdDecompressor().copy_stream(fp, out)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def load_tokenizer(dict_path=None):
+    # 同じ辞書のvibratoはプロセスで1つだけ作る
+    dict_path = dict_path_of(dict_path)
+    if dict_path not in _tokenizers:
+        with open(decompressed_dict_path(dict_path), "rb") as fp:
+            _tokenizers[dict_path] = vibrato.Vibrato(fp.read())
+    return _tokenizers[dict_path]
 
 
 def is_content_word(pos):
@@ -96,33 +222,90 @@ def is_content_word(pos):
 
 def clean_text(text, symbolize={"mention", "emoticon", "url"}, remove_nlsp=True):
     text = neologdn.normalize(text, tilde="normalize")
-    text = re.sub(r"(.+)(https?)", "\\1 \\2", text)
+    text = RE_SPLIT_URL.sub("\\1 \\2", text)
+
+    for pattern in symbolize_passes(frozenset(symbolize)):
+        text = pattern.sub(_symbol, text)
+
+    if remove_nlsp:
+        text = RE_SPACES.sub(" ", text)
+
+    return text
+
+
+def _rust_class(chars):
+    # 文字の集合を polars (Rust regex) の文字クラスにする
+    chars = sorted(ord(c) for c in chars)
+    ranges = []
+    for c in chars:
+        if ranges and ranges[-1][1] == c - 1:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+    return "[" + "".join(
+        f"\\x{{{a:X}}}" if a == b else f"\\x{{{a:X}}}-\\x{{{b:X}}}" for a, b in ranges) + "]"
+
+
+@functools.lru_cache(maxsize=None)
+def _rust_patterns():
+    # Pythonのreと同じ文字にマッチするように、\w, \s, 顔文字の文字クラスを展開する
+    # (Rustの\w, \sはUnicodeの定義が少し違う)
+    word = [chr(c) for c in range(sys.maxunicode + 1)
+            if (chr(c).isalnum() or chr(c) == "_") and not 0xD800 <= c <= 0xDFFF]
+    spaces = [chr(c) for c in range(sys.maxunicode + 1) if chr(c).isspace()] + ["\u200b"]
+    brackets = [c for c in set(BRACKET) if re.fullmatch(BRACKET, c)]
+    emoticon_chars = [c for c in set(EMOTICON_CHARS) if re.fullmatch(f"[{EMOTICON_CHARS}]", c)]
+    url_chars = _rust_class(word + list("/:%#$&?()~.=+-"))
+    return {
+        "img": f"https://pbs.twimg.com/{url_chars}+",
+        "video": f"https://video.twimg.com/{url_chars}+",
+        "url": f"h?ttps?://?{url_chars}+",
+        "emoticon": f"{_rust_class(brackets)}{_rust_class(emoticon_chars)}{{3,}}.*",
+        "mention": MENTION,
+        "spaces": f"{_rust_class(spaces)}+",
+    }
+
+
+def clean_text_expr(expr, symbolize={"mention", "emoticon", "url"}, remove_nlsp=True):
+    # clean_text と同じ結果を返す polars の式。
+    # neologdn 以外は str.replace_all で列全体をまとめて置換する
+    patterns = _rust_patterns()
+    expr = expr.map_elements(
+        lambda text: neologdn.normalize(text, tilde="normalize"), return_dtype=pl.String
+    ).str.replace_all(r"(.+)(https?)", "${1} ${2}")
 
     if "url" in symbolize:
-        text = symbolize_url(text)
+        expr = expr.str.replace_all(patterns["img"], " IMGSYM ")
+        expr = expr.str.replace_all(patterns["video"], " VIDEOSYM ")
+        expr = expr.str.replace_all(patterns["url"], " URLSYM ")
 
     if "emoticon" in symbolize:
-        text = symbolize_emoticon(text)
+        expr = expr.str.replace_all(patterns["emoticon"], " EMOSYM ")
 
     if "mention" in symbolize:
-        text = symbolize_mention(text)
+        expr = expr.str.replace_all(patterns["mention"], " MENTIONSYM ")
 
     if remove_nlsp:
-        text = text.replace("\u200b", " ")
-        text = re.sub(r"(\n|\r\n|\r)+", "\n", text)
-        text = re.sub(r"\s+", " ", text)
+        expr = expr.str.replace_all(patterns["spaces"], " ")
 
-    return text
+    return expr
 
 
 class Tokenizer:
-    def __init__(self, symbolize={"mention", "emoticon", "url"}):
-        self.tokenizer = load_tokenizer()
+    def __init__(self, symbolize={"mention", "emoticon", "url"}, dict_path=None):
+        # 辞書は最初に __call__ したときに読み込む
+        self.dict_path = dict_path
         self.symbolize = symbolize
 
+    @property
+    def tokenizer(self):
+        return load_tokenizer(self.dict_path)
+
     def __call__(self, text):
-        text = clean_text(text, self.symbolize)
+        return self.tokenize_cleaned(clean_text(text, self.symbolize))
 
+    def tokenize_cleaned(self, text):
+        # clean_text 済みのテキストをトークナイズする
         ms = []
         for m in self.tokenizer.tokenize(text):
             feature = m.feature().split(",")
@@ -140,38 +323,145 @@ class Tokenizer:
 
 
 def tokenize_text(text):
-    # クロージャで実装すべき？
-    global _vib_tokenizer
-    if _vib_tokenizer is None:
-        _vib_tokenizer = load_tokenizer()
-
-    text = clean_text(text)
-
-    ms = []
-    for m in _vib_tokenizer.tokenize(text):
-        feature = m.feature().split(",")
-        pos = feature[0:3]
-        lemma = feature[6]
-        if not is_content_word(pos):
+    return Tokenizer()(text)
+
+
+def _init_tokenize_worker(symbolize, dict_path):
+    # 辞書の読み込みはworkerごとに1回だけ
+    global _worker_tokenizer
+    _worker_tokenizer = Tokenizer(symbolize, dict_path)
+
+
+def _tokenize_chunk(texts):
+    # clean_text もworkerで行う
+    return [_worker_tokenizer(text) for text in texts]
+
+
+def token_cache_keys(texts, symbolize, dict_path=None):
+    # (キャッシュの版, symbolize, 辞書の内容, 元のテキスト) のハッシュ
+    prefix = json.dumps([TOKEN_CACHE_VERSION, sorted(symbolize), dict_hash(dict_path)])
+    base = hashlib.blake2b(prefix.encode(), digest_size=16)
+    keys = []
+    for text in texts:
+        h = base.copy()
+        h.update(text.encode())
+        keys.append(h.digest())
+    return pl.Series("key", keys, dtype=pl.Binary)
+
+
+def read_token_cache(cache_dir, keys):
+    # keys のうちキャッシュにあるものの (key, tokens)
+    path = os.path.join(cache_dir, TOKEN_CACHE_FILE)
+    if not os.path.exists(path):
+        return pl.DataFrame(schema={"key": pl.Binary, "tokens": pl.List(pl.String)})
+    return pl.scan_parquet(path).join(
+        keys.to_frame("key").lazy(), on="key", how="semi").select("key", "tokens").collect()
+
+
+def update_token_cache(cache_dir, df_tokens, max_entries=10_000_000):
+    # df_tokens: 今回使った (key, tokens)。既存のエントリとまとめ、最後に使った時刻が新しい順に max_entries 件残す
+    # 同じ cache_dir に同時に書き込んだ場合は後に書いた方が残る
+    path = os.path.join(cache_dir, TOKEN_CACHE_FILE)
+    lf = df_tokens.lazy().with_columns(pl.lit(time.time_ns()).alias("last_used"))
+    if os.path.exists(path):
+        lf_old = pl.scan_parquet(path).join(lf.select("key"), on="key", how="anti")
+        lf = pl.concat([lf, lf_old])
+    df_cache = lf.sort("last_used", descending=True).head(max_entries).collect()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    df_cache.write_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def tokenize_batch(texts, symbolize={"mention", "emoticon", "url"}, workers=1, chunk_size=10000,
+                   dict_path=None, cache_dir=None, cache_max_entries=10_000_000, stats=None):
+    # texts: 文字列の pl.Series / pyarrow.Array
+    # 同じテキストは1回だけ clean_text とトークナイズを行い、元の順序の List[String] の Series を返す (nullはnull)
+    # workers > 1 なら clean_text とトークナイズの両方をworkerで行う
+    # cache_dir を指定すると、前回までの結果をキャッシュから読み、新しいテキストだけをトークナイズする
+    # stats: dictを渡すと、num_texts (重複を除いたテキスト数) と cache_hits (キャッシュにあった数) を書き込む
+    texts = pl.Series("text", texts, dtype=pl.String)
+    df_tokens = texts.to_frame().drop_nulls().unique().with_columns(
+        pl.lit(None, dtype=pl.List(pl.String)).alias("tokens"))
+
+    if cache_dir is not None:
+        df_tokens = df_tokens.with_columns(token_cache_keys(df_tokens["text"], symbolize, dict_path))
+        df_cached = read_token_cache(cache_dir, df_tokens["key"])
+        df_tokens = df_tokens.drop("tokens").join(df_cached, on="key", how="left")
+        if stats is not None:
+            stats["cache_hits"] = len(df_cached)
+
+    df_misses = df_tokens.filter(pl.col("tokens").is_null())
+    misses = df_misses["text"].to_list()
+    chunks = [misses[i:i + chunk_size] for i in range(0, len(misses), chunk_size)]
+
+    if len(chunks) == 0:
+        tokens = []
+    elif workers <= 1:
+        _init_tokenize_worker(symbolize, dict_path)
+        tokens = [_tokenize_chunk(chunk) for chunk in chunks]
+    else:
+        with spawn_pool(workers, initializer=_init_tokenize_worker, initargs=(symbolize, dict_path)) as pool:
+            tokens = pool.map(_tokenize_chunk, chunks)
+
+    df_misses = df_misses.with_columns(
+        pl.Series("tokens", [t for chunk in tokens for t in chunk], dtype=pl.List(pl.String)))
+    df_tokens = pl.concat([df_tokens.filter(pl.col("tokens").is_not_null()), df_misses])
+    if cache_dir is not None:
+        update_token_cache(cache_dir, df_tokens.select("key", "tokens"), cache_max_entries)
+
+    if stats is not None:
+        stats["num_texts"] = len(df_tokens)
+        stats.setdefault("cache_hits", 0)
+    return texts.to_frame().join(df_tokens.select("text", "tokens"), on="text", how="left")["tokens"]
+
+
+def fasttext_vocab(words, fasttext):
+    # words に出てくる単語のうち fasttext.wv にあるもの (サブワードで引ける未知語も含む) とそのベクトル
+    vocab = [word for word in words.unique().to_list() if word in fasttext.wv]
+    if len(vocab) == 0:
+        return pl.Series("word", [], dtype=pl.String), np.zeros((0, fasttext.wv.vector_size), dtype=np.float32)
+    return pl.Series("word", vocab, dtype=pl.String), np.asarray(fasttext.wv[vocab], dtype=np.float32)
+
+
+def mean_fasttext(words_list, fasttext, dim=50, save_path=None, batch_size=1_000_000):
+    # words_list: 単語のリストのリスト / List[String] の Series
+    # 各行の単語ベクトルの平均を (len(words_list), dim) の float32 の配列で返す。単語がない行は0
+    # save_path を指定すると np.load(save_path, mmap_mode="r") で読める .npy に直接書き込む
+    words_list = pl.Series("words", words_list, dtype=pl.List(pl.String))
+    n = len(words_list)
+    if save_path is None:
+        embeds = np.zeros((n, dim), dtype=np.float32)
+    else:
+        embeds = np.lib.format.open_memmap(save_path, mode="w+", dtype=np.float32, shape=(n, dim))
+
+    # 語彙は全体で1回だけ引く
+    vocab, vectors = fasttext_vocab(words_list.explode().drop_nulls(), fasttext)
+    df_vocab = vocab.to_frame().with_row_index("index")
+
+    for offset in range(0, n, batch_size):
+        batch = words_list.slice(offset, batch_size)
+        lengths = batch.list.len().fill_null(0).to_numpy()
+        rows = np.repeat(np.arange(len(batch)), lengths)
+        words = batch.filter(batch.list.len() > 0).explode().rename("word")
+        index = words.to_frame().join(df_vocab, on="word", how="left")["index"]
+
+        # 語彙にない単語を除き、行ごとに連続した単語ベクトルを reduceat で足し合わせる
+        known = index.is_not_null().to_numpy()
+        rows = rows[known]
+        gathered = vectors[index.drop_nulls().to_numpy()]
+        counts = np.bincount(rows, minlength=len(batch))
+        has_words = counts > 0
+        if not has_words.any():
             continue
-        if lemma is None or lemma == "*":
-            lemma = m.surface()
-        if lemma.isascii():
-            if pos[1] != "固有名詞" and lemma not in SYMBOLS:
-                lemma = lemma.lower()
-        ms.append(lemma)
-    return ms
-
-
-def mean_fasttext(words_list, fasttext, dim=50):
-    embeds = []
-    for words in words_list:
-        words = [word for word in words if word in fasttext.wv]
-        if len(words) == 0:
-            embeds.append(np.zeros(dim))
-        else:
-            embeds.append(np.mean(fasttext.wv[words], axis=0))
-    return np.array(embeds)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[has_words]
+        sums = np.add.reduceat(gathered, starts, axis=0)
+        embeds[offset + np.flatnonzero(has_words)] = sums / counts[has_words, None]
+
+    if save_path is not None:
+        embeds.flush()
+    return embeds
 
 
 def diff_of_bio_cluster(df_bio_cluster, target_user_ids, method="kld", return_dist=False):
@@ -238,3 +528,103 @@ def diff_of_bio_cluster_between_two(df_bio_cluster, user_ids1, user_ids2, method
         return bhattacharyya_distance(dist_target1, dist_target2)
     else:
         raise ValueError(f"Unknown method: {method}")
+
+
+def kld_matrix(p, q):
+    # 最後の軸が分布。p, q はブロードキャストされる
+    return kl_div(p, q).sum(axis=-1)
+
+
+def jsd_matrix(p, q):
+    m = (p + q) / 2
+    return (kl_div(p, m) + kl_div(q, m)).sum(axis=-1) / 2
+
+
+def bhattacharyya_matrix(p, q):
+    return -np.log(np.sqrt(p * q).sum(axis=-1))
+
+
+DIVERGENCES = {
+    "kld": kld_matrix,
+    "jsd": jsd_matrix,
+    "bhattacharyya": bhattacharyya_matrix,
+}
+
+
+class BioClusterIndex:
+    # df_bio_cluster (user_id, cluster) からユーザ -> クラスタ番号の表を1回だけ作り、
+    # 複数のユーザ集合のクラスタ分布と分布間の距離をまとめて計算する
+    def __init__(self, df_bio_cluster):
+        self.clusters = df_bio_cluster["cluster"].drop_nulls().unique().sort()
+        self.df_index = df_bio_cluster.select("user_id", "cluster").join(
+            self.clusters.to_frame().with_row_index("cluster_index"), on="cluster"
+        ).select("user_id", pl.col("cluster_index").cast(pl.Int64))
+        self.n_clusters = len(self.clusters)
+        self.counts_all = np.bincount(self.df_index["cluster_index"].to_numpy(), minlength=self.n_clusters)
+        self.dist_all = self.counts_all / self.counts_all.sum()
+
+    def _group_frame(self, groups, group_col):
+        # groups: (user_id, group_col) の DataFrame か、ユーザIDの配列のリスト / dict
+        if isinstance(groups, pl.DataFrame):
+            df_groups = groups.select("user_id", pl.col(group_col).alias("group"))
+            labels = df_groups["group"].unique().sort()
+        else:
+            if not isinstance(groups, dict):
+                groups = dict(enumerate(groups))
+            labels = pl.Series("group", list(groups.keys()))
+            # 空のリストは Null 型になるので、結合する前に型を揃える
+            dtype = self.df_index["user_id"].dtype
+            ids = [pl.Series("user_id", user_ids).cast(dtype) for user_ids in groups.values()]
+            df_groups = pl.DataFrame({
+                "user_id": pl.concat(ids) if ids else pl.Series("user_id", [], dtype=dtype),
+                "group": labels.gather(np.repeat(np.arange(len(ids)), [len(s) for s in ids])),
+            })
+        df_groups = df_groups.unique().join(labels.to_frame().with_row_index("group_index"), on="group")
+        return labels, df_groups
+
+    def counts(self, groups, group_col="group"):
+        # (グループのラベル, グループ x クラスタ の人数の行列)
+        labels, df_groups = self._group_frame(groups, group_col)
+        df = df_groups.join(self.df_index, on="user_id")
+        flat = df["group_index"].to_numpy().astype(np.int64) * self.n_clusters + df["cluster_index"].to_numpy()
+        counts = np.bincount(flat, minlength=len(labels) * self.n_clusters)
+        return labels, counts.reshape(len(labels), self.n_clusters)
+
+    def distributions(self, groups, group_col="group"):
+        labels, counts = self.counts(groups, group_col)
+        return labels, _normalize(counts)
+
+    def divergence(self, groups, method="kld", pairwise=False, group_col="group"):
+        # pairwise=False: 各グループと全体の分布の距離 (グループ数,)
+        # pairwise=True: グループ i と j の距離 (グループ数, グループ数)
+        # クラスタの分かるユーザが1人もいないグループの距離は NaN
+        labels, dists = self.distributions(groups, group_col)
+        return labels, _divergence(dists, self.dist_all, method, pairwise)
+
+    def bootstrap(self, groups, method="kld", pairwise=False, n_boot=1000, seed=0, group_col="group"):
+        # 各グループのユーザを復元抽出したときの距離。(n_boot, ...) の配列
+        # 復元抽出したクラスタの人数は多項分布に従うので、ユーザを直接サンプリングせずに引く
+        labels, counts = self.counts(groups, group_col)
+        rng = np.random.default_rng(seed)
+        sizes = counts.sum(axis=1)
+        samples = rng.multinomial(sizes, _normalize(counts), size=(n_boot, len(labels)))
+        return labels, _divergence(_normalize(samples), self.dist_all, method, pairwise)
+
+
+def _normalize(counts):
+    totals = counts.sum(axis=-1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros(counts.shape), where=totals > 0)
+
+
+def _divergence(dists, dist_all, method, pairwise):
+    if method not in DIVERGENCES:
+        raise ValueError(f"Unknown method: {method}")
+    # 人数0のグループ (分布が全て0) は NaN にする
+    is_empty = dists.sum(axis=-1) == 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if pairwise:
+            values = DIVERGENCES[method](dists[..., :, None, :], dists[..., None, :, :])
+            is_empty = is_empty[..., :, None] | is_empty[..., None, :]
+        else:
+            values = DIVERGENCES[method](dists, dist_all)
+    return np.where(is_empty, np.nan, values)